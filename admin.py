@@ -1,23 +1,33 @@
 # coding : utf -8
 # from flask.ext.htmlbuilder import html
 # from flask.ext.admin.babel import lazy_gettext
+from flask import flash, request, redirect, url_for, abort, Response
+from flask.ext.admin import expose
+from flask.ext.admin.actions import action
+from markupsafe import Markup
 from quokka import admin
 from quokka.modules.posts.admin import PostAdmin
 from quokka.core.admin.models import ModelAdmin
 from quokka.utils.translation import _, _l
+from quokka.utils import get_current_user
 from quokka.core.widgets import TextEditor, PrepopulatedText
-from .models import Cart, Processor
+from .models import (Cart, Processor, CartProfile, Promotion,
+                     PaymentRecord)
+from .archive import archived_carts, restore_cart
+from .breaker import get_breaker_stats
+from .functions import send_task
 
 
 class ProductAdmin(PostAdmin):
     column_list = ('title', 'slug', 'channel',
-                   'unity_value', 'weight',
+                   'unity_value', 'weight', 'stock',
                    'published', 'created_at',
                    'available_at', 'view_on_site')
     column_searchable_list = ['title', 'summary', 'description']
     form_columns = [
         'title', 'slug', 'channel', 'related_channels', 'summary',
         'description', 'unity_value', 'weight', 'dimensions', 'extra_value',
+        'stock',
         'published', 'show_on_channel',
         'available_at', 'available_until',
         'tags', 'contents', 'values', 'template_type'
@@ -36,6 +46,18 @@ class ProductAdmin(PostAdmin):
         'slug': {'style': 'width: 400px'},
     }
 
+    price_fields = ('unity_value', 'extra_value')
+
+    def after_model_change(self, form, model, is_created):
+        super(ProductAdmin, self).after_model_change(form, model, is_created)
+        changed = [
+            name for name in self.price_fields
+            if name in form and form[name].object_data != form[name].data
+        ]
+        if changed and not is_created:
+            send_task('reprice_product', str(model.id))
+            flash(_("Pending carts will be repriced"))
+
 
 class CartAdmin(ModelAdmin):
     roles_accepted = ('admin', 'editor')
@@ -109,10 +131,93 @@ class CartAdmin(ModelAdmin):
                 model.set_reference_tax(float(model.tax))
             model.reference.save()
 
+    def get_one(self, id):
+        # archived carts are reached transparently from the Cart view
+        return super(CartAdmin, self).get_one(id) or \
+            archived_carts(id=id).first()
+
+    def update_model(self, form, model):
+        if not Cart.objects(id=model.id).count():
+            # editing an archived cart brings it back to the hot tier
+            restore_cart(id=model.id)
+        return super(CartAdmin, self).update_model(form, model)
+
+    def bulk_action(self, method, ids, *args):
+        try:
+            count = method(ids, *args, by=get_current_user())
+            flash(_(u"%(count)s carts updated", count=count))
+        except Exception as e:
+            flash(_(u"Bulk action failed: %(error)s", error=e), 'error')
+
+    @action('publish', _l(u"Publish"), _l(u"Publish selected carts?"))
+    def action_publish(self, ids):
+        self.bulk_action(Cart.bulk_set_published, ids, True)
+
+    @action('unpublish', _l(u"Unpublish"), _l(u"Unpublish selected carts?"))
+    def action_unpublish(self, ids):
+        self.bulk_action(Cart.bulk_set_published, ids, False)
+
+    @action('set_tax', _l(u"Set tax"), _l(u"Set tax of selected carts?"))
+    def action_set_tax(self, ids):
+        # the action form has no fields, the tax is asked in set_tax_view
+        return redirect(url_for('.set_tax_view', ids=','.join(ids)))
+
+    @expose('/settax/', methods=('GET', 'POST'))
+    def set_tax_view(self):
+        ids = [cart_id for cart_id in request.values.get('ids', '').split(',')
+               if cart_id]
+        if request.method == 'POST':
+            self.bulk_action(Cart.bulk_set_tax, ids, request.form.get('tax'))
+            return redirect(url_for('.index_view'))
+        return self.render('admin/cart/set_tax.html', ids=ids)
+
+
+def status_action(status, label):
+    @action('status_%s' % status, label,
+            _l(u"Change status of selected carts?"))
+    def action_status(self, ids):
+        self.bulk_action(Cart.bulk_set_status, ids, status)
+    return action_status
+
+
+for status, label in Cart.STATUS:
+    setattr(CartAdmin, 'action_status_%s' % status,
+            status_action(status, label))
+
+
+class ArchivedCartAdmin(CartAdmin):
+    """Read only listing of carts moved to the archive collection"""
+    can_create = False
+    can_edit = False
+    can_delete = False
+    action_disallowed_list = ['publish', 'unpublish', 'set_tax'] + [
+        'status_%s' % status for status, label in Cart.STATUS
+    ]
+
+    def get_query(self):
+        return archived_carts()
+
+    def get_one(self, id):
+        return archived_carts(id=id).first()
+
+    @action('restore', _l(u"Restore"), _l(u"Restore selected carts?"))
+    def action_restore(self, ids):
+        restored = [cart_id for cart_id in ids if restore_cart(id=cart_id)]
+        flash(_(u"%(count)s carts restored", count=len(restored)))
+
+
+def format_circuit(view, context, model, name):
+    # breakers live in memory, this is the state in the current process
+    stats = get_breaker_stats(model.identifier)
+    if not stats:
+        return u"-"
+    return u"{state} ({failures}/{calls} failures)".format(**stats)
+
 
 class ProcessorAdmin(ModelAdmin):
     roles_accepted = ('admin', 'developer')
-    column_list = ('identifier', 'title', 'module', 'published')
+    column_list = ('identifier', 'title', 'module', 'circuit', 'published')
+    column_formatters = {'circuit': format_circuit}
     form_args = {
         "description": {"widget": TextEditor()},
         "identifier": {"widget": PrepopulatedText(master='title')}
@@ -128,6 +233,64 @@ class ProcessorAdmin(ModelAdmin):
         'config': {'cols': 40, 'rows': 10, 'style': 'width:500px;'}
     }
 
+
+class CartProfileAdmin(ModelAdmin):
+    roles_accepted = ('admin', 'developer')
+    # capped collection, documents can not be changed nor deleted
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('created_at', 'endpoint', 'cart_id', 'pipeline_index',
+                   'duration', 'samples', 'stacks')
+    column_filters = ('endpoint', 'cart_id', 'created_at', 'duration')
+    column_formatters = {
+        'created_at': ModelAdmin.formatters.get('datetime'),
+        'stacks': lambda v, c, m, n: Markup(
+            '<a href="%s">stacks</a>' % url_for('.stacks_view', id=m.id)
+        )
+    }
+
+    @expose('/stacks/<id>/')
+    def stacks_view(self, id):
+        """collapsed stacks as text, ready for flamegraph.pl"""
+        profile = CartProfile.objects(id=id).first() or abort(404)
+        return Response(profile.stacks or '', mimetype='text/plain')
+
+
+class PromotionAdmin(ModelAdmin):
+    roles_accepted = ('admin', 'editor')
+    column_list = ('title', 'kind', 'value', 'coupon', 'starts_at',
+                   'ends_at', 'published')
+    column_filters = ('kind', 'coupon', 'published')
+    column_searchable_list = ('title', 'coupon')
+    form_columns = ('title', 'kind', 'value', 'buy', 'get', 'products',
+                    'channels', 'coupon', 'starts_at', 'ends_at',
+                    'published')
+
+
+class PaymentRecordAdmin(ModelAdmin):
+    roles_accepted = ('admin', 'editor')
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('date', 'uid', 'cart_id', 'payment_system', 'method',
+                   'status', 'value', 'fee', 'net_value', 'source')
+    column_filters = ('status', 'payment_system', 'method', 'source',
+                      'date', 'confirmed_at', 'cart_id', 'uid')
+    column_searchable_list = ('uid', 'cart_id', 'reference_code')
+    column_formatters = {
+        'date': ModelAdmin.formatters.get('datetime'),
+    }
+
+
 admin.register(Cart, CartAdmin, category=_("Cart"), name=_l("Cart"))
+admin.register(Cart, ArchivedCartAdmin, category=_("Cart"),
+               name=_l("Archived carts"), endpoint='archivedcart')
 admin.register(Processor, ProcessorAdmin, category=_("Cart"),
                name=_l("Processor"))
+admin.register(CartProfile, CartProfileAdmin, category=_("Cart"),
+               name=_l("Profiles"))
+admin.register(Promotion, PromotionAdmin, category=_("Cart"),
+               name=_l("Promotions"))
+admin.register(PaymentRecord, PaymentRecordAdmin, category=_("Cart"),
+               name=_l("Payment ledger"))
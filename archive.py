@@ -0,0 +1,124 @@
+# coding: utf-8
+
+import datetime
+import logging
+from itertools import chain
+
+from flask import current_app
+from mongoengine.queryset import QuerySet
+from pymongo import ReplaceOne
+
+from .models import Cart
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUS = ('completed', 'refunded', 'cancelled', 'abandoned')
+
+
+def get_archive_collection():
+    name = current_app.config.get('CART_ARCHIVE_COLLECTION', 'cart_archive')
+    return Cart._get_db()[name]
+
+
+def archived_carts(*args, **kwargs):
+    """
+    Cart queryset reading from the archive collection,
+    archived carts are read only, use restore_cart to bring one back
+    """
+    return QuerySet(Cart, get_archive_collection())(*args, **kwargs)
+
+
+def all_carts(page=1, per_page=None, **filters):
+    """
+    a page of the carts matching the filters in both hot and archive
+    tiers ordered by creation date, returns (carts, has_next).
+    Each tier is read with a sorted cursor limited to the carts up to
+    the end of the page
+    """
+    if per_page is None:
+        per_page = current_app.config.get('CART_HISTORY_PER_PAGE', 20)
+    start = (max(page, 1) - 1) * per_page
+    end = start + per_page + 1  # one more to know if there is a next page
+    carts = chain(
+        Cart.objects(**filters).order_by('-created_at').limit(end),
+        archived_carts(**filters).order_by('-created_at').limit(end)
+    )
+    carts = sorted(carts, key=lambda cart: cart.created_at, reverse=True)
+    return carts[start:start + per_page], len(carts) > start + per_page
+
+
+def ensure_archive_indexes(archive):
+    archive.create_index([('belongs_to', 1), ('created_at', -1)])
+    archive.create_index('reference_code')
+    archive.create_index('transaction_code')
+
+
+def archive_carts(days=None, batch_size=None, keep_log=None):
+    """
+    moves carts in terminal status not updated for `days` to the archive
+    collection in batches of `batch_size`.
+    if `keep_log` is given only the last `keep_log` entries of log are kept
+    """
+    config = current_app.config
+    if days is None:
+        days = config.get('CART_ARCHIVE_AFTER_DAYS', 90)
+    if batch_size is None:
+        batch_size = config.get('CART_ARCHIVE_BATCH_SIZE', 1000)
+    if keep_log is None:
+        keep_log = config.get('CART_ARCHIVE_KEEP_LOG')
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    query = {
+        'status': {'$in': TERMINAL_STATUS},
+        'updated_at': {'$lt': cutoff},
+        # order events not yet relayed keep the cart in the hot tier
+        'outbox.id': {'$exists': False}
+    }
+    hot = Cart._get_collection()
+    archive = get_archive_collection()
+    ensure_archive_indexes(archive)
+
+    moved = 0
+    while True:
+        docs = list(hot.find(query).limit(batch_size))
+        if not docs:
+            break
+
+        if keep_log is not None:
+            for doc in docs:
+                doc['log'] = doc.get('log', [])[-keep_log:] if keep_log else []
+
+        ids = [doc['_id'] for doc in docs]
+        archive.bulk_write(
+            [ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+             for doc in docs],
+            ordered=False
+        )
+        deleted = hot.delete_many(dict(query, _id={'$in': ids}))
+
+        if deleted.deleted_count != len(ids):
+            # some carts changed while archiving, they stay in hot tier
+            changed = hot.distinct('_id', {'_id': {'$in': ids}})
+            archive.delete_many({'_id': {'$in': changed}})
+
+        moved += deleted.deleted_count
+        logger.info("%s carts archived", moved)
+
+    return moved
+
+
+def restore_cart(**kwargs):
+    """
+    moves the archived cart matching the filters back to the hot tier
+    restore_cart(id=cart_id) or restore_cart(reference_code=code)
+    """
+    doc = archived_carts(**kwargs).as_pymongo().first()
+    if not doc:
+        return
+
+    # a fresh updated_at keeps it out of the next archive run
+    doc['updated_at'] = datetime.datetime.now()
+    Cart._get_collection().replace_one({'_id': doc['_id']}, doc, upsert=True)
+    get_archive_collection().delete_one({'_id': doc['_id']})
+    logger.info("cart %s restored", doc['_id'])
+    return Cart.objects.get(id=doc['_id'])
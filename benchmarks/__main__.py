@@ -0,0 +1,68 @@
+# coding: utf-8
+"""
+Microbenchmarks for the cart hot paths
+
+    python -m quokka.modules.cart.benchmarks [--save] [--threshold 0.25]
+        [--host mongomock://localhost] [name ...]
+
+Without --save the results are compared with benchmarks/baseline.json
+and the run fails if any hot path is slower than the baseline by more
+than the threshold or does more database round trips. Benchmarks
+without a baseline fail the run too (exit 2) unless --allow-missing.
+"""
+import argparse
+import sys
+
+from werkzeug.datastructures import ImmutableMultiDict
+
+from . import harness
+from .env import create_bench_app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--host', default='mongomock://localhost')
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=10)
+    parser.add_argument('--allow-missing', action='store_true',
+                        help='do not fail for benchmarks without baseline')
+    args = parser.parse_args()
+
+    app = create_bench_app(args.host)
+    with app.test_request_context('/cart/', method='POST',
+                                  data=ImmutableMultiDict()):
+        from . import bench_cart  # noqa registers the benchmarks
+        results = harness.run(args.names, args.repeat, args.number)
+
+    print("{0:<45} {1:>12} {2:>10}".format('benchmark', 'time (ms)',
+                                            'roundtrips'))
+    for name, result in results.items():
+        print("{0:<45} {1:>12.3f} {2:>10}".format(
+            name, result['time'] * 1000, result['roundtrips']))
+
+    if args.save:
+        harness.save_baseline(results)
+        return 0
+
+    baseline = harness.load_baseline()
+    missing = harness.missing(results, baseline)
+    for name in missing:
+        print("NO BASELINE {0}".format(name))
+    if missing and not args.allow_missing:
+        print("{0} benchmarks have no baseline in {1}, run with --save "
+              "on the reference machine and commit it".format(
+                  len(missing), harness.BASELINE_PATH))
+        return 2
+
+    regressions = harness.compare(results, baseline, args.threshold)
+    for name, metric, base, current in regressions:
+        print("REGRESSION {0} {1}: {2} -> {3}".format(
+            name, metric, base, current))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Shows the concurrency gain of async processors, N checkouts against a
+stub gateway with fixed latency are processed one after the other by
+the sync processor and concurrently by the async one (python 3 only).
+
+    python -m quokka.modules.cart.benchmarks.bench_async --carts 50 \
+        --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+from ..processors.aio import run_async
+from ..processors.pagseguro_aio import AsyncPagSeguroProcessor
+from .env import create_bench_app, make_cart
+from .stubs import StubPagSeguro, StubPagSeguroProcessor
+
+
+class AsyncStubPagSeguroProcessor(AsyncPagSeguroProcessor):
+    def __init__(self, cart, *args, **kwargs):
+        self.cart = cart
+        self.config = kwargs.get('config') or {}
+        self._record = kwargs.get('_record')
+        self.pg = StubPagSeguro(**self.config.get('stub', {}))
+
+
+def run(carts, latency):
+    record = carts[0].processor
+    config = {'stub': {'latency': latency}}
+
+    started = time.time()
+    for cart in carts:
+        StubPagSeguroProcessor(cart, config=config, _record=record).process()
+    sync_elapsed = time.time() - started
+
+    async def process_all():
+        return await asyncio.gather(*[
+            AsyncStubPagSeguroProcessor(
+                cart, config=config, _record=record
+            ).process_async()
+            for cart in carts
+        ])
+
+    started = time.time()
+    run_async(process_all())
+    async_elapsed = time.time() - started
+    return sync_elapsed, async_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='mongomock://localhost')
+    parser.add_argument('--carts', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    app = create_bench_app(args.host, CART_ASYNC_GATEWAY_WORKERS=args.carts)
+    with app.test_request_context('/cart/checkout/', method='POST'):
+        carts = [make_cart(3) for _ in range(args.carts)]
+        sync_elapsed, async_elapsed = run(carts, args.latency)
+
+    print("{0} checkouts, gateway latency {1}s".format(args.carts,
+                                                      args.latency))
+    print("sync:  {0:.2f}s".format(sync_elapsed))
+    print("async: {0:.2f}s ({1:.1f}x)".format(
+        async_elapsed, sync_elapsed / async_elapsed))
+
+
+if __name__ == '__main__':
+    main()
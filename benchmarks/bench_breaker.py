@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+Simulates a gateway outage, N checkouts against a stub gateway that is
+slow and failing are processed without and with the circuit breaker,
+with the breaker open calls fail fast instead of waiting on the gateway.
+
+    python -m quokka.modules.cart.benchmarks.bench_breaker --carts 50 \
+        --latency 0.5 --failure-rate 0.8 --budget 0.2
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from ..breaker import GatewayUnavailable, get_breaker_stats
+from .env import create_bench_app, make_cart
+from .stubs import StubError, StubPagSeguroProcessor
+
+
+def run(carts, config):
+    record = carts[0].processor
+    outcomes = {'ok': 0, 'failed': 0, 'unavailable': 0}
+    started = time.time()
+    for cart in carts:
+        processor = StubPagSeguroProcessor(cart, config=config,
+                                           _record=record)
+        try:
+            processor.process()
+            outcomes['ok'] += 1
+        except StubError:
+            outcomes['failed'] += 1
+        except GatewayUnavailable:
+            outcomes['unavailable'] += 1
+    return time.time() - started, outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='mongomock://localhost')
+    parser.add_argument('--carts', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--failure-rate', type=float, default=0.8)
+    parser.add_argument('--budget', type=float, default=0.2)
+    args = parser.parse_args()
+
+    stub = {'latency': args.latency, 'failure_rate': args.failure_rate,
+            'seed': 42}
+    breaker = {'budget': args.budget, 'window': 10, 'min_calls': 5,
+               'failure_rate': 0.5, 'reset_timeout': 60}
+
+    app = create_bench_app(args.host)
+    with app.test_request_context('/cart/checkout/', method='POST'):
+        carts = [make_cart(1) for _ in range(args.carts)]
+        plain = run(carts, {'stub': stub})
+        guarded = run(carts, {'stub': stub, 'circuit_breaker': breaker})
+        stats = get_breaker_stats(carts[0].processor.identifier)
+
+    print("{0} checkouts, gateway latency {1}s, failure rate {2}".format(
+        args.carts, args.latency, args.failure_rate))
+    for label, (elapsed, outcomes) in (('no breaker', plain),
+                                       ('breaker', guarded)):
+        print("{0:<11} {1:.2f}s {2}".format(label, elapsed, outcomes))
+    print("circuit: {0}".format(stats))
+
+
+if __name__ == '__main__':
+    main()
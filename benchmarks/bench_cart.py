@@ -0,0 +1,113 @@
+# coding: utf-8
+from flask import session
+
+from ..models import Cart, Item, Processor
+from ..pipelines import CartPipeline
+from .env import make_cart, make_products
+from .harness import benchmark
+
+SIZES = (1, 10, 100, 1000)
+
+
+class NoopPipeline(CartPipeline):
+    def process(self):
+        return self.go()
+
+
+class LastPipeline(CartPipeline):
+    def process(self):
+        return "done"
+
+
+@benchmark('Item.total', sizes=SIZES)
+def item_total(size):
+    products = make_products(size)
+
+    def run():
+        items = [Item(product=product, quantity=2) for product in products]
+        return sum(item.total for item in items)
+    return run
+
+
+@benchmark('Cart.save', sizes=SIZES)
+def cart_save(size):
+    cart = make_cart(size)
+    return cart.save
+
+
+@benchmark('Cart.set_item', sizes=SIZES)
+def cart_set_item(size):
+    cart = make_cart(size)
+    session['cart_id'] = str(cart.id)
+    uid = cart.items[0].uid
+    quantities = [1, 2]
+
+    def run():
+        quantities.reverse()
+        return cart.set_item(uid=uid, quantity=quantities[0])
+    return run
+
+
+@benchmark('Cart.set_item.add', sizes=SIZES)
+def cart_set_item_add(size):
+    """adds a hot product by id to a cart with `size` items"""
+    cart = make_cart(size)
+    session['cart_id'] = str(cart.id)
+    product_id = str(make_products(1)[0].id)
+
+    def run():
+        cart.set_item(product=product_id, quantity=1)
+        return cart.remove_item(uid=cart.items[-1].uid)
+    return run
+
+
+@benchmark('Cart.build_pipeline', sizes=SIZES)
+def cart_build_pipeline(size):
+    cart = make_cart(size)
+    for item in cart.items:
+        item.pipeline = [
+            'quokka.modules.cart.benchmarks.bench_cart:NoopPipeline'
+        ]
+    return cart.build_pipeline
+
+
+@benchmark('CartPipeline._preprocess', sizes=(1, 10, 50))
+def pipeline_preprocess(steps):
+    cart = make_cart(1)
+    pipeline = ['quokka.modules.cart.benchmarks.bench_cart:NoopPipeline'] * \
+        steps + ['quokka.modules.cart.benchmarks.bench_cart:LastPipeline']
+
+    def run():
+        return NoopPipeline(cart, pipeline, 0)._preprocess()
+    return run
+
+
+@benchmark('Processor.get_instance')
+def processor_get_instance(size):
+    cart = make_cart(size)
+    processor = Processor.get_default_processor()
+    return lambda: processor.get_instance(cart)
+
+
+@benchmark('PagSeguroProcessor.validate', sizes=SIZES)
+def pagseguro_validate(size):
+    cart = make_cart(size)
+    return cart.processor.get_instance(cart).validate
+
+
+@benchmark('PagSeguroProcessor.notification', sizes=(1, 100))
+def pagseguro_notification(size):
+    from flask import request
+    cart = make_cart(size)
+    cart.status = 'checked_out'
+    cart.save()
+    processor = Processor.get_default_processor().get_instance(None)
+    request.form = {'notificationCode': cart.reference_code}
+    return processor.notification
+
+
+@benchmark('Cart.get_cart', sizes=SIZES)
+def cart_get_cart(size):
+    cart = make_cart(size)
+    session['cart_id'] = str(cart.id)
+    return Cart.get_cart
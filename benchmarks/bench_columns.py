@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Compares the per item python loops previously used by Cart.save,
+PagSeguroProcessor.validate and cart.html with the columnar view.
+
+    python -m quokka.modules.cart.benchmarks.bench_columns
+"""
+import random
+import timeit
+
+from ..columns import ItemColumns
+
+SIZES = (10, 100, 1000, 10000)
+
+
+class Line(object):
+    """plain stand-in for an already cleaned Item"""
+    def __init__(self, rand):
+        self.unity_value = round(rand.uniform(1, 500), 2)
+        self.extra_value = rand.choice(
+            [None, 0, round(rand.uniform(0, 20), 2)])
+        self.quantity = float(rand.randint(1, 50))
+        self.weight = round(rand.uniform(0.1, 30), 3)
+
+    @property
+    def unity_plus_extra(self):
+        return float(self.unity_value or 0) + float(self.extra_value or 0)
+
+    @property
+    def total(self):
+        return self.unity_plus_extra * float(self.quantity or 1)
+
+
+def make_lines(size, seed=42):
+    rand = random.Random(seed)
+    return [Line(rand) for _ in range(size)]
+
+
+def loop_passes(lines):
+    # Cart.save
+    total = sum([line.total for line in lines])
+    # PagSeguroProcessor.validate
+    amounts = ["%.2f" % line.unity_plus_extra
+               for line in lines if line.total >= 0]
+    # cart.html
+    rows = [line.total for line in lines]
+    extra = sum(float(line.extra_value or 0) for line in lines)
+    quantity = sum(line.quantity for line in lines)
+    return total, amounts, rows, extra, quantity
+
+
+def columnar_passes(lines):
+    columns = ItemColumns(lines)
+    amounts = ["%.2f" % value for value, line_total
+               in zip(columns.unity_plus_extra, columns.line_totals)
+               if line_total >= 0]
+    return (columns.total, amounts, columns.line_totals,
+            columns.total_extra, columns.total_quantity)
+
+
+def run(sizes=SIZES, repeat=5):
+    for size in sizes:
+        lines = make_lines(size)
+        loop = min(timeit.repeat(lambda: loop_passes(lines),
+                                 number=1, repeat=repeat))
+        columnar = min(timeit.repeat(lambda: columnar_passes(lines),
+                                     number=1, repeat=repeat))
+        yield size, loop, columnar
+
+
+if __name__ == '__main__':
+    print("{0:>8} {1:>12} {2:>12} {3:>8}".format(
+        'lines', 'loop (ms)', 'columns (ms)', 'speedup'))
+    for size, loop, columnar in run():
+        print("{0:>8} {1:>12.3f} {2:>12.3f} {3:>7.2f}x".format(
+            size, loop * 1000, columnar * 1000, loop / columnar))
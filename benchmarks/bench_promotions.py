@@ -0,0 +1,118 @@
+# coding: utf-8
+"""
+Evaluates a cart against N active promotion rules, scanning every rule
+for every item (as a pipeline step reloading the rules would) and with
+the compiled PromotionIndex.
+
+    python -m quokka.modules.cart.benchmarks.bench_promotions \
+        --rules 10000 --items 20
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import random
+import time
+
+from ..promotions import CompiledRule, PromotionIndex
+
+KINDS = ('percentage', 'fixed', 'buy_x_get_y')
+
+
+def make_rules(count, products, channels, seed=42):
+    rand = random.Random(seed)
+    rules = []
+    for index in range(count):
+        kind = rand.choice(KINDS)
+        rule = CompiledRule(
+            str(index), "Rule %s" % index, kind,
+            value=rand.choice([5, 10, 15]) if kind != 'fixed' else 2,
+            buy=2, get=1,
+            coupon="COUPON%s" % index if rand.random() < 0.05 else None
+        )
+        target = rand.random()
+        if target < 0.7:
+            uids = ["product-%s" % rand.randrange(products)
+                    for _ in range(rand.randint(1, 3))]
+            rules.append((rule, uids, []))
+        elif target < 0.98 or kind == 'buy_x_get_y':
+            rules.append((rule, [], ["channel-%s" % rand.randrange(
+                channels)]))
+        else:
+            rules.append((rule, [], []))
+    return rules
+
+
+def make_lines(count, products, channels, seed=7):
+    rand = random.Random(seed)
+    return [
+        ("product-%s" % rand.randrange(products),
+         "channel-%s" % rand.randrange(channels),
+         round(rand.uniform(5, 500), 2), float(rand.randint(1, 5)))
+        for _ in range(count)
+    ]
+
+
+def evaluate_scan(rules, lines, coupons, now):
+    discounts = []
+    subtotal = 0.0
+    for uid, channel_id, unity_value, quantity in lines:
+        best = 0.0
+        for rule, uids, channel_ids in rules:
+            if uid in uids or channel_id in channel_ids:
+                if rule.is_active(now, coupons):
+                    best = max(best, rule.get_discount(unity_value, quantity))
+        best = min(best, unity_value * quantity)
+        discounts.append(best)
+        subtotal += unity_value * quantity - best
+    cart_discount = 0.0
+    for rule, uids, channel_ids in rules:
+        if not uids and not channel_ids and rule.is_active(now, coupons):
+            cart_discount = max(cart_discount,
+                                rule.get_cart_discount(subtotal))
+    return discounts, min(cart_discount, subtotal)
+
+
+def timeit(func, number):
+    started = time.time()
+    for _ in range(number):
+        result = func()
+    return (time.time() - started) / number * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=20)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    rules = make_rules(args.rules, args.products, args.channels)
+    lines = make_lines(args.items, args.products, args.channels)
+    coupons = set(["COUPON1", "COUPON2"])
+    now = datetime.datetime.now()
+
+    started = time.time()
+    index = PromotionIndex()
+    for rule, uids, channel_ids in rules:
+        index.add(rule, uids, channel_ids)
+    compile_ms = (time.time() - started) * 1000
+
+    scan_ms, expected = timeit(
+        lambda: evaluate_scan(rules, lines, coupons, now), args.number)
+    index_ms, result = timeit(
+        lambda: index.evaluate(lines, coupons, now), args.number)
+    assert result == expected, "index and scan disagree"
+
+    print("{0} rules, {1} items".format(args.rules, args.items))
+    print("compile: {0:.2f}ms (once per registry version)".format(
+        compile_ms))
+    print("scan:    {0:.3f}ms per cart".format(scan_ms))
+    print("index:   {0:.3f}ms per cart ({1:.0f}x)".format(
+        index_ms, scan_ms / index_ms))
+
+
+if __name__ == '__main__':
+    main()
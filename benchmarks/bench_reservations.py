@@ -0,0 +1,172 @@
+# coding: utf-8
+"""
+Load test for the atomic stock counters, hundreds of concurrent buyers
+compete for the same product, the stock must never go below zero and
+exactly `stock` units must be sold.
+
+--reservations drives Reservation.reserve (the set_item path) instead:
+buyers reserve the product for their own carts while others keep
+changing the quantity reserved by one shared cart, at the end the stock
+taken must equal the sum of the reservations.
+
+    python -m quokka.modules.cart.benchmarks.bench_reservations \
+        --host mongodb://localhost:27017 --buyers 500 --stock 100 \
+        [--reservations]
+"""
+import argparse
+import random
+import threading
+import time
+
+from pymongo import MongoClient
+
+from ..stock import take_stock, give_back_stock
+
+
+def run(collection, buyers, stock, quantity=1):
+    product_id = collection.insert_one({'stock': stock}).inserted_id
+    sold = []
+    latencies = []
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def buyer():
+        start_event.wait()
+        started = time.time()
+        taken = take_stock(collection, product_id, quantity)
+        elapsed = time.time() - started
+        with lock:
+            latencies.append(elapsed)
+            if taken:
+                sold.append(quantity)
+
+    threads = [threading.Thread(target=buyer) for _ in range(buyers)]
+    for thread in threads:
+        thread.start()
+    started = time.time()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    remaining = collection.find_one({'_id': product_id})['stock']
+    expected = min(stock // quantity, buyers) * quantity
+    assert remaining >= 0, "stock went negative: %s" % remaining
+    assert sum(sold) == expected, "sold %s expected %s" % (sum(sold),
+                                                          expected)
+    assert remaining == stock - expected
+
+    # releasing gives everything back
+    give_back_stock(collection, {product_id: sum(sold)})
+    assert collection.find_one({'_id': product_id})['stock'] == stock
+    collection.delete_one({'_id': product_id})
+
+    latencies.sort()
+    return {
+        'buyers': buyers,
+        'sold': sum(sold),
+        'elapsed': elapsed,
+        'throughput': buyers / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+def run_reservations(app, buyers, stock, changes=20):
+    from ..models import Cart, Reservation
+    from .env import make_products
+
+    with app.app_context():
+        product = make_products(1, stock=stock)[0]
+        carts = Cart._get_collection()
+        shared = carts.insert_one({'status': 'pending'}).inserted_id
+        own = [carts.insert_one({'status': 'pending'}).inserted_id
+               for _ in range(buyers)]
+
+    sold = []
+    latencies = []
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def reserve(cart_id, quantity):
+        started = time.time()
+        with app.app_context():
+            cart = Cart.objects.only('id').get(id=cart_id)
+            taken = Reservation.reserve(cart, product, quantity)
+        with lock:
+            latencies.append(time.time() - started)
+        return taken
+
+    def buyer(cart_id):
+        start_event.wait()
+        if reserve(cart_id, 1):
+            with lock:
+                sold.append(1)
+
+    def changer(seed):
+        rand = random.Random(seed)
+        start_event.wait()
+        for _ in range(changes):
+            reserve(shared, rand.randint(0, 5))
+
+    threads = [threading.Thread(target=buyer, args=(cart_id,))
+               for cart_id in own]
+    threads.extend(threading.Thread(target=changer, args=(seed,))
+                   for seed in range(10))
+    for thread in threads:
+        thread.start()
+    started = time.time()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    with app.app_context():
+        remaining = product.__class__.objects.get(id=product.pk).stock
+        reserved = sum(reservation.quantity for reservation in
+                       Reservation.objects(product=product.pk))
+        assert remaining >= 0, "stock went negative: %s" % remaining
+        assert stock - remaining == reserved, \
+            "%s taken but %s reserved" % (stock - remaining, reserved)
+        Reservation.release(product=product.pk)
+        assert product.__class__.objects.get(id=product.pk).stock == stock
+        carts.delete_many({'_id': {'$in': own + [shared]}})
+        product.delete()
+
+    latencies.sort()
+    return {
+        'buyers': buyers,
+        'sold': sum(sold),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='cart_benchmarks')
+    parser.add_argument('--buyers', type=int, default=500)
+    parser.add_argument('--stock', type=int, default=100)
+    parser.add_argument('--reservations', action='store_true')
+    args = parser.parse_args()
+
+    if args.reservations:
+        from .env import create_bench_app
+        app = create_bench_app(args.host, args.db)
+        result = run_reservations(app, args.buyers, args.stock)
+    else:
+        collection = MongoClient(args.host, maxPoolSize=args.buyers)[
+            args.db]['stock_bench']
+        result = run(collection, args.buyers, args.stock)
+    print(
+        "{buyers} buyers, {sold} sold in {elapsed:.3f}s "
+        "({throughput:.0f} ops/s) p50 {p50:.4f}s p99 {p99:.4f}s".format(
+            **result)
+    )
+
+
+if __name__ == '__main__':
+    main()
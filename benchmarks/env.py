@@ -0,0 +1,59 @@
+# coding: utf-8
+import uuid
+
+STUB_PROCESSOR = {
+    'module': 'quokka.modules.cart.benchmarks.stubs.StubPagSeguroProcessor',
+    'identifier': 'stub',
+    'published': True,
+    'title': "Stub gateway"
+}
+
+
+def create_bench_app(host='mongomock://localhost', db='cart_benchmarks',
+                     **settings):
+    """
+    quokka app connected to a local stand-in database (mongomock or a
+    local mongod) with the stub gateway as default processor
+    """
+    from quokka import create_app
+    mongodb_settings = {'DB': db, 'host': host}
+    if not host.startswith('mongomock'):
+        from ..instrumentation import command_counter
+        mongodb_settings['event_listeners'] = [command_counter]
+    settings.setdefault('MONGODB_SETTINGS', mongodb_settings)
+    settings.setdefault('CART_DEFAULT_PROCESSOR', STUB_PROCESSOR)
+    settings.setdefault('WTF_CSRF_ENABLED', False)
+    return create_app(test=True, **settings)
+
+
+def get_channel():
+    from quokka.core.models.channel import Channel
+    return Channel.objects.first() or Channel.objects.create(
+        title="Benchmarks", slug="benchmarks", long_slug="benchmarks",
+        published=True
+    )
+
+
+def make_products(size, unity_value=10.0, stock=None):
+    from ..models import BaseProduct
+    channel = get_channel()
+    products = []
+    for index in range(size):
+        slug = "product-%s" % uuid.uuid4().hex
+        products.append(BaseProduct.objects.create(
+            title="Product %s" % index, slug=slug, channel=channel,
+            description="<p>Description of product %s</p>" % index,
+            unity_value=unity_value + index, weight=0.5, dimensions="10x10x10",
+            extra_value=1.0, stock=stock, published=True
+        ))
+    return products
+
+
+def make_cart(size, products=None):
+    from ..models import Cart
+    products = products or make_products(size)
+    cart = Cart(status='pending', requires_login=False)
+    for product in products[:size]:
+        cart.items.create(product=product, quantity=2)
+    cart.save()
+    return cart
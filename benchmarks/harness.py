@@ -0,0 +1,143 @@
+# coding: utf-8
+import json
+import os
+import time
+from collections import OrderedDict
+
+from pymongo import monitoring
+
+BENCHMARKS = OrderedDict()
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+MONGOMOCK_METHODS = (
+    'find', 'find_one', 'insert', 'insert_one', 'insert_many', 'update',
+    'update_one', 'update_many', 'replace_one', 'save', 'remove',
+    'delete_one', 'delete_many', 'aggregate', 'count', 'count_documents',
+    'bulk_write', 'find_one_and_update', 'find_and_modify', 'distinct'
+)
+
+
+def benchmark(name, sizes=(1,)):
+    """
+    registers a benchmark, the decorated function receives the size
+    and returns the callable to be timed, setup is not measured
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, sizes)
+        return setup
+    return decorator
+
+
+class RoundTrips(monitoring.CommandListener):
+    """
+    counts database round trips, real servers are counted through
+    pymongo command monitoring, mongomock collections are patched
+    """
+    count = 0
+    active = False
+
+    def started(self, event):
+        if self.active:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def patch_mongomock(self):
+        try:
+            from mongomock.collection import Collection
+        except ImportError:
+            return
+
+        def counted(method):
+            def wrapper(*args, **kwargs):
+                if self.active:
+                    self.count += 1
+                return method(*args, **kwargs)
+            return wrapper
+
+        for name in MONGOMOCK_METHODS:
+            if hasattr(Collection, name):
+                setattr(Collection, name, counted(getattr(Collection, name)))
+
+    def __enter__(self):
+        self.count = 0
+        self.active = True
+        return self
+
+    def __exit__(self, *args):
+        self.active = False
+
+
+roundtrips = RoundTrips()
+monitoring.register(roundtrips)
+roundtrips.patch_mongomock()
+
+
+def measure(func, repeat=5, number=10):
+    func()  # warm up caches and lazy imports
+    with roundtrips:
+        func()
+    trips = roundtrips.count
+
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        for _ in range(number):
+            func()
+        timings.append((time.time() - started) / number)
+    timings.sort()
+    return {'time': timings[len(timings) // 2], 'roundtrips': trips}
+
+
+def run(names=None, repeat=5, number=10):
+    results = OrderedDict()
+    for name, (setup, sizes) in BENCHMARKS.items():
+        if names and not any(part in name for part in names):
+            continue
+        for size in sizes:
+            results["%s[%s]" % (name, size)] = measure(
+                setup(size), repeat, number
+            )
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w') as output:
+        json.dump(baseline, output, indent=2, sort_keys=True)
+
+
+def missing(results, baseline):
+    """benchmarks without a baseline, they can not be compared"""
+    return [key for key in results if not baseline.get(key)]
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    returns the regressions, a benchmark regresses when it is slower than
+    the baseline by more than `threshold` or does more round trips
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result['time'] > base['time'] * (1 + threshold):
+            regressions.append((key, 'time', base['time'], result['time']))
+        if result['roundtrips'] > base['roundtrips']:
+            regressions.append((key, 'roundtrips',
+                                base['roundtrips'], result['roundtrips']))
+    return regressions
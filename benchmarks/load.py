@@ -0,0 +1,250 @@
+# coding: utf-8
+"""
+Concurrent load harness driving the cart blueprint routes
+
+Simulates shoppers browsing, adding items, changing quantities,
+checking out and receiving gateway callbacks against the stub gateway.
+
+    python -m quokka.modules.cart.benchmarks.load --shoppers 50 \
+        --duration 30 --processes 2 --host mongodb://localhost
+
+Reports throughput, p50/p95/p99 latency per action, write conflicts
+(lost updates seen by a verification read and server errors) and
+the growth of the cart documents.
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from bson import BSON, ObjectId
+
+from .env import create_bench_app, make_products, STUB_PROCESSOR
+
+MIX = (
+    ('browse', 40),
+    ('add', 25),
+    ('quantity', 15),
+    ('checkout', 10),
+    ('notification', 10),
+)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class Shopper(object):
+
+    def __init__(self, app, products, rand, stats):
+        from quokka.modules.accounts.models import User
+        self.app = app
+        self.products = products
+        self.rand = rand
+        self.stats = stats
+        self.client = app.test_client()
+        self.quantities = {}
+        self.carts = set()
+        self.references = []
+        user = User.objects.create(
+            name="Shopper %s" % rand.randint(0, 10 ** 6),
+            email="%s@shoppers.local" % uuid.uuid4().hex,
+            password=uuid.uuid4().hex, active=True
+        )
+        with self.client.session_transaction() as session:
+            # flask-login keys for old and new versions
+            session['user_id'] = session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def get_cart_id(self):
+        with self.client.session_transaction() as session:
+            return session.get('cart_id')
+
+    def request(self, action, method, url, **kwargs):
+        started = time.time()
+        response = getattr(self.client, method)(url, **kwargs)
+        self.stats['latency'][action].append(time.time() - started)
+        if response.status_code >= 500:
+            self.stats['errors'] += 1
+        cart_id = self.get_cart_id()
+        cart_id and self.carts.add(cart_id)
+        return response
+
+    def browse(self):
+        self.request('browse', 'get', '/cart/')
+
+    def add(self):
+        product = self.rand.choice(self.products)
+        quantity = self.rand.randint(1, 3)
+        self.request('add', 'post', '/cart/setitem/',
+                     data={'product': str(product.id), 'quantity': quantity})
+        self.quantities[str(product.id)] = quantity
+        self.verify()
+
+    def quantity(self):
+        if not self.quantities:
+            return self.add()
+        uid = self.rand.choice(list(self.quantities))
+        quantity = self.rand.randint(1, 5)
+        self.request('quantity', 'post', '/cart/setitem/',
+                     data={'uid': uid, 'quantity': quantity})
+        self.quantities[uid] = quantity
+        self.verify()
+
+    def checkout(self):
+        if not self.quantities:
+            return self.add()
+        cart_id = self.get_cart_id()
+        self.request('checkout', 'post', '/cart/checkout/')
+        self.references.append(cart_id)
+        self.quantities = {}
+
+    def notification(self):
+        if not self.references:
+            return self.browse()
+        self.request('notification', 'post',
+                     '/cart/notification/%s/' % STUB_PROCESSOR['identifier'],
+                     data={'notificationCode': self.rand.choice(
+                         self.references)})
+
+    def verify(self):
+        """a write is lost when the stored cart differs from what was set"""
+        from ..models import Cart
+        cart_id = self.get_cart_id()
+        if not cart_id:
+            return
+        doc = Cart._get_collection().find_one({'_id': ObjectId(cart_id)},
+                                              {'items': 1})
+        stored = dict((item.get('uid'), item.get('quantity'))
+                      for item in (doc or {}).get('items', []))
+        for uid, quantity in self.quantities.items():
+            if stored.get(uid) != quantity:
+                self.stats['conflicts'] += 1
+
+    def step(self):
+        getattr(self, self.weighted(MIX))()
+        self.stats['requests'] += 1
+
+    def weighted(self, mix):
+        point = self.rand.uniform(0, sum(weight for _, weight in mix))
+        for action, weight in mix:
+            point -= weight
+            if point <= 0:
+                return action
+        return mix[-1][0]
+
+
+def document_sizes(cart_ids):
+    from ..models import Cart
+    collection = Cart._get_collection()
+    return [
+        len(BSON.encode(doc))
+        for doc in collection.find(
+            {'_id': {'$in': [ObjectId(cart_id) for cart_id in cart_ids]}}
+        )
+    ]
+
+
+def run_process(options):
+    host, shoppers, duration, seed, products_count = options
+    app = create_bench_app(host)
+    stats = {'latency': defaultdict(list), 'requests': 0,
+             'errors': 0, 'conflicts': 0}
+    lock = threading.Lock()
+    carts = set()
+
+    with app.test_request_context():
+        products = make_products(products_count)
+
+    def shopper_loop(index):
+        local = {'latency': defaultdict(list), 'requests': 0,
+                 'errors': 0, 'conflicts': 0}
+        with app.app_context():
+            shopper = Shopper(app, products,
+                              random.Random(seed * 1000 + index), local)
+            deadline = time.time() + duration
+            while time.time() < deadline:
+                shopper.step()
+        with lock:
+            for action, values in local['latency'].items():
+                stats['latency'][action].extend(values)
+            for key in ('requests', 'errors', 'conflicts'):
+                stats[key] += local[key]
+            carts.update(shopper.carts)
+
+    threads = [threading.Thread(target=shopper_loop, args=(index,))
+               for index in range(shoppers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        stats['sizes'] = document_sizes(carts)
+    stats['latency'] = dict(stats['latency'])
+    return stats
+
+
+def merge(results):
+    merged = {'latency': defaultdict(list), 'requests': 0, 'errors': 0,
+              'conflicts': 0, 'sizes': []}
+    for result in results:
+        for action, values in result['latency'].items():
+            merged['latency'][action].extend(values)
+        for key in ('requests', 'errors', 'conflicts'):
+            merged[key] += result[key]
+        merged['sizes'].extend(result['sizes'])
+    return merged
+
+
+def report(stats, elapsed):
+    print("requests: {0} in {1:.1f}s ({2:.1f} req/s)".format(
+        stats['requests'], elapsed, stats['requests'] / elapsed))
+    print("server errors: {0} write conflicts: {1}".format(
+        stats['errors'], stats['conflicts']))
+    print("{0:<14} {1:>8} {2:>10} {3:>10} {4:>10}".format(
+        'action', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for action, values in sorted(stats['latency'].items()):
+        print("{0:<14} {1:>8} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(
+            action, len(values),
+            percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000))
+    sizes = stats['sizes']
+    if sizes:
+        print("cart documents: {0} avg {1:.0f} bytes max {2} bytes".format(
+            len(sizes), sum(sizes) / float(len(sizes)), max(sizes)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='mongomock://localhost')
+    parser.add_argument('--shoppers', type=int, default=20,
+                        help="threads per process")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    options = [(args.host, args.shoppers, args.duration,
+                args.seed + index, args.products)
+               for index in range(args.processes)]
+    started = time.time()
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        results = pool.map(run_process, options)
+        pool.close()
+    else:
+        results = [run_process(options[0])]
+    report(merge(results), time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+Local stand-ins for the payment gateway, the stub answers like the
+pagseguro lib without any network access and can inject latency
+and failures.
+"""
+import random
+import time
+import uuid
+
+from ..processors.pagseguro_processor import PagSeguroProcessor
+
+
+class StubError(Exception):
+    pass
+
+
+class StubResponse(object):
+    def __init__(self, **kwargs):
+        self.errors = []
+        self.xml = ''
+        self.__dict__.update(kwargs)
+
+
+class StubPagSeguro(object):
+    """
+    latency: seconds each gateway call takes
+    failure_rate: 0..1 probability of raising StubError
+    notification and transaction codes are the cart reference
+    """
+
+    def __init__(self, email=None, token=None, latency=0, failure_rate=0,
+                 status="3", fee_amount="1.99", seed=None, **kwargs):
+        self.config = {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.status = status
+        self.fee_amount = fee_amount
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.sender = self.shipping = self.reference = None
+        self.items = []
+        self.extra_amount = None
+        self.redirect_url = self.notification_url = None
+
+    @property
+    def data(self):
+        return {'reference': self.reference, 'items': self.items}
+
+    def call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise StubError("injected gateway failure")
+
+    def checkout(self, **kwargs):
+        self.call()
+        code = uuid.uuid4().hex.upper()
+        return StubResponse(
+            code=code,
+            payment_url="https://gateway.local/checkout?code=%s" % code
+        )
+
+    def check_notification(self, code):
+        self.call()
+        return StubResponse(reference=code, code=uuid.uuid4().hex.upper(),
+                            status=self.status, feeAmount=self.fee_amount)
+
+    def check_transaction(self, code):
+        return self.check_notification(code)
+
+
+class StubPagSeguroProcessor(PagSeguroProcessor):
+    """
+    PagSeguroProcessor talking to StubPagSeguro,
+    Processor.config['stub'] is passed to the stub gateway
+    """
+
+    def __init__(self, cart, *args, **kwargs):
+        self.cart = cart
+        self.config = kwargs.get('config') or {}
+        self._record = kwargs.get('_record')
+        self.pg = StubPagSeguro(**self.config.get('stub', {}))
@@ -0,0 +1,115 @@
+# coding: utf-8
+"""
+Local stand-in for a downstream system receiving the order event
+webhook (events.WebhookSink), it records the events and can inject
+latency and 429/503 answers to exercise the dispatcher backpressure.
+
+    python -m quokka.modules.cart.benchmarks.webhook_stub --port 8099 \
+        --throttle-rate 0.2
+
+    CART_EVENT_SINKS = {'stub': {
+        'class': 'quokka.modules.cart.events.WebhookSink',
+        'url': 'http://localhost:8099/events'}}
+
+Prints the events received per second and checks that the events of
+every cart arrive in seq order (duplicates are allowed, at least once).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class EventLog(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.batches = 0
+        self.throttled = 0
+        self.last_seq = {}
+        self.out_of_order = 0
+
+    def add(self, events):
+        with self.lock:
+            self.batches += 1
+            for event in events:
+                self.received += 1
+                last = self.last_seq.get(event['cart_id'], 0)
+                if event['seq'] < last:
+                    self.out_of_order += 1
+                self.last_seq[event['cart_id']] = max(last, event['seq'])
+
+
+def make_handler(log, latency=0, throttle_rate=0, seed=None):
+    rand = random.Random(seed)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if latency:
+                time.sleep(latency)
+            if throttle_rate and rand.random() < throttle_rate:
+                with log.lock:
+                    log.throttled += 1
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.end_headers()
+                return
+            log.add(json.loads(body.decode('utf-8'))['events'])
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8099, latency=0, throttle_rate=0, seed=None):
+    """starts the stub in a daemon thread, returns (server, log)"""
+    log = EventLog()
+    server = HTTPServer(('127.0.0.1', port),
+                        make_handler(log, latency, throttle_rate, seed))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, log
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    server, log = serve(args.port, args.latency, args.throttle_rate,
+                        args.seed)
+    print("listening on http://127.0.0.1:{0}/events".format(args.port))
+    received = 0
+    try:
+        while True:
+            time.sleep(1)
+            print("{0} events/s, {1} total, {2} batches, {3} throttled, "
+                  "{4} out of order".format(
+                      log.received - received, log.received, log.batches,
+                      log.throttled, log.out_of_order))
+            received = log.received
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
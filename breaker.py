@@ -0,0 +1,244 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayUnavailable(Exception):
+    pass
+
+
+class CircuitOpen(GatewayUnavailable):
+    pass
+
+
+class BudgetExceeded(GatewayUnavailable):
+    """
+    late is the PendingCall still running in background (None when it
+    was cancelled before starting), callers may reconcile its result
+    """
+
+    def __init__(self, message, late=None):
+        super(BudgetExceeded, self).__init__(message)
+        self.late = late
+
+
+class PendingCall(object):
+    """a call submitted to a GatewayPool"""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """prevents a call still in the queue from running"""
+        with self.lock:
+            if not self.started:
+                self.cancelled = True
+            return self.cancelled
+
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        with self.lock:
+            self.done.set()
+            callbacks = self.callbacks
+        for callback in callbacks:
+            self.notify(callback)
+
+    def add_done_callback(self, callback):
+        """callback(call) runs in the worker once the call finishes"""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        self.notify(callback)
+
+    def notify(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logger.error("Late gateway call callback failed: %s" % e)
+
+
+class GatewayPool(object):
+    """
+    a fixed number of worker threads shared by the calls of a breaker,
+    calls over budget keep a worker busy until the gateway answers but
+    never start new threads, when every worker is stuck the next calls
+    wait in the queue, exceed their budget and open the circuit
+    """
+
+    def __init__(self, workers):
+        self.queue = Queue()
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            call = self.queue.get()
+            if call is None:
+                return
+            call.run()
+
+    def submit(self, func, *args, **kwargs):
+        call = PendingCall(func, args, kwargs)
+        self.queue.put(call)
+        return call
+
+    def shutdown(self):
+        """workers exit once their current call is done"""
+        for _ in self.workers:
+            self.queue.put(None)
+
+
+def run_with_budget(pool, budget, func, *args, **kwargs):
+    """
+    runs func in the pool and gives up waiting after `budget` seconds,
+    a call still queued is cancelled, a running one finishes in background
+    """
+    call = pool.submit(func, *args, **kwargs)
+    if not call.done.wait(budget):
+        raise BudgetExceeded("gateway call took more than %ss" % budget,
+                             None if call.cancel() else call)
+    if call.error is not None:
+        raise call.error
+    return call.value
+
+
+class CircuitBreaker(object):
+    """
+    Opens when the failure rate of the last `window` calls reaches
+    `failure_rate` (after at least `min_calls`), while open every call
+    fails fast, after `reset_timeout` seconds a single probe call is let
+    through (half open) and its result closes or opens the circuit again.
+    `budget` is the max seconds a single call may take, calls with a
+    budget run in a pool of `workers` threads of the breaker.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_rate=0.5, window=20, min_calls=5,
+                 reset_timeout=30, budget=None, workers=10):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.budget = budget
+        self.pool = GatewayPool(workers) if budget else None
+        self.results = deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+
+    def record(self, success):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+                if success:
+                    self.state = self.CLOSED
+                    self.results.clear()
+                else:
+                    self.open()
+                return
+
+            self.results.append(success)
+            calls = len(self.results)
+            failures = calls - sum(self.results)
+            if calls >= self.min_calls and \
+                    float(failures) / calls >= self.failure_rate:
+                self.open()
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpen("%s circuit is open" % self.name)
+        try:
+            if self.budget:
+                result = run_with_budget(self.pool, self.budget, func,
+                                         *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        return result
+
+    def get_stats(self):
+        calls = len(self.results)
+        return {
+            'state': self.state,
+            'calls': calls,
+            'failures': calls - sum(self.results),
+            'opened_at': self.opened_at
+        }
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_breaker(name, config):
+    """
+    breakers live in process memory, one per processor identifier,
+    they are recreated when the config changes
+    """
+    breaker, current = _breakers.get(name, (None, None))
+    if breaker is None or current != config:
+        with _lock:
+            # another thread may have replaced it meanwhile
+            breaker, current = _breakers.get(name, (None, None))
+            if breaker is None or current != config:
+                if breaker is not None and breaker.pool is not None:
+                    breaker.pool.shutdown()
+                breaker = CircuitBreaker(name, **config)
+                _breakers[name] = (breaker, dict(config))
+    return breaker
+
+
+def get_breaker_stats(name):
+    breaker, config = _breakers.get(name, (None, None))
+    return breaker and breaker.get_stats()
@@ -0,0 +1,115 @@
+# coding: utf-8
+"""
+Fragment cache for the cart templates
+
+The backend is pluggable, CART_CACHE_BACKEND is the import path of a
+BaseCache subclass, the default is an in memory LRU per process. Keys
+are built from whatever identifies the rendered content (cart revision,
+registry versions...) so entries are never invalidated, they just stop
+being used and are evicted.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+from werkzeug.utils import import_string
+
+
+class BaseCache(object):
+
+    def __init__(self, size=None, timeout=None, **config):
+        self.size = size
+        self.timeout = timeout
+        self.config = config
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+
+class MemoryCache(BaseCache):
+    """LRU bounded by size, timeout is in seconds (None never expires)"""
+
+    def __init__(self, size=None, timeout=None, **config):
+        super(MemoryCache, self).__init__(size or 1000, timeout, **config)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return None
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.timeout
+        expires = time.time() + timeout if timeout else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_cache():
+    cache = current_app.extensions.get('cart_cache')
+    if cache is None:
+        config = current_app.config
+        backend = import_string(config.get(
+            'CART_CACHE_BACKEND', 'quokka.modules.cart.cache.MemoryCache'
+        ))
+        cache = current_app.extensions.setdefault('cart_cache', backend(
+            size=config.get('CART_CACHE_SIZE', 1000),
+            timeout=config.get('CART_CACHE_TIMEOUT', 3600),
+            **config.get('CART_CACHE_CONFIG', {})
+        ))
+    return cache
+
+
+def make_key(*parts):
+    key = u"|".join(u"%s" % (part,) for part in parts)
+    return "cart:" + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cached_fragment(*parts, **kwargs):
+    """
+    template global, renders the block once per key:
+
+        {% call cached_fragment('cart-items', cart.get_revision()) %}
+            ...
+        {% endcall %}
+    """
+    caller = kwargs.pop('caller')
+    if not current_app.config.get('CART_FRAGMENT_CACHE', True):
+        return caller()
+    cache = get_cache()
+    key = make_key('fragment', *parts)
+    value = cache.get(key)
+    if value is None:
+        value = caller()
+        cache.set(key, u"%s" % value, kwargs.get('timeout'))
+    return Markup(value)
@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+Columnar view of the cart items values
+
+The values of every item (unity, extra, quantity and weight) are copied
+once into contiguous arrays so totals, weight sums and per line amounts
+are computed in a single pass. numpy is used when available, otherwise
+the stdlib array module is used.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def columns(rows, size, width):
+    if numpy is not None:
+        if not size:
+            return [numpy.zeros(0)] * width
+        return numpy.array(rows, dtype=float).T
+    if not size:
+        return [array('d')] * width
+    return [array('d', values) for values in zip(*rows)]
+
+
+def add(a, b):
+    if numpy is not None:
+        return a + b
+    return array('d', [x + y for x, y in zip(a, b)])
+
+
+def multiply(a, b):
+    if numpy is not None:
+        return a * b
+    return array('d', [x * y for x, y in zip(a, b)])
+
+
+def total(a):
+    return float(a.sum()) if numpy is not None else sum(a)
+
+
+def item_rows(items):
+    """values of the items the columns are built from"""
+    return [
+        (float(item.unity_value or 0), float(item.extra_value or 0),
+         float(item.quantity or 1), float(item.weight or 0))
+        for item in items
+    ]
+
+
+class ItemColumns(object):
+
+    def __init__(self, items, changes=0):
+        self.size = size = len(items)
+        # identify the items list and its in place changes, see is_stale
+        self.items_id = id(items)
+        self.changes = changes
+        rows = item_rows(items)
+        (self.unity_value, self.extra_value,
+         self.quantity, self.weight) = columns(rows, size, 4)
+
+        self.unity_plus_extra = add(self.unity_value, self.extra_value)
+        self.line_totals = multiply(self.unity_plus_extra, self.quantity)
+        self.line_weights = multiply(self.weight, self.quantity)
+
+        self.total = total(self.line_totals)
+        self.total_extra = total(self.extra_value)
+        self.total_quantity = total(self.quantity)
+        self.total_weight = total(self.line_weights)
+
+    def __len__(self):
+        return self.size
+
+    def is_stale(self, items, changes=0):
+        """
+        True when the items list was replaced, an item added or removed
+        or a value changed in place (changes counts the assignments of
+        the values, see Item.__setattr__)
+        """
+        return (self.items_id != id(items) or self.size != len(items) or
+                self.changes != changes)
@@ -1,9 +1,16 @@
 # coding: utf-8
 
+import datetime
 import logging
+import subprocess
+import sys
+import time
 
+from flask import current_app
 from flask.ext.script import Command, Option
-from .models import Cart
+from .models import Cart, PaymentRecord
+from .archive import archive_carts, restore_cart, get_archive_collection
+from . import fixtures
 
 
 logger = logging.getLogger(__name__)
@@ -26,3 +33,255 @@ class ListCart(Command):
 
         for cart in carts:
             logger.info('Cart: {}'.format(cart))
+
+
+class ArchiveCarts(Command):
+    "moves old completed and cancelled carts to the archive collection"
+
+    command_name = 'archive_carts'
+
+    option_list = (
+        Option('--days', '-d', dest='days', type=int),
+        Option('--batch-size', '-b', dest='batch_size', type=int),
+        Option('--keep-log', '-l', dest='keep_log', type=int),
+    )
+
+    def run(self, days=None, batch_size=None, keep_log=None):
+        moved = archive_carts(days, batch_size, keep_log)
+        logger.info('{} carts archived'.format(moved))
+
+
+class RestoreCart(Command):
+    "moves an archived cart back to the Cart collection"
+
+    command_name = 'restore_cart'
+
+    option_list = (
+        Option('--id', '-i', dest='cart_id', required=True),
+    )
+
+    def run(self, cart_id):
+        cart = restore_cart(id=cart_id)
+        logger.info('Restored: {}'.format(cart))
+
+
+class CompactCarts(Command):
+    "removes product descriptions, links and dimensions copied to items"
+
+    command_name = 'compact_carts'
+
+    option_list = (
+        Option('--archive', '-a', dest='archive', action='store_true',
+               default=False),
+    )
+
+    def run(self, archive=False):
+        modified = Cart.compact_items()
+        logger.info('{} carts compacted'.format(modified))
+        if archive:
+            modified = Cart.compact_items(get_archive_collection())
+            logger.info('{} archived carts compacted'.format(modified))
+
+
+def import_times(module):
+    """
+    imports `module` in a fresh interpreter with -X importtime (python
+    3.7+), returns [(cumulative ms, self ms, imported module)]
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out, err = process.communicate()
+    timings = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative) / 1000.0, int(own) / 1000.0,
+                        name.strip()))
+    if process.returncode:
+        raise RuntimeError(err.decode('utf-8', 'replace').splitlines()[-1])
+    return timings
+
+
+class ImportReport(Command):
+    "reports the slowest imports of a cart module and checks the budget"
+
+    command_name = 'cart_import_report'
+
+    option_list = (
+        Option('--module', '-m', dest='module',
+               default='quokka.modules.cart.models'),
+        Option('--top', '-t', dest='top', type=int, default=20),
+        Option('--budget', '-b', dest='budget', type=float),
+    )
+
+    def run(self, module, top=20, budget=None):
+        timings = import_times(module)
+        if not timings:
+            logger.error('no import timings, python 3.7+ is required')
+            return 1
+        total = max(cumulative for cumulative, own, name in timings)
+        for cumulative, own, name in sorted(timings, reverse=True)[:top]:
+            logger.info('{0:>10.1f}ms {1:>10.1f}ms  {2}'.format(
+                cumulative, own, name))
+        logger.info('{0} imported in {1:.1f}ms'.format(module, total))
+
+        budget = budget or current_app.config.get('CART_IMPORT_BUDGET')
+        if budget and total > budget:
+            logger.error('import budget of {0}ms exceeded'.format(budget))
+            return 1
+
+
+class GenerateFixtures(Command):
+    "bulk inserts synthetic users, products and carts for scale testing"
+
+    command_name = 'cart_fixtures'
+
+    option_list = (
+        Option('--carts', '-c', dest='carts', type=int, default=100000),
+        Option('--products', '-p', dest='products', type=int, default=10000),
+        Option('--users', '-u', dest='users', type=int, default=100000),
+        Option('--status', '-s', dest='status',
+               help='status weights e.g: pending=0.2,completed=0.8'),
+        Option('--mean-items', dest='mean_items', type=float, default=3),
+        Option('--max-items', dest='max_items', type=int, default=30),
+        Option('--mean-log', dest='mean_log', type=float, default=4),
+        Option('--days', dest='days', type=int, default=365),
+        Option('--seed', dest='seed', type=int, default=42),
+        Option('--workers', '-w', dest='workers', type=int),
+        Option('--batch-size', '-b', dest='batch_size', type=int,
+               default=5000),
+        Option('--host', dest='host', help='defaults to the app database'),
+        Option('--drop-indexes', dest='drop_indexes', action='store_true',
+               help='drop the cart indexes during the load, rebuild after'),
+    )
+
+    def run(self, carts, products, users, status=None, mean_items=3,
+            max_items=30, mean_log=4, days=365, seed=42, workers=None,
+            batch_size=5000, host=None, drop_indexes=False):
+        from mongoengine.base import get_document
+        from .models import BaseProduct, Processor
+
+        started = time.time()
+        db = Cart._get_db()
+        host = host or fixtures.get_mongo_uri(
+            current_app.config.get('MONGODB_SETTINGS', {}),
+            db.client.address)
+
+        now = fixtures.get_base_time(seed)
+        User = get_document('User')
+        user_rows = fixtures.make_users(
+            User._get_collection(), users, seed, now, fixtures.get_cls(User))
+        logger.info('{} users inserted'.format(len(user_rows)))
+
+        channel = get_document('Channel').objects.first()
+        product_rows = fixtures.make_products(
+            BaseProduct._get_collection(), products, seed + 1, now,
+            channel and channel.pk, fixtures.get_cls(BaseProduct))
+        logger.info('{} products inserted'.format(len(product_rows)))
+
+        Processor.get_default_processor()
+        processors = [processor.pk for processor in Processor.objects]
+
+        options = {
+            'status_weights': fixtures.parse_weights(status),
+            'mean_items': mean_items,
+            'max_items': max_items,
+            'mean_log': max(mean_log, 0.1),
+            'days': days,
+            'seed': seed,
+            'now': now,
+            'batch_size': batch_size
+        }
+        if drop_indexes:
+            # secondary indexes are cheaper to build once after the load
+            Cart._get_collection().drop_indexes()
+        inserted = fixtures.generate(
+            host, db.name, Cart._get_collection_name(), carts,
+            product_rows, user_rows, processors, options, workers
+        )
+        Cart.ensure_indexes()
+        logger.info('{} carts inserted in {:.1f}s'.format(
+            inserted, time.time() - started))
+
+
+class LedgerBackfill(Command):
+    "records the payments of carts processed before the payment ledger"
+
+    command_name = 'cart_ledger_backfill'
+
+    option_list = (
+        Option('--batch-size', '-b', dest='batch_size', type=int,
+               default=1000),
+        Option('--all', dest='all_carts', action='store_true',
+               help='every cart with a transaction, not only the failed'),
+    )
+
+    def run(self, batch_size=1000, all_carts=False):
+        inserted = PaymentRecord.backfill(batch_size, all_carts)
+        logger.info('{} payment records inserted'.format(inserted))
+
+
+class SettlementReport(Command):
+    "totals of the payments confirmed in a period (UTC), from the ledger"
+
+    command_name = 'cart_settlement'
+
+    option_list = (
+        Option('--start', '-s', dest='start', required=True,
+               help='YYYY-MM-DD'),
+        Option('--end', '-e', dest='end', help='YYYY-MM-DD, exclusive'),
+        Option('--by', dest='by', default='day,status',
+               help='comma separated: day,status,payment_system,method'),
+    )
+
+    def run(self, start, end=None, by='day,status'):
+        start = datetime.datetime.strptime(start, '%Y-%m-%d')
+        end = (datetime.datetime.strptime(end, '%Y-%m-%d') if end
+               else datetime.datetime.utcnow())
+        by = [name.strip() for name in by.split(',') if name.strip()]
+        totals = dict(count=0, value=0, fee=0, net_value=0)
+        for row in PaymentRecord.settlement(start, end, by):
+            logger.info(u'{0}  count:{1} value:{2:.2f} fee:{3:.2f} '
+                        u'net:{4:.2f}'.format(
+                            u' '.join(u'%s' % row['_id'].get(name)
+                                      for name in by),
+                            row['count'], row['value'] or 0,
+                            row['fee'] or 0, row['net_value'] or 0))
+            for name in totals:
+                totals[name] += row[name] or 0
+        logger.info(u'total  count:{count} value:{value:.2f} '
+                    u'fee:{fee:.2f} net:{net_value:.2f}'.format(**totals))
+
+
+class DispatchEvents(Command):
+    "relays cart order events and delivers them to CART_EVENT_SINKS"
+
+    command_name = 'cart_events'
+
+    option_list = (
+        Option('--reset', '-r', dest='reset',
+               help='sink name, replays its feed from --position'),
+        Option('--position', '-p', dest='position', type=int,
+               help='OrderEvent number, the feed resumes after it'),
+        Option('--loop', '-l', dest='loop', type=float,
+               help='keeps dispatching every LOOP seconds'),
+    )
+
+    def run(self, reset=None, position=None, loop=None):
+        from .events import process_events, reset_cursor
+        if reset:
+            reset_cursor(reset, position)
+            logger.info('{} cursor reset'.format(reset))
+            return
+        while True:
+            delivered = process_events()
+            if delivered is None:
+                logger.info('events already being dispatched')
+            else:
+                logger.info('events delivered: {}'.format(delivered))
+            if not loop:
+                break
+            time.sleep(loop)
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""
+Outbound order event feed
+
+Cart.set_status, bulk_set_status and finish_checkout append compact
+events to Cart.outbox with atomic $push (or in the bulk update pipeline)
+along with the change. The relay numbers the events of each cart (seq)
+from Cart.event_seq when it moves them, and numbers the whole feed
+(number) from a $inc counter on its cursor. process_events
+(task dispatch_order_events, command cart_events) relays them to the
+OrderEvent collection and delivers them in batches to every sink in
+CART_EVENT_SINKS:
+
+    CART_EVENT_SINKS = {
+        'erp': {'class': 'quokka.modules.cart.events.WebhookSink',
+                'url': 'https://erp.example.com/orders/events'},
+        'audit': {'class': 'quokka.modules.cart.events.JsonlSink',
+                  'path': '/var/log/cart/events.jsonl'}
+    }
+
+Each sink has its own EventCursor, deliveries resume after the number
+of the last acknowledged event, so sinks get every event at least once and the
+events of a cart in order. A failing sink (or one answering with
+Backpressure) is retried with exponential backoff, the others go on.
+"""
+import datetime
+import json
+import logging
+
+from bson import ObjectId
+from flask import current_app
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from werkzeug.utils import import_string
+
+from .functions import send_task
+from .models import Cart, OrderEvent, EventCursor
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+logger = logging.getLogger(__name__)
+
+RELAY = '_relay'
+
+
+class Backpressure(Exception):
+    """raised by sinks asking to be called again later"""
+
+    def __init__(self, message, retry_after=None):
+        super(Backpressure, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class BaseSink(object):
+
+    def __init__(self, name, **config):
+        self.name = name
+        self.config = config
+
+    def send(self, events):
+        """delivers a batch of event payloads or raises"""
+        raise NotImplementedError()
+
+
+class WebhookSink(BaseSink):
+    """
+    POSTs {"events": [...]} as JSON to config['url'],
+    429 and 503 responses are backpressure (Retry-After is honored)
+    """
+
+    def send(self, events):
+        headers = {'Content-Type': 'application/json'}
+        headers.update(self.config.get('headers', {}))
+        request = Request(
+            self.config['url'],
+            data=json.dumps({'events': events}).encode('utf-8'),
+            headers=headers
+        )
+        try:
+            response = urlopen(request,
+                               timeout=self.config.get('timeout', 10))
+            response.close()
+        except HTTPError as e:
+            if e.code in (429, 503):
+                retry_after = e.headers.get('Retry-After')
+                raise Backpressure(
+                    "%s answered %s" % (self.name, e.code),
+                    int(retry_after) if retry_after and
+                    retry_after.isdigit() else None
+                )
+            raise
+
+
+class JsonlSink(BaseSink):
+    """appends one JSON line per event to config['path']"""
+
+    def send(self, events):
+        with open(self.config['path'], 'a') as output:
+            for event in events:
+                output.write(json.dumps(event) + '\n')
+
+
+class QueueSink(BaseSink):
+    """
+    sends each batch to the celery task config['task'] (name), on
+    config.get('queue'), consumers read the events from the broker
+    """
+
+    def send(self, events):
+        send_task(self.config['task'], events,
+                  queue=self.config.get('queue'))
+
+
+def get_sinks():
+    sinks = []
+    for name, config in current_app.config.get('CART_EVENT_SINKS',
+                                               {}).items():
+        config = dict(config)
+        sinks.append(import_string(config.pop('class'))(name, **config))
+    return sinks
+
+
+def to_payload(document):
+    """JSON ready event"""
+    payload = dict(
+        (key, value.isoformat() if isinstance(value, datetime.datetime)
+         else value)
+        for key, value in document.get('data', {}).items()
+    )
+    payload.update(id=str(document['_id']), cart_id=document['cart_id'],
+                   seq=document['seq'], number=document['number'],
+                   type=document['type'])
+    return payload
+
+
+def reserve_numbers(count):
+    """last of `count` feed numbers taken from the relay counter"""
+    cursor = EventCursor._get_collection().find_one_and_update(
+        {'name': RELAY}, {'$inc': {'counter': count}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return cursor['counter']
+
+
+def relay_outbox(batch_size=500):
+    """
+    moves the outbox of carts to OrderEvent, the events of a cart get
+    the seqs following its event_seq in outbox order, then they are
+    pulled and event_seq moves past them, only if no other relay did it.
+    A relay interrupted before the pull numbers the events the same way
+    next time, the unique (cart_id, seq) index drops them (their feed
+    numbers are skipped, dispatch only needs them increasing).
+    Returns the events relayed
+    """
+    collection = Cart._get_collection()
+    relayed = 0
+    while True:
+        carts = list(collection.find(
+            {'outbox.id': {'$exists': True}}, {'outbox': 1, 'event_seq': 1}
+        ).limit(batch_size))
+        if not carts:
+            return relayed
+
+        documents = []
+        pulls = []
+        for cart in carts:
+            seq = cart.get('event_seq') or 0
+            for event in cart['outbox']:
+                seq += 1
+                data = dict(event)
+                data.pop('id', None)
+                documents.append({
+                    '_id': ObjectId(),
+                    'cart_id': str(cart['_id']),
+                    'seq': seq,
+                    'type': event['type'],
+                    'data': data,
+                    'created_at': event.get('at')
+                })
+            pulls.append(UpdateOne(
+                {'_id': cart['_id'], 'event_seq': cart.get('event_seq')},
+                {'$pull': {'outbox': {'id': {
+                    '$in': [event['id'] for event in cart['outbox']]
+                }}}, '$set': {'event_seq': seq}}
+            ))
+
+        number = reserve_numbers(len(documents)) - len(documents)
+        for document in documents:
+            number += 1
+            document['number'] = number
+
+        try:
+            # ordered, so numbers are visible in delivery order
+            result = OrderEvent._get_collection().insert_many(documents)
+            relayed += len(result.inserted_ids)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000
+                   for error in e.details['writeErrors']):
+                raise
+            relayed += e.details['nInserted']
+            # inserts stop at the first duplicate, go on one by one
+            for document in documents[e.details['nInserted'] + 1:]:
+                try:
+                    OrderEvent._get_collection().insert_one(document)
+                    relayed += 1
+                except Exception as error:
+                    if getattr(error, 'code', None) != 11000:
+                        raise
+        Cart._get_collection().bulk_write(pulls, ordered=False)
+
+
+def backoff(cursor, error, retry_after=None):
+    failures = cursor.failures + 1
+    max_delay = current_app.config.get('CART_EVENT_MAX_BACKOFF', 600)
+    delay = retry_after or min(max_delay, 2 ** failures)
+    cursor.update(
+        set__failures=failures,
+        set__error=u"%s" % error,
+        set__retry_at=datetime.datetime.now() +
+        datetime.timedelta(seconds=delay)
+    )
+    logger.error("Sink %s failed (%s), retry in %ss", cursor.name, error,
+                 delay)
+
+
+def dispatch(sink, cursor, batch_size=100, max_batches=10):
+    """
+    delivers up to max_batches batches after the cursor position,
+    the position moves only when the sink accepts the batch
+    """
+    if cursor.retry_at and cursor.retry_at > datetime.datetime.now():
+        return 0
+    collection = OrderEvent._get_collection()
+    delivered = 0
+    for _ in range(max_batches):
+        query = {'number': {'$gt': cursor.position or 0}}
+        documents = list(collection.find(query).sort('number', 1)
+                         .limit(batch_size))
+        if not documents:
+            break
+        try:
+            sink.send([to_payload(document) for document in documents])
+        except Backpressure as e:
+            backoff(cursor, e, e.retry_after)
+            break
+        except Exception as e:
+            backoff(cursor, e)
+            break
+        cursor.position = documents[-1]['number']
+        cursor.update(set__position=cursor.position,
+                      inc__delivered=len(documents),
+                      set__failures=0, unset__retry_at=True,
+                      unset__error=True)
+        cursor.failures = 0
+        cursor.retry_at = None
+        delivered += len(documents)
+    return delivered
+
+
+def process_events(sinks=None):
+    """
+    relays the outboxes and dispatches to the sinks, one run at a time
+    (the relay must be single so numbers become visible in order).
+    Returns {sink name: delivered} or None if another run holds the lease
+    """
+    config = current_app.config
+    lease = config.get('CART_EVENT_LEASE', 300)
+    relay = EventCursor.acquire(RELAY, lease)
+    if relay is None:
+        return None
+    try:
+        relay_outbox(config.get('CART_EVENT_RELAY_BATCH_SIZE', 500))
+        delivered = {}
+        for sink in (get_sinks() if sinks is None else sinks):
+            cursor = EventCursor.objects(name=sink.name).first()
+            if cursor is None:
+                cursor = EventCursor(name=sink.name).save()
+            delivered[sink.name] = dispatch(
+                sink, cursor,
+                config.get('CART_EVENT_BATCH_SIZE', 100),
+                config.get('CART_EVENT_MAX_BATCHES', 10)
+            )
+        return delivered
+    finally:
+        relay.release()
+
+
+def reset_cursor(name, position=None):
+    """replays the feed to a sink after the event number position"""
+    EventCursor.objects(name=name).update_one(
+        set__position=position, set__failures=0,
+        unset__retry_at=True, unset__error=True, upsert=True
+    )
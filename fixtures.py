@@ -1 +1,364 @@
 # coding: utf-8
+"""
+Synthetic data for scale testing
+
+Builds the raw documents of users, BaseProduct catalogs and carts in
+every STATUS (items, logs, payments) and inserts them with unordered
+insert_many batches from a pool of processes. Each chunk of carts has
+its own seed derived from the main seed so the dataset is reproducible
+no matter how the chunks are spread over the workers.
+
+    python manage.py cart_fixtures --carts 5000000 --workers 8
+
+Ids and dates derive from the seed too (see get_base_time and
+IdFactory), run the command again with another seed to grow the same
+database.
+"""
+import calendar
+import datetime
+import logging
+import multiprocessing
+import random
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:
+    from urllib import quote_plus
+
+logger = logging.getLogger(__name__)
+
+# share of carts in each status
+STATUS_WEIGHTS = {
+    'pending': 0.20,
+    'checked_out': 0.05,
+    'analysing': 0.02,
+    'confirmed': 0.08,
+    'completed': 0.22,
+    'refunding': 0.005,
+    'refunded': 0.015,
+    'cancelled': 0.09,
+    'abandoned': 0.30,
+}
+
+PAID_STATUS = ('confirmed', 'completed', 'refunding', 'refunded')
+
+PAYMENT_METHODS = ('credit_card', 'boleto', 'debit')
+
+# id streams, the chunks of carts follow
+USERS, PRODUCTS, CARTS = 0, 1, 2
+
+
+def get_base_time(seed):
+    """the 'now' of the dataset, carts are created in the days before"""
+    return datetime.datetime(2016, 1, 1) + datetime.timedelta(
+        seconds=random.Random(seed).randint(0, 365 * 86400))
+
+
+class IdFactory(object):
+    """
+    sequential ObjectIds of a stream: the base time, 24 bits of the seed,
+    the stream index and a counter, so every run of a seed builds the
+    same ids and the streams never collide
+    """
+
+    def __init__(self, seed, stream, when):
+        self.prefix = '%08x%06x%04x' % (
+            calendar.timegm(when.timetuple()), seed & 0xffffff, stream)
+        self.counter = 0
+
+    def __call__(self):
+        self.counter += 1
+        return ObjectId('%s%06x' % (self.prefix, self.counter))
+
+
+def parse_weights(value, defaults=STATUS_WEIGHTS):
+    """'pending=0.5,completed=0.5' into {status: weight}"""
+    if not value:
+        return dict(defaults)
+    weights = {}
+    for pair in value.split(','):
+        status, weight = pair.split('=')
+        if status.strip() not in defaults:
+            raise ValueError("Unknown status %s" % status)
+        weights[status.strip()] = float(weight)
+    return weights
+
+
+def get_mongo_uri(settings, address=None):
+    """
+    URI for the worker clients from the app MONGODB_SETTINGS, keeping
+    credentials and options, address (host, port) is the fallback
+    """
+    settings = dict((key.lower(), value) for key, value in settings.items())
+    host = settings.get('host')
+    if host and '://' in host:
+        return host
+    if host:
+        address = (host, settings.get('port') or 27017)
+    uri = 'mongodb://'
+    if settings.get('username'):
+        uri += '%s:%s@' % (quote_plus(settings['username']),
+                           quote_plus(settings.get('password') or ''))
+    uri += '%s:%s' % tuple(address or ('localhost', 27017))
+    if settings.get('authentication_source'):
+        uri += '/?authSource=%s' % settings['authentication_source']
+    return uri
+
+
+def get_cls(model):
+    """_cls value of the documents of model or None"""
+    if model._meta.get('allow_inheritance'):
+        return model._class_name
+
+
+def make_users(collection, count, seed, now, cls_name=None,
+               batch_size=5000):
+    """
+    User documents, returns [(id, name, email)], usernames and emails
+    are unique (they carry the id) as the user collection indexes them
+    """
+    make_id = IdFactory(seed, USERS, now)
+    ids = []
+    batch = []
+    for index in range(count):
+        user_id = make_id()
+        name = "User %s" % index
+        batch.append({
+            '_id': user_id,
+            'name': name,
+            'email': "user.%s@example.com" % user_id,
+            'username': "user%s" % user_id,
+            'password': None,
+            'active': True,
+            'roles': []
+        })
+        if cls_name:
+            batch[-1]['_cls'] = cls_name
+        ids.append((user_id, name, batch[-1]['email']))
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    batch and collection.insert_many(batch, ordered=False)
+    return ids
+
+
+def make_products(collection, count, seed, now, channel_id, cls_name,
+                  batch_size=5000):
+    """BaseProduct documents, returns [(id, title, price, weight, extra)]"""
+    rand = random.Random(seed)
+    make_id = IdFactory(seed, PRODUCTS, now)
+    products = []
+    batch = []
+    for index in range(count):
+        product_id = make_id()
+        title = "Product %s" % index
+        price = round(rand.lognormvariate(3.5, 0.9), 2)
+        weight = round(rand.uniform(0.1, 20), 2)
+        extra = rand.choice([None, None, None, round(price * 0.05, 2)])
+        batch.append({
+            '_id': product_id,
+            'title': title,
+            'slug': "fixture-product-%s-%s" % (index, product_id),
+            'channel': channel_id,
+            'summary': "Summary of %s" % title,
+            'description': "<p>Description of %s</p>" % title,
+            'unity_value': price,
+            'weight': weight,
+            'dimensions': "%sx%sx%s" % (rand.randint(5, 60),
+                                        rand.randint(5, 60),
+                                        rand.randint(5, 60)),
+            'extra_value': extra,
+            'stock': rand.choice([None, rand.randint(0, 1000)]),
+            'published': True,
+            'created_at': now,
+            'updated_at': now,
+            'available_at': now
+        })
+        if cls_name:
+            batch[-1]['_cls'] = cls_name
+        products.append((product_id, title, price, weight, extra))
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    batch and collection.insert_many(batch, ordered=False)
+    return products
+
+
+class CartFactory(object):
+    """builds raw cart documents, see Cart for the fields"""
+
+    def __init__(self, products, users, processors, options, seed,
+                 index=0):
+        self.rand = random.Random(seed)
+        self.now = options['now']
+        self.make_id = IdFactory(options['seed'], CARTS + index, self.now)
+        self.products = products
+        self.users = users
+        self.processors = processors
+        self.options = options
+        statuses = sorted(options['status_weights'].items())
+        self.statuses = [status for status, weight in statuses]
+        self.weights = [weight for status, weight in statuses]
+
+    def choose_status(self):
+        rand = self.rand.random() * sum(self.weights)
+        for status, weight in zip(self.statuses, self.weights):
+            rand -= weight
+            if rand <= 0:
+                return status
+        return self.statuses[-1]
+
+    def make_items(self, created_at):
+        rand = self.rand
+        count = min(self.options['max_items'],
+                    1 + int(rand.expovariate(
+                        1.0 / max(self.options['mean_items'] - 1, 0.01))))
+        items = []
+        for order, (product_id, title, price, weight, extra) in enumerate(
+                rand.sample(self.products, min(count, len(self.products)))):
+            quantity = float(rand.choice([1, 1, 1, 2, 2, 3, 5]))
+            items.append({
+                'product': product_id,
+                'uid': str(product_id),
+                'title': title,
+                'quantity': quantity,
+                'unity_value': price,
+                'total_value': round((price + (extra or 0)) * quantity, 2),
+                'weight': weight,
+                'extra_value': extra,
+                'allowed_to_set': ['quantity'],
+                'pipeline': [],
+                'order': order,
+                'created_at': created_at,
+                'updated_at': created_at
+            })
+        return items
+
+    def make_log(self, status, created_at):
+        rand = self.rand
+        entries = ["{0},Cart created".format(created_at)]
+        for index in range(int(rand.expovariate(
+                1.0 / self.options['mean_log']))):
+            entries.append("{0},Item updated {1}".format(created_at, index))
+        entries.append("{0},Status changed to: {1}".format(created_at,
+                                                          status))
+        return entries
+
+    def make_cart(self):
+        rand = self.rand
+        cart_id = self.make_id()
+        status = self.choose_status()
+        created_at = self.now - datetime.timedelta(
+            seconds=rand.randint(0, self.options['days'] * 86400))
+        updated_at = created_at + datetime.timedelta(
+            minutes=rand.randint(0, 7 * 24 * 60))
+        items = self.make_items(created_at)
+        total = round(sum(item['total_value'] for item in items), 2)
+        user = None
+        if status != 'pending' or rand.random() > 0.3:
+            user = rand.choice(self.users) if self.users else None
+
+        cart = {
+            '_id': cart_id,
+            'status': status,
+            'items': items,
+            'payment': [],
+            'total': total,
+            'extra_costs': {},
+            'sender_data': {},
+            'shipping_data': {},
+            'shipping_cost': 0.0,
+            'tax': 0.0,
+            'processor': rand.choice(self.processors),
+            'reference_code': str(cart_id),
+            'requires_login': True,
+            'continue_shopping_url': '/',
+            'pipeline': [],
+            'log': self.make_log(status, created_at),
+            'config': {},
+            'coupons': [],
+            'published': True,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'search_helper': ""
+        }
+        if user:
+            cart['belongs_to'] = user[0]
+            cart['search_helper'] = " ".join(user[1:])
+        if status != 'pending':
+            cart['checkout_code'] = "%032X" % rand.getrandbits(128)
+        if status in PAID_STATUS:
+            tax = round(total * 0.0399 + 0.4, 2)
+            cart['tax'] = tax
+            cart['transaction_code'] = "%032X" % rand.getrandbits(128)
+            cart['payment'] = [{
+                'uid': cart['transaction_code'],
+                'payment_system': 'pagseguro',
+                'method': rand.choice(PAYMENT_METHODS),
+                'value': total,
+                'date': updated_at,
+                'confirmed_at': updated_at,
+                'status': status
+            }]
+        return cart
+
+
+_worker = {}
+
+
+def init_worker(host, db_name, collection_name, products, users,
+                processors, options):
+    # pymongo clients must not be shared across forks
+    _worker['collection'] = MongoClient(host)[db_name][collection_name]
+    _worker['args'] = (products, users, processors, options)
+
+
+def insert_carts(task):
+    """inserts a chunk of carts, task is (index, count, seed)"""
+    index, count, seed = task
+    products, users, processors, options = _worker['args']
+    factory = CartFactory(products, users, processors, options, seed,
+                          index)
+    batch_size = options['batch_size']
+    collection = _worker['collection']
+    inserted = 0
+    while inserted < count:
+        size = min(batch_size, count - inserted)
+        collection.insert_many([factory.make_cart() for _ in range(size)],
+                               ordered=False)
+        inserted += size
+    return inserted
+
+
+def generate(host, db_name, collection_name, carts, products, users,
+             processors, options, workers=None, chunk_size=50000):
+    """
+    inserts `carts` carts using `workers` processes,
+    chunk seeds are derived from options['seed']
+    """
+    rand = random.Random(options['seed'])
+    tasks = []
+    remaining = carts
+    while remaining > 0:
+        count = min(chunk_size, remaining)
+        tasks.append((len(tasks), count, rand.getrandbits(32)))
+        remaining -= count
+
+    pool = multiprocessing.Pool(
+        workers or multiprocessing.cpu_count(),
+        initializer=init_worker,
+        initargs=(host, db_name, collection_name, products, users,
+                  processors, options)
+    )
+    inserted = 0
+    try:
+        for count in pool.imap_unordered(insert_carts, tasks):
+            inserted += count
+            logger.info("%s/%s carts inserted", inserted, carts)
+    finally:
+        pool.close()
+        pool.join()
+    return inserted
@@ -1,9 +1,55 @@
 # coding: utf-8
+import logging
 
-from flask import session
-from .models import Cart
+from flask import session, current_app
+
+logger = logging.getLogger()
 
 
 def get_current_cart(*args, **kwargs):
     if session.get('cart_id'):
+        from .models import Cart
         return Cart.get_cart(*args, **kwargs)
+
+
+def merge_cart_on_login(sender, user, **extra):
+    """
+    flask-login user_logged_in receiver, merges the anonymous cart of
+    the session with the pending carts of user, see Cart.merge_carts
+    """
+    if not current_app.config.get('CART_MERGE_ON_LOGIN', True):
+        return
+    from .models import Cart
+    try:
+        Cart.merge_carts(user, session.get('cart_id'))
+    except Exception as e:
+        # login must not fail because of the cart
+        logger.error("Cart merge failed for {0}: {1}".format(user, e))
+
+
+TASKS = __name__.rsplit('.', 1)[0] + '.tasks'
+
+
+def get_celery():
+    """
+    celery client of current_app, only sends tasks: importing .tasks in
+    a web request would build a second app with create_celery_app
+    """
+    celery = current_app.extensions.get('cart_celery')
+    if celery is None:
+        from celery import Celery
+        celery = Celery(current_app.import_name,
+                        broker=current_app.config.get('CELERY_BROKER_URL'))
+        celery.conf.update(current_app.config)
+        current_app.extensions['cart_celery'] = celery
+    return celery
+
+
+def send_task(name, *args, **kwargs):
+    """
+    sends the task `name` of .tasks (or a full task name) to the broker,
+    kwargs are options of Celery.send_task
+    """
+    if '.' not in name:
+        name = '{0}.{1}'.format(TASKS, name)
+    return get_celery().send_task(name, args=args, **kwargs)
@@ -0,0 +1,303 @@
+# coding: utf-8
+"""
+Write-behind store for pending carts
+
+When CART_HOTSTORE is set (import path of a BaseHotStore subclass)
+Cart.save of a pending cart only writes the BSON document to the hot
+store, get_cart reads it from there and the document is written to
+Mongo later, every CART_HOTSTORE_FLUSH_INTERVAL seconds, when evicted
+(CART_HOTSTORE_SIZE carts at most) and always before checkout, so the
+checkout works on a durable cart. Writes are conditional, a hot copy
+never overwrites a cart changed in mongo after it (status changed by a
+notification, bulk action...), it is dropped instead.
+
+MemoryHotStore keeps carts in the process, it is only safe for single
+process servers. SqliteHotStore is shared by the processes of one host
+and stands in for a networked key value store, which can be plugged in
+implementing the same interface.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from bson import BSON
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+from werkzeug.utils import import_string
+
+logger = logging.getLogger()
+
+
+class StaleCart(Exception):
+    """the cart changed in mongo after its hot copy was written"""
+
+
+class BaseHotStore(object):
+    """
+    carts are stored as BSON keyed by cart id, every put bumps the
+    version and marks the cart dirty until it is written to collection
+    """
+
+    def __init__(self, collection, size=10000, flush_interval=5, **config):
+        self.collection = collection
+        self.size = size
+        self.flush_interval = flush_interval
+        self.config = config
+        self.flusher = None
+
+    def get(self, cart_id):
+        """BSON bytes of the cart or None"""
+        raise NotImplementedError()
+
+    def put(self, cart_id, data):
+        """stores the cart as dirty, returns the ids evicted"""
+        raise NotImplementedError()
+
+    def pop(self, cart_id):
+        """removes the cart, returns (data, dirty) or None"""
+        raise NotImplementedError()
+
+    def get_dirty(self, cart_id=None):
+        """[(cart_id, data, version)] of the dirty carts"""
+        raise NotImplementedError()
+
+    def mark_clean(self, cart_id, version):
+        """clears dirty unless the cart was written again meanwhile"""
+        raise NotImplementedError()
+
+    def write(self, data, since=None, events=None):
+        """
+        writes the cart unless the stored one is no longer pending or
+        was updated after it (or after `since`), returns False when the
+        hot copy is stale. events are pushed to the outbox in the write
+        """
+        document = BSON(data).decode()
+        query = {'_id': document.pop('_id'), 'status': 'pending'}
+        since = since or document.get('updated_at')
+        if since is not None:
+            query['updated_at'] = {'$lte': since}
+        # events are only pushed to mongo, see Cart.add_event
+        document.pop('outbox', None)
+        document.pop('event_seq', None)
+        update = {'$set': document}
+        if events:
+            update['$push'] = {'outbox': {'$each': events}}
+        try:
+            self.collection.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            # the filter did not match an existing cart, keep mongo's
+            logger.warning("Hot copy of cart %s is stale, dropped",
+                           query['_id'])
+            return False
+        return True
+
+    def flush(self, cart_id=None):
+        """writes the dirty carts (or cart_id) to mongo"""
+        dirty = self.get_dirty(cart_id)
+        for dirty_id, data, version in dirty:
+            if self.write(data):
+                self.mark_clean(dirty_id, version)
+            else:
+                self.pop(dirty_id)
+        return len(dirty)
+
+    def evict(self, cart_id):
+        """flushes and removes the cart"""
+        entry = self.pop(cart_id)
+        if entry and entry[1]:
+            self.write(entry[0])
+
+    def start(self):
+        """flushes on a timer in a daemon thread and at exit"""
+        if self.flusher is not None or not self.flush_interval:
+            return
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Hot store flush failed: %s" % e)
+
+
+class MemoryHotStore(BaseHotStore):
+    """LRU of carts in the current process"""
+
+    def __init__(self, collection, size=10000, flush_interval=5, **config):
+        super(MemoryHotStore, self).__init__(collection, size,
+                                             flush_interval, **config)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # cart_id: [data, version, dirty]
+
+    def get(self, cart_id):
+        with self.lock:
+            entry = self.entries.pop(cart_id, None)
+            if entry is None:
+                return None
+            self.entries[cart_id] = entry
+            return entry[0]
+
+    def put(self, cart_id, data):
+        evicted = []
+        with self.lock:
+            entry = self.entries.pop(cart_id, None)
+            version = entry[1] + 1 if entry else 1
+            self.entries[cart_id] = [data, version, True]
+            while len(self.entries) > self.size:
+                evicted.append(self.entries.popitem(last=False))
+        for evicted_id, (old_data, version, dirty) in evicted:
+            if dirty:
+                self.write(old_data)
+        return [evicted_id for evicted_id, entry in evicted]
+
+    def pop(self, cart_id):
+        with self.lock:
+            entry = self.entries.pop(cart_id, None)
+        return entry and (entry[0], entry[2])
+
+    def get_dirty(self, cart_id=None):
+        with self.lock:
+            if cart_id is not None:
+                entry = self.entries.get(cart_id)
+                entries = [(cart_id, entry)] if entry else []
+            else:
+                entries = self.entries.items()
+            return [(key, entry[0], entry[1])
+                    for key, entry in entries if entry[2]]
+
+    def mark_clean(self, cart_id, version):
+        with self.lock:
+            entry = self.entries.get(cart_id)
+            if entry and entry[1] == version:
+                entry[2] = False
+
+
+class SqliteHotStore(BaseHotStore):
+    """
+    carts in a sqlite file (CART_HOTSTORE_CONFIG['path']) shared by
+    the processes of the host
+    """
+
+    def __init__(self, collection, size=10000, flush_interval=5, **config):
+        super(SqliteHotStore, self).__init__(collection, size,
+                                             flush_interval, **config)
+        self.path = config.get('path', 'cart_hotstore.db')
+        self.local = threading.local()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS carts (id TEXT PRIMARY KEY, "
+            "data BLOB, version INTEGER, dirty INTEGER, touched REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS carts_touched ON carts (touched)")
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, cart_id):
+        row = self.connection.execute(
+            "SELECT data FROM carts WHERE id = ?", (cart_id,)
+        ).fetchone()
+        return row and bytes(row[0])
+
+    def put(self, cart_id, data):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO carts VALUES (?, ?, COALESCE("
+            "(SELECT version FROM carts WHERE id = ?), 0) + 1, 1, ?)",
+            (cart_id, sqlite3.Binary(data), cart_id, time.time())
+        )
+        overflow = self.connection.execute(
+            "SELECT COUNT(*) FROM carts").fetchone()[0] - self.size
+        evicted = []
+        if overflow > 0:
+            evicted = [row[0] for row in self.connection.execute(
+                "SELECT id FROM carts ORDER BY touched LIMIT ?", (overflow,)
+            ).fetchall()]
+            for evicted_id in evicted:
+                self.evict(evicted_id)
+        return evicted
+
+    def pop(self, cart_id):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT data, dirty FROM carts WHERE id = ?", (cart_id,)
+            ).fetchone()
+            connection.execute("DELETE FROM carts WHERE id = ?", (cart_id,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return row and (bytes(row[0]), bool(row[1]))
+
+    def get_dirty(self, cart_id=None):
+        query = "SELECT id, data, version FROM carts WHERE dirty = 1"
+        params = ()
+        if cart_id is not None:
+            query += " AND id = ?"
+            params = (cart_id,)
+        return [(row[0], bytes(row[1]), row[2])
+                for row in self.connection.execute(query, params).fetchall()]
+
+    def mark_clean(self, cart_id, version):
+        self.connection.execute(
+            "UPDATE carts SET dirty = 0 WHERE id = ? AND version = ?",
+            (cart_id, version)
+        )
+
+
+_lock = threading.Lock()
+
+
+def get_hotstore():
+    """the configured hot store, None when CART_HOTSTORE is not set"""
+    config = current_app.config
+    if not config.get('CART_HOTSTORE'):
+        return None
+    store = current_app.extensions.get('cart_hotstore')
+    if store is None:
+        from .models import Cart
+        with _lock:
+            store = current_app.extensions.get('cart_hotstore')
+            if store is None:
+                store = import_string(config['CART_HOTSTORE'])(
+                    Cart._get_collection(),
+                    size=config.get('CART_HOTSTORE_SIZE', 10000),
+                    flush_interval=config.get(
+                        'CART_HOTSTORE_FLUSH_INTERVAL', 5),
+                    **config.get('CART_HOTSTORE_CONFIG', {})
+                )
+                store.start()
+                current_app.extensions['cart_hotstore'] = store
+    return store
+
+
+def evict_carts(ids):
+    """
+    makes mongo the source of truth for the carts before they are
+    updated directly in the collection (bulk actions, repricing)
+    """
+    store = get_hotstore()
+    if store is not None:
+        for cart_id in ids:
+            store.evict(str(cart_id))
+
+
+def flush_hotstore():
+    store = get_hotstore()
+    return store.flush() if store is not None else 0
@@ -0,0 +1,232 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from bson import BSON
+from flask import current_app, g, has_app_context
+from flask.signals import Namespace
+from pymongo import monitoring
+from werkzeug.utils import import_string
+
+logger = logging.getLogger(__name__)
+
+signals = Namespace()
+
+# sender is the step name, kwargs: duration, metrics
+step_finished = signals.signal('cart-step-finished')
+gateway_called = signals.signal('cart-gateway-called')
+# sender is the cart, kwargs: size, metrics
+cart_saved = signals.signal('cart-saved')
+# sender is the RequestMetrics
+request_measured = signals.signal('cart-request-measured')
+
+
+class RequestMetrics(object):
+    """measures collected during a single cart request"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.duration = None
+        self.steps = []
+        self.gateway = []
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.cart_sizes = []
+        self.snapshot_hits = 0
+        self.snapshot_misses = 0
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+
+def get_metrics():
+    if has_app_context():
+        return getattr(g, 'cart_metrics', None)
+
+
+@contextmanager
+def timed(name, kind='step'):
+    """
+    records the duration of the block in the current request metrics,
+    does nothing when metrics are disabled
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        if kind == 'gateway':
+            metrics.gateway.append((name, duration))
+            gateway_called.send(name, duration=duration, metrics=metrics)
+        else:
+            metrics.steps.append((name, duration))
+            step_finished.send(name, duration=duration, metrics=metrics)
+
+
+def record_cart_size(cart):
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    size = len(BSON.encode(cart.to_mongo()))
+    metrics.cart_sizes.append(size)
+    cart_saved.send(cart, size=size, metrics=metrics)
+
+
+@contextmanager
+def measure_request(endpoint):
+    if not current_app.config.get('CART_METRICS_ENABLED', False):
+        yield
+        return
+
+    check_command_counter()
+    metrics = g.cart_metrics = RequestMetrics(endpoint)
+    try:
+        yield metrics
+    finally:
+        g.cart_metrics = None
+        metrics.finish()
+        request_measured.send(metrics)
+        get_sink().collect(metrics)
+
+
+class CommandCounter(monitoring.CommandListener):
+    """counts mongo commands and bytes of the current cart request"""
+
+    def started(self, event):
+        metrics = get_metrics()
+        if metrics is not None:
+            metrics.commands += 1
+            metrics.bytes_sent += len(BSON.encode(event.command))
+
+    def succeeded(self, event):
+        metrics = get_metrics()
+        if metrics is not None:
+            metrics.bytes_received += len(BSON.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+# pymongo only attaches listeners to clients created after they are
+# registered, the app client is connected before this module is imported,
+# so it has to be given in the connection settings:
+#     MONGODB_SETTINGS = {..., 'event_listeners': [command_counter]}
+# the global registration covers the clients created later (workers)
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+_checked = []
+
+
+def check_command_counter():
+    """warns once when the app client does not report commands"""
+    if _checked:
+        return
+    _checked.append(True)
+    from mongoengine.connection import get_db
+    listeners = getattr(get_db().client, '_event_listeners', None)
+    if listeners is None:
+        # not a pymongo client (mongomock)
+        return
+    if command_counter not in listeners.event_listeners:
+        logger.warning(
+            "Mongo commands are not counted, add the cart command_counter "
+            "to MONGODB_SETTINGS['event_listeners']")
+
+
+class BaseSink(object):
+    def collect(self, metrics):
+        raise NotImplementedError()
+
+
+class PrometheusSink(BaseSink):
+    """aggregates metrics in memory and renders Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.summaries = defaultdict(lambda: [0, 0.0])
+        self.types = {}
+
+    def inc(self, name, labels, value=1):
+        self.types[name] = 'counter'
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        self.types[name] = 'summary'
+        summary = self.summaries[(name, labels)]
+        summary[0] += 1
+        summary[1] += value
+
+    def collect(self, metrics):
+        endpoint = (('endpoint', metrics.endpoint),)
+        with self.lock:
+            self.observe('cart_request_seconds', endpoint, metrics.duration)
+            for name, duration in metrics.steps:
+                self.observe('cart_step_seconds', (('step', name),), duration)
+            for name, duration in metrics.gateway:
+                self.observe('cart_gateway_seconds', (('call', name),),
+                             duration)
+            for size in metrics.cart_sizes:
+                self.observe('cart_document_bytes', endpoint, size)
+            self.inc('cart_mongo_commands_total', endpoint, metrics.commands)
+            self.inc('cart_mongo_bytes_sent_total', endpoint,
+                     metrics.bytes_sent)
+            self.inc('cart_mongo_bytes_received_total', endpoint,
+                     metrics.bytes_received)
+            self.inc('cart_snapshot_hits_total', endpoint,
+                     metrics.snapshot_hits)
+            self.inc('cart_snapshot_misses_total', endpoint,
+                     metrics.snapshot_misses)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, kind in sorted(self.types.items()):
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                if kind == 'counter':
+                    for (key, labels), value in self.counters.items():
+                        if key == name:
+                            lines.append("{0}{1} {2}".format(
+                                name, format_labels(labels), value))
+                else:
+                    for (key, labels), (count, total) in \
+                            self.summaries.items():
+                        if key == name:
+                            labels = format_labels(labels)
+                            lines.append("{0}_count{1} {2}".format(
+                                name, labels, count))
+                            lines.append("{0}_sum{1} {2}".format(
+                                name, labels, total))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace('"', '\\"'))
+        for key, value in labels
+    )
+
+
+def get_sink():
+    sink = current_app.extensions.get('cart_metrics_sink')
+    if sink is None:
+        sink = current_app.extensions.setdefault(
+            'cart_metrics_sink',
+            import_string(current_app.config.get(
+                'CART_METRICS_SINK',
+                'quokka.modules.cart.instrumentation.PrometheusSink'
+            ))()
+        )
+    return sink
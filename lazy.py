@@ -0,0 +1,29 @@
+# coding: utf-8
+"""
+Views are imported on their first request instead of when the blueprint
+is registered, so CLI commands and workers loading the app do not import
+views, models and processors they never use.
+"""
+from werkzeug.utils import cached_property, import_string
+
+
+class LazyView(object):
+    """
+    stand-in view function for `import_name` (a View class), methods
+    must be given as flask can not read them from the unloaded class
+    """
+
+    def __init__(self, import_name, name, methods=('GET',)):
+        # flask takes the endpoint from __name__ like in View.as_view
+        self.__module__ = import_name.rsplit('.', 1)[0]
+        self.__name__ = name
+        self.import_name = import_name
+        self.name = name
+        self.methods = list(methods)
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name).as_view(self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
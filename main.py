@@ -1,31 +1,46 @@
 # coding: utf-8
 
+from flask.ext.login import user_logged_in
 from quokka.core.app import QuokkaModule
-from .views import CartView, SetItemView, RemoveItemView, SetProcessorView, \
-    CheckoutView, HistoryView, ConfirmationView, NotificationView
-from .functions import get_current_cart
+from .functions import get_current_cart, merge_cart_on_login
+from .cache import cached_fragment
+from .lazy import LazyView
 
 module = QuokkaModule("cart", __name__,
                       template_folder="templates", static_folder="static")
 
 # template globals
 module.add_app_template_global(get_current_cart)
+module.add_app_template_global(cached_fragment)
+
+# anonymous cart merged with the user carts on login
+user_logged_in.connect(merge_cart_on_login)
+
+
+def view(name, endpoint, methods=('GET', 'POST')):
+    views = __name__.rpartition('.')[0] + '.views'
+    return LazyView('%s.%s' % (views, name), endpoint, methods)
 
 
 # urls
-module.add_url_rule('/cart/', view_func=CartView.as_view('cart'))
-module.add_url_rule('/cart/setitem/', view_func=SetItemView.as_view('setitem'))
+module.add_url_rule('/cart/', view_func=view('CartView', 'cart', ['GET']))
+module.add_url_rule('/cart/setitem/', view_func=view('SetItemView', 'setitem'))
 module.add_url_rule('/cart/removeitem/',
-                    view_func=RemoveItemView.as_view('removeitem'))
+                    view_func=view('RemoveItemView', 'removeitem'))
 module.add_url_rule('/cart/setprocessor/',
-                    view_func=SetProcessorView.as_view('setprocessor'))
+                    view_func=view('SetProcessorView', 'setprocessor'))
+module.add_url_rule('/cart/setcoupon/',
+                    view_func=view('SetCouponView', 'setcoupon'))
 module.add_url_rule('/cart/checkout/',
-                    view_func=CheckoutView.as_view('checkout'))
-module.add_url_rule('/cart/history/', view_func=HistoryView.as_view('history'))
+                    view_func=view('CheckoutView', 'checkout'))
+module.add_url_rule('/cart/history/',
+                    view_func=view('HistoryView', 'history', ['GET']))
 module.add_url_rule('/cart/confirmation/<identifier>/',
-                    view_func=ConfirmationView.as_view('confirmation'))
+                    view_func=view('ConfirmationView', 'confirmation'))
 module.add_url_rule('/cart/notification/<identifier>/',
-                    view_func=NotificationView.as_view('notification'))
+                    view_func=view('NotificationView', 'notification'))
+module.add_url_rule('/cart/metrics/',
+                    view_func=view('MetricsView', 'metrics', ['GET']))
 
 """
 Every url accepts ajax requests, and so do not redirect anything.
@@ -49,6 +64,8 @@ in ajax request it will return JSON as response
     - use 'next' to redirect or '/cart'
 /cart/setprocessor
     - receives a POST with processor identifier or id
+/cart/setcoupon
+    - receives a POST with coupon code, 'remove' to remove it
 /cart/setstatus
     - user can set only from abandoned to pending
     - if there is a current 'pending' cart it will be set to 'abandoned'
@@ -1,11 +1,18 @@
 # coding: utf-8
 
 import datetime
+import hashlib
 import logging
 import sys
+import time
+import uuid
 
+from bson import BSON, ObjectId
+from mongoengine import signals, Q
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from werkzeug.utils import import_string
-from flask import session, current_app
+from flask import session, current_app, redirect, has_request_context
 
 from quokka.utils.translation import _l
 from quokka.utils import get_current_user, lazy_str_setting
@@ -17,6 +24,17 @@ from quokka.core.models.signature import (
 from quokka.core.models.content import Content
 from quokka.modules.media.models import Image
 
+from .columns import ItemColumns
+from .stock import (take_stock, give_back_stock, OutOfStock,
+                    ReservationConflict)
+from .instrumentation import timed, record_cart_size
+from .promotions import (apply_promotions, is_valid_coupon, get_ref_id,
+                         get_index as get_promotion_index)
+from .snapshots import (get_snapshot, invalidate_snapshot, call,
+                        get_product_id)
+from .hotstore import get_hotstore, evict_carts, flush_hotstore, StaleCart
+from .prefetch import prefetch, get_declarations
+
 
 if sys.version_info.major == 3:
     from functools import reduce
@@ -68,6 +86,7 @@ class BaseProduct(BaseProductReference, Content):
     weight = db.FloatField()
     dimensions = db.StringField()
     extra_value = db.FloatField()
+    stock = db.IntField()  # None means stock is not controlled
 
     meta = {
         'allow_inheritance': True
@@ -83,7 +102,9 @@ class Item(Ordered, Dated, db.EmbeddedDocument):
     """
     uid = db.StringField()
     title = db.StringField(required=True, max_length=255)
-    description = db.StringField(required=True)
+    # description, link and dimensions are only stored for custom items,
+    # for products they are resolved on demand, see get_description
+    description = db.StringField()
     link = db.StringField()
     quantity = db.FloatField(default=1)
     unity_value = db.FloatField(required=True)
@@ -91,6 +112,8 @@ class Item(Ordered, Dated, db.EmbeddedDocument):
     weight = db.FloatField()
     dimensions = db.StringField()
     extra_value = db.FloatField()
+    # promotion discount per unit, already subtracted from extra_value
+    discount = db.FloatField()
     allowed_to_set = db.ListField(db.StringField(), default=['quantity'])
     pipeline = db.ListField(db.StringField(), default=[])
 
@@ -120,11 +143,58 @@ class Item(Ordered, Dated, db.EmbeddedDocument):
     def __unicode__(self):
         return u"{i.title} - {i.total_value}".format(i=self)
 
+    # values of Cart.get_columns
+    COLUMN_FIELDS = ('unity_value', 'extra_value', 'quantity', 'weight')
+
+    def __setattr__(self, name, value):
+        super(Item, self).__setattr__(name, value)
+        if name in self.COLUMN_FIELDS:
+            # counts in place changes so the cart columns know they are
+            # stale without comparing every item
+            cart = getattr(self, '_instance', None)
+            if cart is not None:
+                cart._items_changes = getattr(cart, '_items_changes', 0) + 1
+
+    def get_snapshot(self):
+        """cached snapshot of the product, see snapshots.py"""
+        return get_snapshot(self._data.get('product'))
+
     def get_uid(self):
-        try:
-            return self.product.get_uid()
-        except:
-            return self.uid
+        snapshot = self.get_snapshot()
+        return snapshot.uid if snapshot else self.uid
+
+    def resolve(self, attr, method):
+        """
+        value stored in the item or taken from reference/product,
+        the products of all the cart items are loaded in a single query
+        """
+        value = getattr(self, attr, None)
+        if value is not None:
+            return value
+        if self.reference is None:
+            value = call(self.get_snapshot(), method)
+            if value is not None:
+                return value
+        cart = getattr(self, '_instance', None)
+        if cart is not None and hasattr(cart, 'resolve_items'):
+            cart.resolve_items()
+        for ref in [self.reference, self.product]:
+            if ref and hasattr(ref, method):
+                value = getattr(ref, method)()
+                if value is not None:
+                    return value
+
+    def get_description(self):
+        return self.resolve('description', 'get_description')
+
+    def get_summary(self):
+        return self.resolve('description', 'get_summary')
+
+    def get_link(self):
+        return self.resolve('link', 'get_absolute_url')
+
+    def get_dimensions(self):
+        return self.resolve('dimensions', 'get_dimensions')
 
     @property
     def unity_plus_extra(self):
@@ -137,18 +207,21 @@ class Item(Ordered, Dated, db.EmbeddedDocument):
         return self.total_value
 
     def clean(self):
+        # only pricing and identity fields are copied to the cart
         mapping = [
             ('title', 'get_title'),
-            ('description', 'get_description'),
-            ('link', 'get_absolute_url'),
             ('unity_value', 'get_unity_value'),
             ('weight', 'get_weight'),
-            ('dimensions', 'get_dimensions'),
             ('extra_value', 'get_extra_value'),
             ('uid', 'get_uid'),
         ]
 
-        references = [self.reference, self.product]
+        mapping = [(attr, method) for attr, method in mapping
+                   if getattr(self, attr, None) is None]
+        if not mapping:
+            return
+
+        references = [self.reference, self.get_snapshot()]
 
         for ref in references:
             if not ref:
@@ -171,6 +244,9 @@ class Payment(db.EmbeddedDocument):
     status = db.StringField()
 
 
+_processor_classes = {}
+
+
 class Processor(Publishable, db.DynamicDocument):
     identifier = db.StringField(max_length=100, unique=True)
     module = db.StringField(max_length=255)
@@ -183,17 +259,34 @@ class Processor(Publishable, db.DynamicDocument):
     pipeline = db.ListField(db.StringField(max_length=255), default=[])
 
     def import_processor(self):
-        return import_string(self.module)
+        """
+        processor modules (and requires) are imported on first use
+        and the class is kept per process
+        """
+        processor_class = _processor_classes.get(self.module)
+        if processor_class is None:
+            self.check_imports()
+            processor_class = import_string(self.module)
+            _processor_classes[self.module] = processor_class
+        return processor_class
+
+    def check_imports(self):
+        for item in (self.requires or []):
+            import_string(item)
+        import_string(self.module)
 
     def get_instance(self, *args, **kwargs):
         if 'config' not in kwargs:
             kwargs['config'] = self.config
         kwargs['_record'] = self
-        return self.import_processor()(*args, **kwargs)
+        with timed('processor.get_instance'):
+            return self.import_processor()(*args, **kwargs)
 
     def clean(self, *args, **kwargs):
-        for item in (self.requires or []):
-            import_string(item)
+        # set False to save processors whose modules are not installed
+        # in the admin process (they are imported on first use)
+        if current_app.config.get('CART_PROCESSOR_CHECK_IMPORTS', True):
+            self.check_imports()
         super(Processor, self).clean(*args, **kwargs)
 
     def __unicode__(self):
@@ -221,10 +314,6 @@ class Processor(Publishable, db.DynamicDocument):
         except:
             return cls.objects.create(**default)
 
-    def save(self, *args, **kwargs):
-        self.import_processor()
-        super(Processor, self).save(*args, **kwargs)
-
 
 class Cart(Publishable, db.DynamicDocument):
     STATUS = (
@@ -263,6 +352,8 @@ class Cart(Publishable, db.DynamicDocument):
     reference_code = db.StringField()  # Reference code for filtering
     checkout_code = db.StringField()  # The UID for transaction checkout
     transaction_code = db.StringField()  # The UID for transaction
+    # a payment could not be appended to the ledger, see backfill
+    ledger_pending = db.BooleanField()
     requires_login = db.BooleanField(default=True)
     continue_shopping_url = db.StringField(
         default=lambda: current_app.config.get(
@@ -272,11 +363,29 @@ class Cart(Publishable, db.DynamicDocument):
     pipeline = db.ListField(db.StringField(), default=[])
     log = db.ListField(db.StringField(), default=[])
     config = db.DictField(default=lambda: {})
+    coupons = db.ListField(db.StringField(), default=[])
+    # order events pushed with the cart writes, relayed to OrderEvent,
+    # event_seq is the seq of the last relayed event (events.py)
+    outbox = db.ListField(db.DictField(), default=[])
+    event_seq = db.IntField(default=0)
 
     search_helper = db.StringField()
 
     meta = {
-        'ordering': ['-created_at']
+        'ordering': ['-created_at'],
+        'indexes': [
+            {'fields': ['status', 'updated_at']},
+            # history pages, see archive.all_carts
+            {'fields': ['belongs_to', '-created_at']},
+            # multikey, carts containing a product (repricing)
+            {'fields': ['items.product', 'status']},
+            {'fields': ['items.uid', 'status']},
+            # only carts with events waiting to be relayed
+            {'fields': ['outbox.id'],
+             'partialFilterExpression': {'outbox.id': {'$exists': True}}},
+            {'fields': ['ledger_pending'],
+             'partialFilterExpression': {'ledger_pending': True}}
+        ]
     }
 
     def send_response(self, response, identifier):
@@ -306,13 +415,76 @@ class Cart(Publishable, db.DynamicDocument):
         all the items and also the 'reference' if set
         """
         if self.status != status:
+            previous = self.status
             self.status = status
+            self.add_event('status_changed', previous=previous)
+            if status in Reservation.RELEASE_STATUS:
+                Reservation.release(cart=self)
 
         self.set_reference_statuses(status)
 
         if save:
             self.save()
 
+    def add_event(self, kind, **data):
+        """
+        queues an order event, the next save appends it to the outbox
+        with an atomic $push in the same write as the change (the outbox
+        list is never written whole, so concurrent writers and the relay
+        do not lose events), the relay gives it its seq, see events.py
+        """
+        data.update(id=ObjectId(), type=kind, status=self.status,
+                    total=self.total, at=datetime.datetime.now())
+        if not hasattr(self, '_events'):
+            self._events = []
+        self._events.append(data)
+
+    def save_events(self, events):
+        """
+        writes the changed fields of a stored cart and appends events to
+        its outbox in a single update, so a change (status...) is never
+        stored without its events
+        """
+        signals.pre_save.send(self.__class__, document=self)
+        self.updated_at = datetime.datetime.now()
+        self.validate()
+        sets, unsets = self._delta()
+        for name in ('outbox', 'event_seq'):
+            sets.pop(name, None)
+            unsets.pop(name, None)
+        update = {'$push': {'outbox': {'$each': events}}}
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = unsets
+        self._get_collection().update_one({'_id': self.pk}, update)
+        self._clear_changed_fields()
+        signals.post_save.send(self.__class__, document=self, created=False)
+
+    @classmethod
+    def get_event_pipeline(cls, kind, fields, entry, now):
+        """
+        update pipeline setting `fields` and appending the log entry and
+        an order event with the previous status to each cart
+        """
+        values = dict((name, {'$literal': value})
+                      for name, value in fields.items())
+        event = {
+            'id': {'$literal': ObjectId()},
+            'type': kind,
+            'previous': '$status',
+            'status': values.get('status', '$status'),
+            'total': '$total',
+            'at': now
+        }
+        values.update(
+            updated_at=now,
+            log={'$concatArrays': [{'$ifNull': ['$log', []]},
+                                   [{'$literal': entry}]]},
+            outbox={'$concatArrays': [{'$ifNull': ['$outbox', []]}, [event]]}
+        )
+        return [{'$set': values}]
+
     def set_reference_statuses(self, status):
         if self.reference and hasattr(self.reference, 'set_status'):
             self.reference.set_status(status, cart=self)
@@ -328,6 +500,174 @@ class Cart(Publishable, db.DynamicDocument):
             if hasattr(item, 'set_tax'):
                 item.set_tax(tax)
 
+    @classmethod
+    def bulk_update(cls, ids, msg, event=None, **update):
+        """
+        apply `update` to all the carts in `ids` using one update_many
+        per batch, every cart in the batch receives the same single
+        audit entry in its log and, if `event` is given, an order event
+        of that kind in the same write (only set__ updates).
+        yields the updated carts of each batch so hooks can be dispatched
+        """
+        batch_size = current_app.config.get('CART_BULK_BATCH_SIZE', 500)
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            evict_carts(batch)
+            now = datetime.datetime.now()
+            entry = u"{0},{1} ({2} carts)".format(now, msg, len(batch))
+            if event is None:
+                cls.objects(id__in=batch).update(
+                    push__log=entry, set__updated_at=now, **update
+                )
+            else:
+                fields = dict((key.replace('set__', '', 1), value)
+                              for key, value in update.items())
+                cls._get_collection().update_many(
+                    cls.objects(id__in=batch)._query,
+                    cls.get_event_pipeline(event, fields, entry, now)
+                )
+            logger.info(entry)
+            yield cls.objects(id__in=batch).select_related()
+
+    @classmethod
+    def bulk_set_status(cls, ids, status, by=None):
+        msg = u"Bulk status changed to: {0} by {1}".format(status, by)
+        count = 0
+        for carts in cls.bulk_update(ids, msg, event='status_changed',
+                                     set__status=status):
+            if status in Reservation.RELEASE_STATUS:
+                Reservation.release(cart__in=carts)
+            for cart in carts:
+                cart.set_reference_statuses(status)
+            count += len(carts)
+        return count
+
+    @classmethod
+    def bulk_set_published(cls, ids, published, by=None):
+        msg = u"Bulk published set to: {0} by {1}".format(published, by)
+        count = 0
+        for carts in cls.bulk_update(ids, msg, set__published=published):
+            references = {}
+            for cart in carts:
+                # only references which are publishable themselves
+                if cart.reference and \
+                        'published' in cart.reference._fields:
+                    references.setdefault(
+                        type(cart.reference), []
+                    ).append(cart.reference.pk)
+            for reference_class, pks in references.items():
+                reference_class.objects(id__in=pks).update(
+                    set__published=published
+                )
+            count += len(carts)
+        return count
+
+    @classmethod
+    def bulk_set_tax(cls, ids, tax, by=None):
+        tax = float(tax)
+        msg = u"Bulk tax set to: {0} by {1}".format(tax, by)
+        count = 0
+        for carts in cls.bulk_update(ids, msg, set__tax=tax):
+            for cart in carts:
+                cart.set_reference_tax(tax)
+                if cart.reference and hasattr(cart.reference, 'set_tax'):
+                    cart.reference.save()
+            count += len(carts)
+        return count
+
+    # recomputes item total_value and cart total like Cart.save does
+    TOTALS_PIPELINE = [
+        {'$set': {'items': {'$map': {
+            'input': '$items',
+            'as': 'item',
+            'in': {'$mergeObjects': ['$$item', {'total_value': {
+                '$multiply': [
+                    {'$add': [{'$ifNull': ['$$item.unity_value', 0]},
+                              {'$ifNull': ['$$item.extra_value', 0]}]},
+                    {'$cond': [
+                        {'$eq': [{'$ifNull': ['$$item.quantity', 0]}, 0]},
+                        1, '$$item.quantity'
+                    ]}
+                ]
+            }}]}
+        }}}},
+        {'$set': {'total': {'$sum': '$items.total_value'}}}
+    ]
+
+    @classmethod
+    def reprice_product(cls, product, progress=None):
+        """
+        updates unity and extra values of the items of `product` in all
+        pending carts, one array filter update plus one totals update
+        per batch (requires MongoDB 4.2). Items with a custom reference
+        keep their own price. When there are promotions the batch is
+        loaded to evaluate them again, see reapply_promotions.
+        progress(done, total) is called after each batch
+        """
+        unity_value = product.get_unity_value()
+        extra_value = product.get_extra_value()
+        item_query = {'product': product.pk, 'reference': None}
+        query = {'items': {'$elemMatch': item_query}, 'status': 'pending'}
+        promotions = get_promotion_index().size
+        collection = cls._get_collection()
+        flush_hotstore()
+        ids = [doc['_id'] for doc in collection.find(query, {'_id': 1})]
+        evict_carts(ids)
+        batch_size = current_app.config.get('CART_BULK_BATCH_SIZE', 500)
+        msg = u"Repriced {0} to: {1} + {2}".format(
+            product.get_uid(), unity_value, extra_value)
+        done = 0
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            now = datetime.datetime.now()
+            # as stored by mongo, so it can be matched by reapply_promotions
+            now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            collection.update_many(
+                dict(query, _id={'$in': batch}),
+                {
+                    '$set': {
+                        'items.$[item].unity_value': unity_value,
+                        'items.$[item].extra_value': extra_value,
+                        # the discount is evaluated again below
+                        'items.$[item].discount': 0,
+                        'updated_at': now
+                    },
+                    '$push': {'log': u"{0},{1}".format(now, msg)}
+                },
+                array_filters=[{'item.product': product.pk,
+                                'item.reference': None}]
+            )
+            if promotions:
+                cls.reapply_promotions(batch, now)
+            else:
+                collection.update_many(dict(query, _id={'$in': batch}),
+                                       cls.TOTALS_PIPELINE)
+            done += len(batch)
+            progress and progress(done, len(ids))
+        logger.info(u"{0} ({1} carts)".format(msg, done))
+        return done
+
+    @classmethod
+    def reapply_promotions(cls, ids, updated_at):
+        """
+        evaluates discounts and totals of the carts again in one bulk
+        write, carts saved after updated_at are skipped (their own save
+        did it)
+        """
+        requests = []
+        for cart in cls.objects(id__in=ids, updated_at=updated_at):
+            cart.apply_totals()
+            data = cart.to_mongo()
+            requests.append(UpdateOne(
+                {'_id': cart.pk, 'updated_at': updated_at},
+                {'$set': {'items': data.get('items', []),
+                          'extra_costs': data.get('extra_costs', {}),
+                          'total': cart.total}}
+            ))
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
     def addlog(self, msg, save=True):
         try:
             self.log.append(u"{0},{1}".format(datetime.datetime.now(), msg))
@@ -365,15 +705,18 @@ class Cart(Publishable, db.DynamicDocument):
         session.permanent = current_app.config.get(
             "CART_PERMANENT_SESSION", True)
         try:
-            cart = cls.objects(id=session.get('cart_id'), status='pending')
+            cart = cls.from_hotstore(session.get('cart_id'))
+            if cart is None:
+                cart = cls.objects(id=session.get('cart_id'),
+                                   status='pending')
 
-            if not cart:
-                raise cls.DoesNotExist('A pending cart not found')
+                if not cart:
+                    raise cls.DoesNotExist('A pending cart not found')
 
-            if no_dereference:
-                cart = cart.no_dereference()
+                if no_dereference:
+                    cart = cart.no_dereference()
 
-            cart = cart.first()
+                cart = cart.first()
 
             save and cart.save()
 
@@ -386,18 +729,254 @@ class Cart(Publishable, db.DynamicDocument):
 
         return cart
 
+    def apply_totals(self):
+        """promotion discounts, item totals and cart total"""
+        if self.status == 'pending':
+            apply_promotions(self)
+        columns = self.get_columns(refresh=True)
+        for item, line_total in zip(self.items, columns.line_totals):
+            item.total_value = float(line_total)
+        self.total = columns.total
+
     def assign(self):
         self.belongs_to = self.belongs_to or get_current_user()
 
+    def get_columns(self, refresh=False):
+        """
+        columnar view of the items values, built once per items mutation
+        and shared by save, processors and templates. Mutations through
+        set_item/remove_item drop it, in place changes of quantities or
+        prices are detected by is_stale
+        """
+        columns = getattr(self, '_columns', None)
+        changes = getattr(self, '_items_changes', 0)
+        if refresh or columns is None or \
+                columns.is_stale(self.items, changes):
+            for item in self.items:
+                item.clean()
+            columns = self._columns = ItemColumns(
+                self.items, getattr(self, '_items_changes', 0))
+        return columns
+
+    @property
+    def columns(self):
+        return self.get_columns()
+
+    def resolve_items(self, refresh=False):
+        """
+        dereferences the products of all items in a single query,
+        used to resolve the display fields which are not stored in items
+        """
+        if refresh or not getattr(self, '_items_resolved', False):
+            self._items_resolved = True
+            self.select_related(max_depth=2)
+
+    @classmethod
+    def compact_items(cls, collection=None):
+        """
+        unsets the display fields copied to product items by older versions,
+        custom items (without product) keep them. Returns modified count
+        """
+        collection = collection or cls._get_collection()
+        fields = ('description', 'link', 'dimensions')
+        result = collection.update_many(
+            {'items': {'$elemMatch': {
+                'product': {'$ne': None},
+                '$or': [{field: {'$exists': True}} for field in fields]
+            }}},
+            {'$unset': {'items.$[item].%s' % field: '' for field in fields}},
+            array_filters=[{'item.product': {'$ne': None}}]
+        )
+        return result.modified_count
+
     def save(self, *args, **kwargs):
-        self.total = sum([item.total for item in self.items])
+        """
+        pending carts are written to the hot store when it is enabled,
+        durable=True (or any other status) writes to mongo
+        """
+        durable = kwargs.pop('durable', False)
+        self.prepare_save()
+        events = getattr(self, '_events', None) or []
+        self._events = []
+        try:
+            self.write_changes(durable, events, *args, **kwargs)
+        except Exception:
+            self._events = events + self._events
+            raise
+        record_cart_size(self)
+        self.set_reference_statuses(self.status)
+
+    def write_changes(self, durable, events, *args, **kwargs):
+        """
+        writes the cart where save decided, events go in the same write:
+        carts with events skip the hot store
+        """
+        hotstore = get_hotstore()
+        if hotstore and self.id and self.status == 'pending' and \
+                not durable and not events:
+            self.updated_at = datetime.datetime.now()
+            self.validate()
+            with timed('cart.save.hot'):
+                hotstore.put(str(self.id), BSON.encode(self.to_mongo()))
+            self._hot = True
+        elif hotstore and getattr(self, '_hot', False):
+            # the whole hot copy becomes durable, unless mongo changed
+            since = self.updated_at
+            self.updated_at = datetime.datetime.now()
+            self.validate()
+            hotstore.pop(str(self.id))
+            self._hot = False
+            with timed('cart.save'):
+                written = hotstore.write(BSON.encode(self.to_mongo()), since,
+                                         events)
+            if not written:
+                raise StaleCart("cart %s changed meanwhile" % self.id)
+            self._clear_changed_fields()
+        elif events and self.pk and not self._created:
+            with timed('cart.save'):
+                self.save_events(events)
+        else:
+            if events:
+                # a new cart is inserted whole, with its events
+                self.outbox = list(self.outbox or []) + events
+            with timed('cart.save'):
+                super(Cart, self).save(*args, **kwargs)
+
+    def prepare_save(self):
+        """computed fields (discounts, totals, owner) written by save"""
+        self.apply_totals()
         self.assign()
         self.reference_code = self.get_uid()
         self.search_helper = self.get_search_helper()
         if not self.id:
             self.published = True
-        super(Cart, self).save(*args, **kwargs)
-        self.set_reference_statuses(self.status)
+
+    @classmethod
+    def merge_carts(cls, user, cart_id=None, retries=3):
+        """
+        merges the anonymous cart (cart_id) and the pending carts of user
+        into the most recent pending cart of user: items are combined by
+        uid (quantities added) and reservations moved. One ordered bulk
+        write merges the cart, only if it did not change since it was
+        read (the merge starts over otherwise), and abandons each losing
+        cart under the same condition, then their reservations are moved.
+        Returns the merged cart, None if there is no cart
+        """
+        owned = list(cls.objects(belongs_to=user, status='pending')
+                     .only('id').order_by('-updated_at'))
+        ids = [cart.pk for cart in owned]
+        if cart_id and cart_id not in [str(pk) for pk in ids]:
+            ids.append(cart_id)
+        if not ids:
+            return None
+        # mongo is the source of truth while merging
+        evict_carts(ids)
+        carts = dict(
+            (str(cart.pk), cart)
+            for cart in cls.objects(id__in=ids, status='pending')
+            if cart.belongs_to is None or cart.belongs_to == user
+        )
+        ordered = [carts[str(pk)] for pk in ids if str(pk) in carts]
+        if not ordered:
+            return None
+
+        winner, losers = ordered[0], ordered[1:]
+        for loser in losers:
+            for item in loser.items:
+                current = winner.items.filter(uid=item.uid).first()
+                if current is not None:
+                    current.quantity = float(current.quantity or 1) + \
+                        float(item.quantity or 1)
+                else:
+                    winner.items.append(Item._from_son(item.to_mongo()))
+            for code in loser.coupons:
+                if code not in winner.coupons:
+                    winner.coupons.append(code)
+        winner.belongs_to = user
+        winner._columns = None
+        winner.prepare_save()
+
+        now = datetime.datetime.now()
+        # as stored by mongo, so the abandoned carts can be matched
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        loser_ids = [loser.pk for loser in losers]
+        entry = u"{0},Merged carts {1} on login".format(
+            now, ", ".join(str(pk) for pk in loser_ids))
+        data = winner.to_mongo()
+        update = dict((field, data.get(field)) for field in (
+            'items', 'coupons', 'extra_costs', 'total', 'belongs_to',
+            'reference_code', 'search_helper'
+        ))
+        pipeline = cls.get_event_pipeline(
+            'status_changed', {'status': 'abandoned'},
+            u"{0},Merged into {1}".format(now, winner.pk), now
+        )
+        # a winner changed meanwhile does not match and its upsert fails
+        # on the duplicate _id, which stops the ordered bulk before the
+        # losers are touched
+        writes = [UpdateOne(
+            {'_id': winner.pk, 'status': 'pending',
+             'updated_at': winner.updated_at},
+            {'$set': dict(update, updated_at=now), '$push': {'log': entry}},
+            upsert=True
+        )]
+        writes.extend(
+            UpdateOne({'_id': loser.pk, 'status': 'pending',
+                       'updated_at': loser.updated_at}, pipeline)
+            for loser in losers
+        )
+        try:
+            cls._get_collection().bulk_write(writes)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 or error['index'] != 0
+                   for error in e.details['writeErrors']):
+                raise
+            # changed by another request while merging
+            if retries:
+                return cls.merge_carts(user, cart_id, retries - 1)
+            logger.warning(u"Could not merge carts {0}".format(ids))
+            return None
+        winner.updated_at = now
+        winner.log.append(entry)
+
+        abandoned = [cart.pk for cart in cls.objects(
+            id__in=loser_ids, status='abandoned', updated_at=now
+        ).only('id')]
+        for pk in set(loser_ids) - set(abandoned):
+            logger.warning(u"Cart {0} changed while merged into "
+                           u"{1}".format(pk, winner.pk))
+        Reservation.transfer(abandoned, winner.pk)
+
+        session['cart_id'] = str(winner.pk)
+        session.pop('cart_pipeline_index', None)
+        session.pop('cart_pipeline_args', None)
+        return winner
+
+    @classmethod
+    def from_hotstore(cls, cart_id):
+        """pending cart from the hot store or None"""
+        hotstore = get_hotstore()
+        data = hotstore and cart_id and hotstore.get(str(cart_id))
+        if not data:
+            return None
+        cart = cls._from_son(BSON(data).decode())
+        if cart.status == 'pending':
+            cart._hot = True
+            return cart
+
+    def get_revision(self):
+        """
+        fingerprint of everything that changes what is charged,
+        it changes whenever items, prices or costs change
+        """
+        parts = [str(self.id), str(self.shipping_cost),
+                 repr(sorted((self.extra_costs or {}).items()))]
+        parts.extend(
+            u"{i.uid}:{i.quantity}:{i.unity_value}:{i.extra_value}".format(
+                i=item)
+            for item in self.items
+        )
+        return hashlib.sha1(u"|".join(parts).encode('utf-8')).hexdigest()
 
     def get_search_helper(self):
         if not self.belongs_to:
@@ -408,23 +987,30 @@ class Cart(Publishable, db.DynamicDocument):
             user.email or ""
         ])
 
+    def reserve_item(self, product, quantity):
+        """
+        reserves product (document or snapshot) stock for this cart,
+        returns False when there is not enough stock
+        """
+        controls_stock = getattr(product, 'controls_stock', None)
+        if controls_stock is None:
+            controls_stock = getattr(product, 'stock', None) is not None
+        if not controls_stock or \
+                not current_app.config.get('CART_RESERVE_STOCK', True):
+            return True
+        return Reservation.reserve(self, product, int(quantity)) is not False
+
     def get_item(self, uid):
         # MongoEngine/mongoengine#503
         return self.items.get(uid=uid)
 
     def set_item(self, **kwargs):
+        snapshot = None
         if 'product' in kwargs:
-            if not isinstance(kwargs['product'], Content):
-                try:
-                    kwargs['product'] = Content.objects.get(
-                        id=kwargs['product'])
-                except Content.DoesNotExist:
-                    kwargs['product'] = None
-
-        uid = kwargs.get(
-            'uid',
-            kwargs['product'].get_uid() if kwargs.get('product') else None
-        )
+            snapshot = get_snapshot(kwargs['product'])
+            kwargs['product'] = snapshot and snapshot.get_reference()
+
+        uid = kwargs.get('uid', snapshot.uid if snapshot else None)
 
         if not uid:
             self.addlog("Cannot add item without an uid %s" % kwargs)
@@ -433,18 +1019,27 @@ class Cart(Publishable, db.DynamicDocument):
         item = self.get_item(uid)
 
         kwargs = Item.normalize(kwargs)
+        self._columns = None
 
         if not item:
             # items should only be added if there is a product (for safety)
             if not kwargs.get('product'):
                 self.addlog("there is no product to add item")
                 return
+            if not self.reserve_item(snapshot, kwargs.get('quantity', 1)):
+                self.addlog("out of stock %s" % snapshot.pk)
+                return
             allowed = ['product', 'quantity']
             item = self.items.create(
                 **{k: v for k, v in kwargs.items() if k in allowed}
             )
             self.addlog("New item created %s" % item, save=False)
         else:
+            item_snapshot = item.get_snapshot()
+            if 'quantity' in kwargs and item_snapshot and \
+                    not self.reserve_item(item_snapshot, kwargs['quantity']):
+                self.addlog("out of stock %s" % item_snapshot.pk)
+                return item
             # update only allowed attributes
             item = self.items.update(
                 {k: v for k, v in kwargs.items() if k in item.allowed_to_set},
@@ -457,27 +1052,88 @@ class Cart(Publishable, db.DynamicDocument):
                 self.remove_item(**kwargs)
 
         self.save()
-        self.reload()
+        if not getattr(self, '_hot', False):
+            self.reload()
+        self._items_resolved = False
         return item
 
     def remove_item(self, **kwargs):
+        products = [item._data.get('product')
+                    for item in self.items.filter(**kwargs)]
+        products = [get_product_id(product) for product in products
+                    if product is not None]
+        if products and self.id:
+            Reservation.release(cart=self, product__in=products)
         deleted = self.items.delete(**kwargs)
+        self._columns = None
+        self._items_resolved = False
         if self.reference and hasattr(self.reference, 'remove_item'):
             self.reference.remove_item(**kwargs)
         return deleted
 
     def checkout(self, processor=None, *args, **kwargs):
+        processor_instance = self.start_checkout(processor, *args, **kwargs)
+        attempt = CheckoutAttempt.begin(self, processor_instance)
+        if attempt and not attempt.owner:
+            return attempt.wait_replay()
+
+        try:
+            with timed('processor.validate'):
+                valid = processor_instance.validate()
+            if not valid:
+                self.invalid_checkout()
+            with timed('processor.process'):
+                response = processor_instance.process()
+        except Exception as e:
+            attempt and attempt.abandon(processor_instance, e)
+            raise
+
+        attempt and attempt.complete(processor_instance)
+        self.finish_checkout()
+        session.pop('cart_id', None)
+        return response
+
+    def start_checkout(self, processor=None, *args, **kwargs):
         self.set_processor(processor)
+        if getattr(self, '_hot', False):
+            # checkout always works on the durable cart
+            self.save(durable=True)
         processor_instance = self.processor.get_instance(self, *args, **kwargs)
-        if processor_instance.validate():
-            response = processor_instance.process()
-            self.status = 'checked_out'
-            self.save()
-            session.pop('cart_id', None)
-            return response
-        else:
-            self.addlog("Cart did not validate")
-            raise Exception("Cart did not validate")  # todo: specialize this
+        self.reserve_items()
+        return processor_instance
+
+    def invalid_checkout(self):
+        self.addlog("Cart did not validate")
+        raise Exception("Cart did not validate")  # todo: specialize this
+
+    def finish_checkout(self):
+        """commits the reservations and moves the cart to checked_out"""
+        Reservation.objects(cart=self).update(
+            set__committed=True, unset__expires_at=True
+        )
+        self.status = 'checked_out'
+        self.add_event('checked_out', previous='pending',
+                       checkout_code=self.checkout_code)
+        self.save()
+
+    def reserve_items(self):
+        """
+        makes sure every item has its stock reserved before checkout,
+        reservations may have expired while the cart was idle
+        """
+        reserved = {
+            reservation['product']: reservation['quantity']
+            for reservation in Reservation._get_collection().find(
+                {'cart': self.pk}, {'product': 1, 'quantity': 1}
+            )
+        }
+        for item in self.items:
+            product = item.get_snapshot()
+            quantity = int(item.quantity or 1)
+            if product and reserved.get(product.pk) != quantity \
+                    and not self.reserve_item(product, quantity):
+                self.addlog("out of stock %s" % product.pk)
+                raise OutOfStock(item.title)
 
     def get_items_pipeline(self):
         if not self.items:
@@ -502,8 +1158,32 @@ class Cart(Publishable, db.DynamicDocument):
 
         pipelines = self.build_pipeline()
         index = session.get('cart_pipeline_index', 0)
-        pipeline = import_string(pipelines[index])
-        return pipeline(self, pipelines, index)._preprocess()
+        steps = [import_string(path) for path in pipelines[index:]]
+        processor = self.processor and self.processor.import_processor()
+        # everything the remaining chain declared, in one pass
+        prefetch(self, get_declarations(processor, *steps))
+        return steps[0](self, pipelines, index)._preprocess()
+
+    def set_coupon(self, code):
+        """
+        adds a coupon code if there is a promotion running for it,
+        the caller saves the cart (which applies the promotions)
+        """
+        code = (code or '').strip().upper()
+        if not code or code in self.coupons:
+            return code in self.coupons
+        if not is_valid_coupon(code):
+            self.addlog("invalid coupon %s" % code, save=False)
+            return False
+        self.coupons.append(code)
+        self.addlog("Coupon set %s" % code, save=False)
+        return True
+
+    def remove_coupon(self, code):
+        code = (code or '').strip().upper()
+        if code in self.coupons:
+            self.coupons.remove(code)
+            self.addlog("Coupon removed %s" % code, save=False)
 
     def set_processor(self, processor=None):
         if not self.processor:
@@ -527,3 +1207,665 @@ class Cart(Publishable, db.DynamicDocument):
 
     def get_available_processors(self):
         return Processor.objects(published=True)
+
+    def get_items_cache_key(self):
+        """
+        the items table changes with the cart revision and with the
+        products shown (titles, summaries...), see bump_products
+        """
+        return (self.get_revision(), RegistryVersion.current('products'))
+
+    def get_processors_cache_key(self):
+        """
+        the processor selector changes with the processors registry and
+        the processor selected in this cart
+        """
+        return (RegistryVersion.current('processors'),
+                get_ref_id(self, 'processor'))
+
+
+class CartProfile(db.Document):
+    """Sampled stacks of a single profiled cart request"""
+    endpoint = db.StringField(max_length=255)
+    cart_id = db.StringField(max_length=255)
+    pipeline_index = db.IntField()
+    duration = db.FloatField()
+    samples = db.IntField()
+    stacks = db.StringField()  # collapsed stacks, flamegraph ready
+    created_at = db.DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        'ordering': ['-created_at'],
+        'max_documents': 1000,
+        'max_size': 64 * 1024 * 1024
+    }
+
+    def __unicode__(self):
+        return u"{p.endpoint} {p.cart_id} {p.duration}".format(p=self)
+
+
+class CheckoutInProgress(Exception):
+    """a duplicate checkout could not replay the first one, retry later"""
+
+
+class CheckoutAttempt(db.Document):
+    """
+    Idempotency record of a checkout, the key is derived from the cart
+    revision and the processor so only the first of concurrent duplicate
+    checkouts reaches the gateway, the others wait and replay its
+    response for CART_CHECKOUT_REPLAY_TTL seconds
+    """
+    key = db.StringField(max_length=255, unique=True)
+    cart_id = db.StringField(max_length=255)
+    status = db.StringField(default='running')  # running, done
+    replay = db.DictField(default=lambda: {})
+    expires_at = db.DateTimeField()
+
+    meta = {
+        'indexes': [
+            'cart_id',
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+    owner = False
+
+    @classmethod
+    def begin(cls, cart, processor_instance):
+        if not getattr(processor_instance, 'idempotent', False):
+            return
+        key = hashlib.sha1(u"{0}:{1}".format(
+            cart.get_revision(), cart.processor.identifier
+        ).encode('utf-8')).hexdigest()
+        ttl = current_app.config.get('CART_CHECKOUT_REPLAY_TTL', 1800)
+        # the TTL monitor compares with UTC
+        now = datetime.datetime.utcnow()
+
+        for retry in range(2):
+            try:
+                attempt = cls(
+                    key=key, cart_id=str(cart.id),
+                    expires_at=now + datetime.timedelta(seconds=ttl)
+                ).save(force_insert=True)
+                attempt.owner = True
+                return attempt
+            except db.NotUniqueError:
+                attempt = cls.objects(key=key).first()
+                if attempt and attempt.expires_at > now:
+                    return attempt
+                # expired but not yet removed by the TTL monitor
+                cls.objects(key=key, expires_at__lte=now).delete()
+
+    def complete(self, processor_instance):
+        replay = processor_instance.get_checkout_replay()
+        if not replay:
+            self.delete()
+            return
+        self.update(set__status='done', set__replay=replay)
+
+    def abandon(self, processor_instance, error):
+        """
+        the checkout failed, the attempt is deleted so retries reach the
+        gateway again, unless the gateway call is still running over its
+        budget: then retries wait for it and replay its late response
+        """
+        late = getattr(error, 'late', None)
+        if late is None:
+            self.delete()
+            return
+        app = current_app._get_current_object()
+
+        def reconcile(call):
+            with app.app_context():
+                replay = None
+                if call.error is None:
+                    replay = processor_instance.reconcile_checkout(
+                        call.value)
+                if not replay:
+                    self.delete()
+                    return
+                self.update(set__status='done', set__replay=replay)
+                # the request gave up on the cart, finish it here
+                cart = Cart.objects(id=self.cart_id).first()
+                if cart and cart.status == 'pending':
+                    if replay.get('checkout_code'):
+                        cart.checkout_code = replay['checkout_code']
+                    cart.finish_checkout()
+                logger.info("Late checkout of cart %s reconciled",
+                            self.cart_id)
+
+        late.add_done_callback(reconcile)
+
+    def wait_replay(self):
+        timeout = current_app.config.get('CART_CHECKOUT_WAIT', 30)
+        deadline = time.time() + timeout
+        attempt = self
+        while attempt and attempt.status != 'done':
+            if time.time() > deadline:
+                raise CheckoutInProgress("Checkout still in progress")
+            time.sleep(0.1)
+            attempt = CheckoutAttempt.objects(key=self.key).first()
+        if not attempt:
+            raise CheckoutInProgress("Checkout failed, please try again")
+        return attempt.get_response()
+
+    def get_response(self):
+        if has_request_context():
+            session.pop('cart_id', None)
+        return redirect(self.replay['redirect'])
+
+    @classmethod
+    def get_replay(cls, cart_id):
+        """cached response of a finished checkout of the cart"""
+        if not cart_id:
+            return
+        attempt = cls.objects(
+            cart_id=cart_id, status='done',
+            expires_at__gt=datetime.datetime.utcnow()
+        ).first()
+        return attempt and attempt.get_response()
+
+
+class Reservation(db.Document):
+    """
+    Stock held by a cart, pending reservations expire after
+    CART_RESERVATION_TTL minutes and are given back by sweep_expired,
+    checked out carts have their reservations committed
+    """
+    RELEASE_STATUS = ('abandoned', 'cancelled')
+    RETRIES = 10
+
+    # deleted carts release their reservations, see release_reservations
+    cart = db.ReferenceField(Cart)
+    product = db.ReferenceField(Content)
+    quantity = db.IntField(default=0)
+    committed = db.BooleanField(default=False)
+    expires_at = db.DateTimeField()
+    sweep = db.StringField()
+
+    meta = {
+        'indexes': [
+            # one live reservation (sweep null) per cart and product,
+            # swept ones waiting to be deleted do not block new ones
+            {'fields': ['cart', 'product', 'sweep'], 'unique': True},
+            {'fields': ['committed', 'expires_at']},
+            'sweep'
+        ]
+    }
+
+    @classmethod
+    def reserve(cls, cart, product, quantity):
+        """
+        sets the reserved quantity of product for the cart,
+        returns False if there is not enough stock
+        and None if the product does not control stock
+        """
+        product_id = product.pk  # document or snapshot
+        reservations = cls._get_collection()
+        stock = Content._get_collection()
+        ttl = current_app.config.get('CART_RESERVATION_TTL', 30)
+        key = {'cart': cart.pk, 'product': product_id}
+
+        for retry in range(cls.RETRIES):
+            current = reservations.find_one(dict(key, sweep=None),
+                                            {'quantity': 1})
+            previous = current['quantity'] if current else 0
+            delta = quantity - previous
+            # stock is taken first and given back if the write loses
+            if delta > 0:
+                taken = take_stock(stock, product_id, delta)
+                if not taken:
+                    return taken
+            # the reservation only changes if nobody changed it meanwhile
+            expected = dict(key, quantity=previous, sweep=None)
+            try:
+                if quantity:
+                    written = reservations.update_one(expected, {'$set': {
+                        'quantity': quantity,
+                        'committed': False,
+                        'expires_at': datetime.datetime.now() +
+                        datetime.timedelta(minutes=ttl)
+                    }}, upsert=True)
+                    won = bool(written.matched_count or written.upserted_id)
+                else:
+                    won = not current or reservations.delete_one(
+                        expected).deleted_count
+            except DuplicateKeyError:
+                won = False
+            if won:
+                if delta < 0:
+                    give_back_stock(stock, {product_id: -delta})
+                return True
+            if delta > 0:
+                give_back_stock(stock, {product_id: delta})
+        raise ReservationConflict(
+            "reservation of %s changed concurrently" % product_id)
+
+    @classmethod
+    def release(cls, **kwargs):
+        """
+        gives back the stock of all reservations matching the filters,
+        reservations are claimed with a token first so concurrent releases
+        never give back the same reservation twice
+        """
+        token = uuid.uuid4().hex
+        claimed = cls.objects(sweep=None, **kwargs).update(set__sweep=token)
+        if not claimed:
+            return 0
+
+        quantities = {
+            group['_id']: group['quantity']
+            for group in cls._get_collection().aggregate([
+                {'$match': {'sweep': token}},
+                {'$group': {'_id': '$product',
+                            'quantity': {'$sum': '$quantity'}}}
+            ])
+        }
+        give_back_stock(Content._get_collection(), quantities)
+        cls.objects(sweep=token).delete()
+        return claimed
+
+    @classmethod
+    def transfer(cls, cart_ids, cart_id):
+        """
+        moves the reservations of cart_ids to cart_id, quantities of the
+        products already reserved by cart_id are added, the stock taken
+        stays the same
+        """
+        collection = cls._get_collection()
+        for reservation in collection.find({'cart': {'$in': cart_ids},
+                                            'sweep': None}):
+            merged = collection.update_one(
+                {'cart': cart_id, 'product': reservation['product'],
+                 'sweep': None},
+                {'$inc': {'quantity': reservation['quantity']}}
+            )
+            if merged.matched_count:
+                collection.delete_one({'_id': reservation['_id']})
+            else:
+                collection.update_one({'_id': reservation['_id']},
+                                      {'$set': {'cart': cart_id}})
+
+    @classmethod
+    def sweep_expired(cls):
+        return cls.release(committed=False,
+                           expires_at__lt=datetime.datetime.now())
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def local_to_utc(value):
+    """naive local datetime (Cart dates) into naive UTC (ledger dates)"""
+    if value is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(
+        time.mktime(value.timetuple())
+    ).replace(microsecond=value.microsecond)
+
+
+class PaymentRecord(db.Document):
+    """
+    Append only ledger of payment events, one record per transaction
+    status reported by a gateway (the same status notified twice is
+    recorded once), fields follow the Payment embedded document.
+    Settlement and fee reports query it by confirmed_at ranges instead
+    of parsing Cart.log
+    """
+    CONFIRMED_STATUS = ('confirmed', 'completed')
+    GROUPS = ('day', 'status', 'payment_system', 'method')
+
+    key = db.StringField(max_length=255, unique=True)
+    cart_id = db.StringField(max_length=255)
+    reference_code = db.StringField(max_length=255)
+    uid = db.StringField(max_length=255)  # transaction code
+    payment_system = db.StringField(max_length=100)
+    method = db.StringField()
+    status = db.StringField()
+    source = db.StringField()  # notification, confirmation, backfill
+    value = db.FloatField()
+    fee = db.FloatField()
+    net_value = db.FloatField()
+    extra_value = db.FloatField()
+    date = db.DateTimeField()
+    confirmed_at = db.DateTimeField()
+
+    meta = {
+        'indexes': [
+            'cart_id',
+            'uid',
+            {'fields': ['status', 'confirmed_at']},
+            'confirmed_at'
+        ]
+    }
+
+    def __unicode__(self):
+        return u"{r.uid} {r.status} {r.value}".format(r=self)
+
+    @classmethod
+    def build(cls, cart, payment_system, source, status=None, uid=None,
+              value=None, fee=None, net_value=None, extra_value=None,
+              method=None, date=None):
+        status = status or cart.status
+        uid = uid or getattr(cart, 'transaction_code', None)
+        date = date or datetime.datetime.utcnow()
+        key = u"{0}:{1}:{2}".format(payment_system, uid or cart.id, status)
+        return cls(
+            key=hashlib.sha1(key.encode('utf-8')).hexdigest(),
+            cart_id=str(cart.id),
+            reference_code=cart.reference_code,
+            uid=uid,
+            payment_system=payment_system,
+            method=method,
+            status=status,
+            source=source,
+            value=value if value is not None else cart.total,
+            fee=fee,
+            net_value=net_value,
+            extra_value=extra_value,
+            date=date,
+            confirmed_at=date if status in cls.CONFIRMED_STATUS else None
+        )
+
+    @classmethod
+    def from_response(cls, cart, response, payment_system, source,
+                      status=None):
+        """
+        record of a gateway transaction response (PagSeguro fields),
+        status is the one reported, mapped to the cart STATUS
+        """
+        method = getattr(response, 'paymentMethod', None)
+        if isinstance(method, dict):
+            method = method.get('type')
+        return cls.build(
+            cart, payment_system, source, status=status,
+            uid=getattr(response, 'code', None),
+            value=to_float(getattr(response, 'grossAmount', None)),
+            fee=to_float(getattr(response, 'feeAmount', None)),
+            net_value=to_float(getattr(response, 'netAmount', None)),
+            extra_value=to_float(getattr(response, 'extraAmount', None)),
+            method=method and str(method)
+        )
+
+    def to_payment(self):
+        return Payment(
+            uid=self.uid, payment_system=self.payment_system,
+            method=self.method, value=self.value,
+            extra_value=self.extra_value, date=self.date,
+            confirmed_at=self.confirmed_at, status=self.status
+        )
+
+    @classmethod
+    def append(cls, records):
+        """
+        bulk inserts records, the ones already in the ledger are
+        skipped, returns the number inserted
+        """
+        documents = []
+        for record in records:
+            record.validate()
+            documents.append(record.to_mongo())
+        if not documents:
+            return 0
+        try:
+            result = cls._get_collection().insert_many(documents,
+                                                       ordered=False)
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000
+                   for error in e.details['writeErrors']):
+                raise
+            return e.details['nInserted']
+
+    @classmethod
+    def settlement(cls, start, end, by=('day', 'status')):
+        """
+        totals of the records confirmed in [start, end) (UTC) grouped
+        by any of GROUPS
+        """
+        group = {}
+        for name in by:
+            if name not in cls.GROUPS:
+                raise ValueError("Unknown group %s" % name)
+            if name == 'day':
+                group[name] = {'$dateToString': {'format': '%Y-%m-%d',
+                                                 'date': '$confirmed_at'}}
+            else:
+                group[name] = '$' + name
+        pipeline = [
+            {'$match': {'confirmed_at': {'$gte': start, '$lt': end}}},
+            {'$group': {
+                '_id': group,
+                'count': {'$sum': 1},
+                'value': {'$sum': '$value'},
+                'fee': {'$sum': '$fee'},
+                'net_value': {'$sum': '$net_value'}
+            }},
+            {'$sort': {'_id': 1}}
+        ]
+        return list(cls._get_collection().aggregate(pipeline))
+
+    @classmethod
+    def backfill(cls, batch_size=1000, all_carts=False):
+        """
+        ledger records of the carts whose payment could not be appended
+        (ledger_pending), or of all carts with a transaction code, for
+        the payments processed before the ledger existed
+        """
+        fields = ['reference_code', 'transaction_code', 'status', 'total',
+                  'tax', 'updated_at', 'processor']
+        query = {'transaction_code__nin': [None, '']}
+        if not all_carts:
+            query['ledger_pending'] = True
+        carts = Cart.objects(**query).only(
+            *fields).no_dereference().batch_size(batch_size)
+        identifiers = dict(
+            (processor.pk, processor.identifier)
+            for processor in Processor.objects.only('identifier')
+        )
+        inserted = 0
+        batch = []
+        for cart in carts:
+            processor = cart.processor
+            batch.append(cls.build(
+                cart, identifiers.get(getattr(processor, 'id', processor)),
+                'backfill', fee=cart.tax or None,
+                date=local_to_utc(cart.updated_at)
+            ))
+            if len(batch) >= batch_size:
+                inserted += cls.append_backfill(batch)
+                batch = []
+        return inserted + cls.append_backfill(batch)
+
+    @classmethod
+    def append_backfill(cls, records):
+        inserted = cls.append(records)
+        Cart.objects(
+            id__in=[record.cart_id for record in records],
+            ledger_pending=True
+        ).update(unset__ledger_pending=True)
+        return inserted
+
+
+class OrderEvent(db.Document):
+    """
+    Order events relayed from Cart.outbox, `number` (given by the relay
+    from its cursor counter) is the delivery order, events of a cart are
+    relayed in seq order
+    """
+    cart_id = db.StringField(max_length=255)
+    seq = db.IntField()
+    number = db.IntField()
+    type = db.StringField(max_length=100)
+    data = db.DictField()
+    created_at = db.DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        'indexes': [
+            {'fields': ['cart_id', 'seq'], 'unique': True},
+            {'fields': ['number'], 'unique': True, 'sparse': True}
+        ]
+    }
+
+    def __unicode__(self):
+        return u"{e.cart_id} {e.seq} {e.type}".format(e=self)
+
+
+class EventCursor(db.Document):
+    """
+    Position of a sink in the OrderEvent feed, deliveries resume after
+    the event number `position`. Failed or throttled sinks are retried
+    after retry_at. The relay cursor counts the numbers given (counter)
+    """
+    name = db.StringField(max_length=100, unique=True)
+    position = db.IntField()
+    counter = db.IntField(default=0)
+    delivered = db.IntField(default=0)
+    failures = db.IntField(default=0)
+    retry_at = db.DateTimeField()
+    lease_until = db.DateTimeField()
+    error = db.StringField()
+
+    @classmethod
+    def acquire(cls, name, seconds):
+        """
+        leases the cursor for `seconds`, only one relay/dispatch runs at
+        a time, returns the cursor or None if it is leased
+        """
+        now = datetime.datetime.now()
+        until = now + datetime.timedelta(seconds=seconds)
+        # mongo keeps milliseconds
+        until = until.replace(microsecond=until.microsecond // 1000 * 1000)
+        try:
+            cls.objects(
+                Q(lease_until=None) | Q(lease_until__lt=now),
+                name=name
+            ).update_one(set__lease_until=until, upsert=True)
+        except db.NotUniqueError:
+            return None
+        return cls.objects(name=name, lease_until=until).first()
+
+    def release(self):
+        self.update(unset__lease_until=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+_registry_versions = {}
+
+
+class RegistryVersion(db.Document):
+    """
+    Version counter of a registry (promotions, processors...) bumped on
+    every change, so per process caches know when to rebuild
+    """
+    name = db.StringField(max_length=100, unique=True)
+    version = db.IntField(default=0)
+
+    @classmethod
+    def bump(cls, name):
+        cls.objects(name=name).update_one(inc__version=1, upsert=True)
+        _registry_versions.pop(name, None)
+
+    @classmethod
+    def current(cls, name):
+        """
+        version of the registry, read from the database at most every
+        CART_REGISTRY_VERSION_INTERVAL seconds per process
+        """
+        interval = current_app.config.get('CART_REGISTRY_VERSION_INTERVAL', 5)
+        now = time.time()
+        cached = _registry_versions.get(name)
+        if cached and now - cached[1] < interval:
+            return cached[0]
+        record = cls.objects(name=name).only('version').first()
+        version = record.version if record else 0
+        _registry_versions[name] = (version, now)
+        return version
+
+
+class Promotion(Publishable, db.DynamicDocument):
+    """
+    Discount rule, rules with products or channels discount the matching
+    items (Item.discount), rules without them discount the cart
+    (extra_costs['promotions']). Rules with a coupon only apply to carts
+    where the coupon was set. See promotions.py
+    """
+    KINDS = (
+        ("percentage", _l("Percentage")),
+        ("fixed", _l("Fixed amount")),
+        ("buy_x_get_y", _l("Buy X get Y")),
+    )
+    title = db.StringField(max_length=255, required=True)
+    kind = db.StringField(choices=KINDS, default='percentage')
+    value = db.FloatField(default=0)  # percent or amount per unit
+    buy = db.IntField()
+    get = db.IntField()
+    products = db.ListField(db.ReferenceField(Content))
+    channels = db.ListField(db.ReferenceField('Channel'))
+    coupon = db.StringField(max_length=100)
+    starts_at = db.DateTimeField()
+    ends_at = db.DateTimeField()
+    # keys of the compiled index, filled from products and channels
+    uids = db.ListField(db.StringField())
+    channel_ids = db.ListField(db.StringField())
+
+    meta = {
+        'indexes': ['published', 'coupon']
+    }
+
+    def clean(self):
+        self.uids = [
+            product.get_uid() if hasattr(product, 'get_uid')
+            else str(product.id)
+            for product in self.products if product
+        ]
+        self.channel_ids = [str(channel.id) for channel in self.channels
+                            if channel]
+        self.coupon = (self.coupon or '').strip().upper() or None
+        if self.kind == 'buy_x_get_y':
+            if not (self.buy and self.get):
+                raise db.ValidationError("buy and get are required")
+            if not (self.uids or self.channel_ids):
+                raise db.ValidationError(
+                    "buy X get Y needs products or channels")
+
+    def __unicode__(self):
+        return self.title
+
+
+def bump_promotions(sender, document, **kwargs):
+    RegistryVersion.bump('promotions')
+
+
+def bump_processors(sender, document, **kwargs):
+    RegistryVersion.bump('processors')
+
+
+def bump_products(sender, document, **kwargs):
+    """any product change, Content has no common product subclass"""
+    if hasattr(document, 'get_unity_value'):
+        RegistryVersion.bump('products')
+
+
+signals.post_save.connect(bump_promotions, sender=Promotion)
+signals.post_delete.connect(bump_promotions, sender=Promotion)
+signals.post_save.connect(bump_processors, sender=Processor)
+signals.post_delete.connect(bump_processors, sender=Processor)
+signals.post_save.connect(bump_products)
+signals.post_delete.connect(bump_products)
+
+
+def release_reservations(sender, document, **kwargs):
+    """gives back the stock of a cart being deleted"""
+    Reservation.release(cart=document)
+
+
+signals.pre_delete.connect(release_reservations, sender=Cart)
+signals.post_save.connect(invalidate_snapshot)
+signals.post_delete.connect(invalidate_snapshot)
@@ -2,7 +2,10 @@
 from flask import session, request
 from werkzeug.utils import import_string
 from quokka.core.templates import render_template
-from quokka.utils import get_current_user
+from ..breaker import GatewayUnavailable
+from ..models import CheckoutInProgress
+from ..instrumentation import timed
+from ..prefetch import get_prefetched
 
 
 class PipelineOverflow(Exception):
@@ -10,6 +13,8 @@ class PipelineOverflow(Exception):
 
 
 class CartPipeline(object):
+    # data loaded before the chain runs, see prefetch.py
+    prefetch = ()
 
     def __init__(self, cart, pipeline, index=0):
         self.cart = cart  # Cart object
@@ -28,12 +33,16 @@ class CartPipeline(object):
         if session.get('cart_pipeline_args'):
             del session['cart_pipeline_args']
 
+    def get_prefetched(self, name):
+        return get_prefetched(name, self.cart)
+
     def render(self, *args, **kwargs):
         return render_template(*args, **kwargs)
 
     def _preprocess(self):
         try:
-            ret = self.process()  # the only overridable method
+            with timed('pipeline.%s' % self.__class__.__name__):
+                ret = self.process()  # the only overridable method
             if not ret:
                 ret = self.go()
             if isinstance(ret, CartPipeline):
@@ -43,7 +52,21 @@ class CartPipeline(object):
                 session['cart_pipeline_index'] = self.index
                 return ret
         except PipelineOverflow as e:
-            ret = self.cart.checkout()
+            try:
+                ret = self.cart.checkout()
+            except GatewayUnavailable as e:
+                # fast fallback, cart stays pending so user can retry
+                self.cart.addlog(u"Gateway unavailable: {0}".format(e))
+                return render_template('cart/pipeline_error.html',
+                                       pipeline=self,
+                                       error=e,
+                                       unavailable=True)
+            except CheckoutInProgress as e:
+                # a duplicate submit, keep the session so user can retry
+                return render_template('cart/pipeline_error.html',
+                                       pipeline=self,
+                                       error=e,
+                                       in_progress=True)
             self.del_sessions()
             return ret
         except Exception as e:
@@ -84,9 +107,11 @@ class StartPipeline(CartPipeline):
     This is the first pipeline executed upon cart checkout
     it only checks if user has email and name
     """
+    prefetch = ('user',)
+
     def process(self):
         self.cart.addlog("StartPipeline")
-        user = get_current_user()
+        user = self.get_prefetched('user')
         if not all([user.name, user.email]):
             confirm = request.form.get('cart_complete_information')
 
@@ -0,0 +1,222 @@
+# coding: utf-8
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+from .base import CartPipeline
+from ..breaker import get_breaker
+
+logger = logging.getLogger()
+
+
+class ShippingError(Exception):
+    pass
+
+
+class RateTable(object):
+    """
+    In memory rate table indexed by destination zone and weight bracket
+
+    zones: {"south": ["80", "81", "9"], ...} postal code prefixes per zone
+    rates: {"south": [[1, 10.0], [5, 18.5], [30, 42.0]], ...}
+           [max weight, cost] brackets per zone
+    """
+
+    def __init__(self, zones=None, rates=None, default_zone=None):
+        self.default_zone = default_zone
+        # longest prefixes first so "801" wins over "80"
+        self.prefixes = sorted(
+            ((prefix, zone)
+             for zone, prefixes in (zones or {}).items()
+             for prefix in prefixes),
+            key=lambda pair: len(pair[0]), reverse=True
+        )
+        self.brackets = {}
+        for zone, brackets in (rates or {}).items():
+            brackets = sorted(brackets)
+            self.brackets[zone] = (
+                [float(weight) for weight, cost in brackets],
+                [float(cost) for weight, cost in brackets]
+            )
+
+    def get_zone(self, postal_code):
+        postal_code = "".join(
+            char for char in str(postal_code or "") if char.isalnum()
+        )
+        for prefix, zone in self.prefixes:
+            if postal_code.startswith(prefix):
+                return zone
+        return self.default_zone
+
+    def get_cost(self, zone, weight):
+        if zone not in self.brackets:
+            raise ShippingError("No rates for zone %s" % zone)
+        weights, costs = self.brackets[zone]
+        index = bisect_left(weights, weight)
+        if index >= len(weights):
+            raise ShippingError("Weight %s over the limit for %s" % (
+                weight, zone))
+        return costs[index]
+
+
+class BaseCarrier(object):
+    """
+    Adapter for carrier quote APIs, quote() must return the cost as float.
+    Quotes go through a circuit breaker whose budget is the timeout in
+    seconds (CART_SHIPPING_BREAKER configures the rest), see get_quote
+    """
+
+    def __init__(self, table, timeout=None, **config):
+        self.table = table
+        self.timeout = timeout
+        self.config = config
+
+    def quote(self, destination, weight, dimensions):
+        raise NotImplementedError()
+
+    def get_quote(self, destination, weight, dimensions):
+        config = dict(current_app.config.get('CART_SHIPPING_BREAKER', {}))
+        if self.timeout:
+            config.setdefault('budget', self.timeout)
+        breaker = get_breaker('shipping.%s' % self.__class__.__name__,
+                              config)
+        return breaker.call(self.quote, destination, weight, dimensions)
+
+
+class TableCarrier(BaseCarrier):
+    """local stub carrier which quotes from the in memory rate table"""
+
+    def quote(self, destination, weight, dimensions):
+        zone = self.table.get_zone(destination.get('postal_code'))
+        return self.table.get_cost(zone, weight)
+
+
+_lock = threading.Lock()
+
+
+def get_state():
+    """rate table and memoized quotes are kept per application"""
+    state = current_app.extensions.get('cart_shipping')
+    if state is None:
+        with _lock:
+            state = current_app.extensions.setdefault('cart_shipping', {
+                'table': None,
+                'quotes': OrderedDict()
+            })
+    return state
+
+
+def get_rate_table():
+    state = get_state()
+    if state['table'] is None:
+        config = current_app.config
+        state['table'] = RateTable(
+            config.get('CART_SHIPPING_ZONES'),
+            config.get('CART_SHIPPING_RATES'),
+            config.get('CART_SHIPPING_DEFAULT_ZONE')
+        )
+    return state['table']
+
+
+def reload_rate_table():
+    state = get_state()
+    with _lock:
+        state['table'] = None
+        state['quotes'].clear()
+    return get_rate_table()
+
+
+def get_carrier():
+    config = current_app.config
+    carrier = config.get('CART_SHIPPING_CARRIER',
+                         'quokka.modules.cart.pipelines.shipping:TableCarrier')
+    return import_string(carrier)(
+        get_rate_table(),
+        timeout=config.get('CART_SHIPPING_TIMEOUT', 5),
+        **config.get('CART_SHIPPING_CARRIER_CONFIG', {})
+    )
+
+
+def get_dimensions(item):
+    """
+    stored dimensions (custom items) or the ones of the cached product
+    snapshot, quotes never dereference products
+    """
+    if item.dimensions:
+        return item.dimensions
+    snapshot = item.get_snapshot()
+    return snapshot.dimensions if snapshot else None
+
+
+def get_fingerprint(cart):
+    destination = cart.shipping_data or {}
+    parts = [
+        "%.3f" % cart.get_columns().total_weight,
+        str(destination.get('postal_code', '')),
+        str(destination.get('country', '')),
+    ]
+    parts.extend(sorted(
+        "%s:%s" % (get_dimensions(item) or '', item.quantity)
+        for item in cart.items
+    ))
+    return hashlib.sha1(u"|".join(parts).encode('utf-8')).hexdigest()
+
+
+def get_shipping_quote(cart):
+    """
+    quotes are memoized by the fingerprint of cart weight, dimensions
+    and destination, so recalculating on every cart view is cheap.
+    if the carrier fails the rate table is used as fallback
+    """
+    table = get_rate_table()
+    quotes = get_state()['quotes']
+    fingerprint = get_fingerprint(cart)
+
+    with _lock:
+        if fingerprint in quotes:
+            quotes[fingerprint] = quotes.pop(fingerprint)
+            return quotes[fingerprint]
+
+    destination = cart.shipping_data or {}
+    weight = cart.get_columns().total_weight
+    dimensions = [get_dimensions(item) for item in cart.items]
+    try:
+        cost = get_carrier().get_quote(destination, weight, dimensions)
+    except Exception as e:
+        logger.error("Carrier quote failed, using rate table: %s" % e)
+        cost = TableCarrier(table).quote(destination, weight, dimensions)
+
+    with _lock:
+        quotes[fingerprint] = cost
+        while len(quotes) > current_app.config.get(
+                'CART_SHIPPING_QUOTE_CACHE_SIZE', 10000):
+            quotes.popitem(last=False)
+
+    return cost
+
+
+class ShippingPipeline(CartPipeline):
+    """
+    Sets cart.shipping_cost from the quote for the cart destination
+    (cart.shipping_data['postal_code']) and total weight
+    """
+    prefetch = ('products', 'shipping')
+
+    def process(self):
+        self.cart.addlog("ShippingPipeline", save=False)
+        try:
+            cost = get_shipping_quote(self.cart)
+        except ShippingError as e:
+            self.cart.addlog("Shipping not available: %s" % e)
+            return self.render('cart/pipeline_error.html',
+                               pipeline=self, error=e)
+
+        self.cart.shipping_cost = cost
+        self.cart.shipping_data['cost'] = "%.2f" % cost
+        self.cart.addlog("Shipping cost set to: %s" % cost)
+        return self.go()
@@ -0,0 +1,123 @@
+# coding: utf-8
+"""
+Declared data dependencies of pipeline steps and processors
+
+CartPipeline subclasses and processors list the data they need in the
+`prefetch` class attribute, e.g. prefetch = ('user', 'products').
+Before the chain runs, process_pipeline collects the declarations of
+the remaining steps and of the processor and loads all of them in one
+pass. Products come from the snapshot cache, the other references of
+the cart (belongs_to, processor) are dereferenced together, one query
+per collection. The results live in a
+per request context (flask.g) and steps read them with get_prefetched,
+which loads undeclared names on demand.
+
+Custom loaders are registered with @loader('name') or in
+CART_PREFETCH_LOADERS = {'name': 'import.path:function'}, a loader
+receives the cart and returns the value.
+"""
+from flask import current_app, g, has_app_context
+from werkzeug.utils import import_string
+from quokka.utils import get_current_user
+
+from .instrumentation import timed
+from .snapshots import get_snapshot
+
+LOADERS = {}
+
+
+def loader(name):
+    def decorator(func):
+        LOADERS[name] = func
+        return func
+    return decorator
+
+
+def get_loader(name):
+    custom = current_app.config.get('CART_PREFETCH_LOADERS', {})
+    if name in custom:
+        return import_string(custom[name])
+    if name not in LOADERS:
+        raise KeyError("No prefetch loader for %s" % name)
+    return LOADERS[name]
+
+
+@loader('user')
+def load_user(cart):
+    return get_current_user()
+
+
+@loader('references')
+def load_references(cart):
+    """products, belongs_to and processor in one batched dereference"""
+    cart.resolve_items()
+    return True
+
+
+@loader('products')
+def load_products(cart):
+    """
+    {uid: ProductSnapshot} of the cart items, the raw references are
+    enough: only products missing from the snapshot cache are loaded
+    """
+    snapshots = {}
+    for item in cart.items:
+        snapshot = get_snapshot(item._data.get('product'))
+        if snapshot is not None:
+            snapshots[snapshot.uid] = snapshot
+    return snapshots
+
+
+@loader('belongs_to')
+def load_belongs_to(cart):
+    get_prefetched('references', cart)
+    return cart.belongs_to
+
+
+@loader('processor')
+def load_processor(cart):
+    get_prefetched('references', cart)
+    return cart.processor
+
+
+@loader('shipping')
+def load_shipping(cart):
+    from .pipelines.shipping import get_rate_table
+    return get_rate_table()
+
+
+def get_context(cart):
+    """data prefetched for the cart in the current request"""
+    if not has_app_context():
+        return {}
+    context = getattr(g, 'cart_prefetch', None)
+    if context is None or context['cart_id'] != cart.id:
+        context = g.cart_prefetch = {'cart_id': cart.id, 'data': {}}
+    return context['data']
+
+
+def get_declarations(*declarers):
+    """prefetch names of steps/processors (classes or instances)"""
+    names = []
+    for declarer in declarers:
+        for name in getattr(declarer, 'prefetch', ()):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def prefetch(cart, names):
+    """loads every name not yet in the context of the cart"""
+    data = get_context(cart)
+    with timed('prefetch'):
+        for name in names:
+            if name not in data:
+                data[name] = get_loader(name)(cart)
+    return data
+
+
+def get_prefetched(name, cart):
+    data = get_context(cart)
+    if name not in data:
+        data[name] = get_loader(name)(cart)
+    return data[name]
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""
+Asyncio processor contract (python 3 only)
+
+AsyncBaseProcessor adds awaitable versions of the processor methods
+(validate_async, process_async, notification_async, confirmation_async)
+next to the sync ones, so a single process serving carts from an event
+loop (an asyncio server or worker awaiting aio.checkout) can hold many
+outstanding gateway calls. The regular flask views are sync and keep
+calling the sync methods, an async processor works in both.
+Sync processors are adapted by ensure_async.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (current_app, copy_current_request_context,
+                   has_request_context, session)
+
+from .base import BaseProcessor
+from ..breaker import BudgetExceeded, CircuitOpen
+from ..instrumentation import timed
+
+_executors = {}
+
+
+def get_executor():
+    workers = current_app.config.get('CART_ASYNC_GATEWAY_WORKERS', 64)
+    if workers not in _executors:
+        _executors[workers] = ThreadPoolExecutor(max_workers=workers)
+    return _executors[workers]
+
+
+def with_context(func):
+    """runs func in the executor with the current flask context"""
+    if has_request_context():
+        return copy_current_request_context(func)
+    app = current_app._get_current_object()
+
+    def wrapper():
+        with app.app_context():
+            return func()
+    return wrapper
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(), with_context(functools.partial(func, *args, **kwargs))
+    )
+
+
+async def call_breaker(breaker, func, *args, **kwargs):
+    """
+    awaits func run by the pool of the breaker, the loop is woken up by
+    the worker so the call takes a single thread
+    """
+    if not breaker.allow():
+        raise CircuitOpen("%s circuit is open" % breaker.name)
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+    call = breaker.pool.submit(
+        with_context(functools.partial(func, *args, **kwargs)))
+    call.add_done_callback(lambda call: loop.call_soon_threadsafe(
+        lambda: done.done() or done.set_result(None)))
+    try:
+        await asyncio.wait_for(done, breaker.budget)
+    except asyncio.TimeoutError:
+        breaker.record(False)
+        raise BudgetExceeded(
+            "gateway call took more than %ss" % breaker.budget,
+            None if call.cancel() else call)
+    if call.error is not None:
+        breaker.record(False)
+        raise call.error
+    breaker.record(True)
+    return call.value
+
+
+def run_async(coroutine):
+    """
+    drives a coroutine to completion in a new loop, for scripts and
+    workers, not for request handlers (it would block the worker anyway)
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncBaseProcessor(BaseProcessor):
+    """
+    by default the awaitable methods run the sync ones in the gateway
+    thread pool, override them to await the gateway directly
+    """
+
+    async def validate_async(self, *args, **kwargs):
+        return await run_blocking(self.validate, *args, **kwargs)
+
+    async def process_async(self, *args, **kwargs):
+        return await run_blocking(self.process, *args, **kwargs)
+
+    async def notification_async(self):
+        return await run_blocking(self.notification)
+
+    async def confirmation_async(self):
+        return await run_blocking(self.confirmation)
+
+    async def call_gateway_async(self, name, func, *args, **kwargs):
+        """
+        awaitable gateway call, blocking gateway libs run in the pool of
+        the circuit breaker (when it has a budget) or in a thread pool of
+        CART_ASYNC_GATEWAY_WORKERS, override to use an async http client
+        """
+        breaker = self.get_breaker()
+        if breaker is not None and breaker.pool is not None:
+            with timed('gateway.%s' % name, kind='gateway'):
+                return await call_breaker(breaker, func, *args, **kwargs)
+        return await run_blocking(self.call_gateway, name, func,
+                                  *args, **kwargs)
+
+
+class SyncProcessorAdapter(AsyncBaseProcessor):
+    """exposes a sync processor through the async contract"""
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def __getattr__(self, name):
+        return getattr(self.processor, name)
+
+    def validate(self, *args, **kwargs):
+        return self.processor.validate(*args, **kwargs)
+
+    def process(self, *args, **kwargs):
+        return self.processor.process(*args, **kwargs)
+
+    def notification(self):
+        return self.processor.notification()
+
+    def confirmation(self):
+        return self.processor.confirmation()
+
+
+def ensure_async(processor):
+    if isinstance(processor, AsyncBaseProcessor):
+        return processor
+    return SyncProcessorAdapter(processor)
+
+
+async def checkout(cart, processor=None, *args, **kwargs):
+    """
+    awaitable version of Cart.checkout, needs an app (or request)
+    context, the database steps run in the executor with it
+    """
+    from ..models import CheckoutAttempt
+    processor_instance = await run_blocking(
+        cart.start_checkout, processor, *args, **kwargs)
+    attempt = await run_blocking(CheckoutAttempt.begin, cart,
+                                 processor_instance)
+    if attempt and not attempt.owner:
+        return await run_blocking(attempt.wait_replay)
+
+    async_instance = ensure_async(processor_instance)
+    try:
+        if not await async_instance.validate_async():
+            await run_blocking(cart.invalid_checkout)
+        response = await async_instance.process_async()
+    except Exception as e:
+        if attempt:
+            await run_blocking(attempt.abandon, processor_instance, e)
+        raise
+
+    if attempt:
+        await run_blocking(attempt.complete, processor_instance)
+    await run_blocking(cart.finish_checkout)
+    if has_request_context():
+        session.pop('cart_id', None)
+    return response
@@ -1,7 +1,19 @@
 # coding: utf-8
+import logging
+
+from ..breaker import get_breaker
+from ..instrumentation import timed
+
+logger = logging.getLogger()
 
 
 class BaseProcessor(object):
+    # idempotent processors have their checkout response replayed
+    # to duplicate checkouts, see get_checkout_replay
+    idempotent = False
+    # data loaded before the checkout chain runs, see prefetch.py
+    prefetch = ()
+
     def __init__(self, cart, *args, **kwargs):
         self.cart = cart
         self.config = kwargs.get('config', {})
@@ -13,6 +25,71 @@ class BaseProcessor(object):
     def process(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def get_checkout_replay(self):
+        """
+        data to replay the checkout response: {'redirect': url, ...}
+        or None if the response can not be replayed
+        """
+        return None
+
+    def get_response_status(self, response):
+        """cart STATUS reported by a gateway transaction response"""
+        return None
+
+    def reconcile_checkout(self, response):
+        """
+        replay data for a gateway checkout response that arrived after
+        the request gave up waiting for it (see CheckoutAttempt.abandon)
+        """
+        return None
+
+    def get_breaker(self):
+        """
+        circuit breaker configured in Processor.config['circuit_breaker']
+        e.g: {"failure_rate": 0.5, "window": 20, "min_calls": 5,
+              "reset_timeout": 30, "budget": 10, "workers": 10}
+        """
+        config = (self.config or {}).get('circuit_breaker')
+        if config and self._record:
+            return get_breaker(self._record.identifier, config)
+
+    def call_gateway(self, name, func, *args, **kwargs):
+        """
+        every remote call to the gateway should go through here,
+        raises GatewayUnavailable when the circuit is open or the call
+        exceeds the latency budget
+        """
+        breaker = self.get_breaker()
+        with timed('gateway.%s' % name, kind='gateway'):
+            if breaker is None:
+                return func(*args, **kwargs)
+            return breaker.call(func, *args, **kwargs)
+
+    def record_payment(self, response, source):
+        """
+        appends the transaction in response to the PaymentRecord ledger
+        and keeps its Payment in cart.payment up to date
+        """
+        from ..models import PaymentRecord
+        record = PaymentRecord.from_response(
+            self.cart, response,
+            self._record.identifier if self._record else None, source,
+            self.get_response_status(response)
+        )
+        payment = record.to_payment()
+        self.cart.payment = [
+            item for item in self.cart.payment if item.uid != payment.uid
+        ] + [payment]
+        try:
+            PaymentRecord.append([record])
+        except Exception as e:
+            # backfilled later from the cart by cart_ledger_backfill,
+            # saved with the cart by the caller
+            self.cart.ledger_pending = True
+            logger.error("Payment not recorded {0}: {1}".format(
+                record.uid, e))
+        return record
+
     def notification(self):
         return "notification"
 
@@ -0,0 +1,39 @@
+# coding: utf-8
+"""PagSeguro processor awaiting its gateway calls (python 3 only)"""
+from .aio import AsyncBaseProcessor
+from .pagseguro_processor import PagSeguroProcessor
+from ..breaker import GatewayUnavailable
+
+
+class AsyncPagSeguroProcessor(AsyncBaseProcessor, PagSeguroProcessor):
+
+    async def process_async(self, *args, **kwargs):
+        response = await self.call_gateway_async(
+            'checkout', self.pg.checkout, **self.get_checkout_params(**kwargs)
+        )
+        return self.handle_checkout(response)
+
+    async def notification_async(self):
+        code = self.get_notification_code()
+        if not code:
+            return "notification code not found"
+        try:
+            response = await self.call_gateway_async(
+                'check_notification', self.pg.check_notification, code
+            )
+        except GatewayUnavailable as e:
+            return self.notification_unavailable(code, e)
+        return self.handle_notification(response)
+
+    async def confirmation_async(self):
+        transaction_code = self.get_transaction_code()
+        response = None
+        if transaction_code:
+            try:
+                response = await self.call_gateway_async(
+                    'check_transaction', self.pg.check_transaction,
+                    transaction_code
+                )
+            except GatewayUnavailable as e:
+                return self.defer_confirmation(transaction_code, e)
+        return self.handle_confirmation(transaction_code, response)
@@ -1,16 +1,20 @@
 # coding: utf-8
 import logging
 from flask import redirect, request
-from pagseguro import PagSeguro
 from quokka.core.templates import render_template
 from .base import BaseProcessor
-from ..models import Cart
+from ..breaker import GatewayUnavailable
+from ..functions import send_task
 
 logger = logging.getLogger()
 
 
 class PagSeguroProcessor(BaseProcessor):
 
+    idempotent = True
+    prefetch = ('products',)
+    response = None
+
     STATUS_MAP = {
         "1": "checked_out",
         "2": "analysing",
@@ -29,6 +33,8 @@ class PagSeguroProcessor(BaseProcessor):
             raise ValueError("Config must be a dict")
         email = self.config.get('email')
         token = self.config.get('token')
+        # the SDK is only imported when the processor is used
+        from pagseguro import PagSeguro
         self.pg = PagSeguro(email=email, token=token)
         self.cart and self.cart.addlog(
             "PagSeguro initialized {}".format(self.__dict__)
@@ -42,15 +48,17 @@ class PagSeguroProcessor(BaseProcessor):
         if extra_costs:
             self.pg.extra_amount = "%.2f" % extra_costs
 
+        columns = self.cart.get_columns()
         self.pg.items = [
             {
                 "id": item.get_uid(),
                 "description": item.title[:100],
-                "amount": "%.2f" % item.unity_plus_extra,
+                "amount": "%.2f" % columns.unity_plus_extra[index],
                 "weight": item.weight,
                 "quantity": int(item.quantity or 1)
             }
-            for item in self.cart.items if item.total >= 0
+            for index, item in enumerate(self.cart.items)
+            if columns.line_totals[index] >= 0
         ]
 
         if hasattr(self.cart, 'redirect_url'):
@@ -66,10 +74,30 @@ class PagSeguroProcessor(BaseProcessor):
         self.cart.addlog("pagSeguro validated {}".format(self.pg.data))
         return True  # all data is valid
 
-    def process(self, *args, **kwargs):
+    def get_checkout_params(self, **kwargs):
         kwargs.update(self._record.config)
         kwargs.update(self.cart.config)
-        response = self.pg.checkout(**kwargs)
+        return kwargs
+
+    def process(self, *args, **kwargs):
+        response = self.call_gateway('checkout', self.pg.checkout,
+                                     **self.get_checkout_params(**kwargs))
+        return self.handle_checkout(response)
+
+    def get_checkout_replay(self):
+        if self.response is not None and not self.response.errors:
+            return {'redirect': self.response.payment_url,
+                    'checkout_code': self.response.code}
+
+    def get_response_status(self, response):
+        return self.STATUS_MAP.get(str(getattr(response, 'status', None)))
+
+    def reconcile_checkout(self, response):
+        self.response = response
+        return self.get_checkout_replay()
+
+    def handle_checkout(self, response):
+        self.response = response
         self.cart.addlog(
             (
                 "lib checkout data:{pg.data}\n"
@@ -93,12 +121,27 @@ class PagSeguroProcessor(BaseProcessor):
             return render_template("cart/checkout_error.html",
                                    response=response, cart=self.cart)
 
+    def get_notification_code(self):
+        return request.form.get('notificationCode')
+
     def notification(self):
-        code = request.form.get('notificationCode')
+        code = self.get_notification_code()
         if not code:
             return "notification code not found"
 
-        response = self.pg.check_notification(code)
+        try:
+            response = self.call_gateway('check_notification',
+                                         self.pg.check_notification, code)
+        except GatewayUnavailable as e:
+            return self.notification_unavailable(code, e)
+        return self.handle_notification(response)
+
+    def notification_unavailable(self, code, error):
+        # PagSeguro sends the notification again when it is not accepted
+        logger.error("Notification {0} not checked: {1}".format(code, error))
+        return "gateway unavailable", 503
+
+    def handle_notification(self, response):
         reference = getattr(response, 'reference', None)
         if not reference:
             return "reference not found"
@@ -109,6 +152,9 @@ class PagSeguroProcessor(BaseProcessor):
         status = getattr(response, 'status', None)
         transaction_code = getattr(response, 'code', None)
 
+        from ..models import Cart
+        from ..archive import restore_cart
+
         # get grossAmount to populate a payment with methods
         try:
             ref = reference.replace(prefix, '')
@@ -116,10 +162,14 @@ class PagSeguroProcessor(BaseProcessor):
                 reference_code=ref
             ) or Cart.objects.filter(id=ref)
 
-            if not qs:
-                return "Cart not found"
+            if qs:
+                self.cart = qs[0]
+            else:
+                # status changes of archived carts (e.g: refunds)
+                self.cart = restore_cart(reference_code=ref)
 
-            self.cart = qs[0]
+            if not self.cart:
+                return "Cart not found"
 
             self.cart.set_status(
                 self.STATUS_MAP.get(str(status), self.cart.status)
@@ -127,6 +177,7 @@ class PagSeguroProcessor(BaseProcessor):
 
             if transaction_code:
                 self.cart.transaction_code = transaction_code
+                self.record_payment(response, 'notification')
 
             msg = "Status changed to: %s" % self.cart.status
             self.cart.addlog(msg)
@@ -146,16 +197,41 @@ class PagSeguroProcessor(BaseProcessor):
             logger.error(msg)
             return msg
 
-    def confirmation(self):  # redirect_url
-        context = {}
+    def get_transaction_code(self):
         transaction_param = self.config.get(
             'transaction_param',
             self.pg.config.get('TRANSACTION_PARAM', 'transaction_id')
         )
-        transaction_code = request.args.get(transaction_param)
+        return request.args.get(transaction_param)
+
+    def confirmation(self):  # redirect_url
+        transaction_code = self.get_transaction_code()
+        response = None
+        if transaction_code:
+            try:
+                response = self.call_gateway('check_transaction',
+                                             self.pg.check_transaction,
+                                             transaction_code)
+            except GatewayUnavailable as e:
+                return self.defer_confirmation(transaction_code, e)
+        return self.handle_confirmation(transaction_code, response)
+
+    def defer_confirmation(self, transaction_code, error):
+        """
+        the transaction is reconciled later by a background task
+        """
+        logger.error("Confirmation {0} deferred: {1}".format(
+            transaction_code, error))
+        send_task('reconcile_transaction', self._record.identifier,
+                  transaction_code)
+        return render_template('cart/simple_confirmation.html',
+                               transaction_code=transaction_code,
+                               deferred=True)
+
+    def handle_confirmation(self, transaction_code, response):
+        context = {}
         if transaction_code:
             context['transaction_code'] = transaction_code
-            response = self.pg.check_transaction(transaction_code)
             logger.debug(response.xml)
             reference = getattr(response, 'reference', None)
             if not reference:
@@ -167,6 +243,8 @@ class PagSeguroProcessor(BaseProcessor):
 
             status = getattr(response, 'status', None)
 
+            from ..models import Cart
+
             # get grossAmount to populate a payment with methods
             try:
                 # self.cart = Cart.objects.get(
@@ -187,6 +265,7 @@ class PagSeguroProcessor(BaseProcessor):
                 )
 
                 self.cart.transaction_code = transaction_code
+                self.record_payment(response, 'confirmation')
                 msg = "Status changed to: %s" % self.cart.status
                 self.cart.addlog(msg)
                 context['cart'] = self.cart
@@ -0,0 +1,105 @@
+# coding: utf-8
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, request, session
+from flask.ext.security import current_user
+
+logger = logging.getLogger()
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a single thread from a background thread,
+    the output is in the collapsed format read by flamegraph tools
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+
+    def sample(self):
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (
+                    frame.f_globals.get('__name__', '?'), code.co_name
+                ))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self
+
+    def collapsed(self):
+        return "\n".join(
+            "%s %s" % (stack, count)
+            for stack, count in self.samples.most_common()
+        )
+
+
+def should_profile():
+    config = current_app.config
+    header = config.get('CART_PROFILE_HEADER', 'X-Cart-Profile')
+    if request.headers.get(header):
+        if current_user.is_authenticated() and current_user.has_role('admin'):
+            return True
+    rate = config.get('CART_PROFILE_SAMPLE_RATE')  # profile 1 in N
+    return bool(rate) and random.randint(1, rate) == 1
+
+
+@contextmanager
+def profile_request(endpoint, enabled=True):
+    """
+    profiles the request when asked by an admin through the header
+    or when it is sampled, otherwise it costs a header lookup.
+    Yields a dict, views which resolve the cart themselves (gateway
+    notifications have no session) set its cart_id and pipeline_index
+    """
+    profile = {}
+    if not enabled or not should_profile():
+        yield profile
+        return
+
+    from .models import CartProfile
+
+    profiler = SamplingProfiler(
+        threading.current_thread().ident,
+        current_app.config.get('CART_PROFILE_INTERVAL', 0.005)
+    ).start()
+    started = time.time()
+    try:
+        yield profile
+    finally:
+        profiler.stop()
+        try:
+            CartProfile.objects.create(
+                endpoint=endpoint,
+                cart_id=profile.get('cart_id', session.get('cart_id')),
+                pipeline_index=profile.get(
+                    'pipeline_index', session.get('cart_pipeline_index')),
+                duration=time.time() - started,
+                samples=sum(profiler.samples.values()),
+                stacks=profiler.collapsed()
+            )
+        except Exception as e:
+            logger.error("Could not store profile: %s" % e)
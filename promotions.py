@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+Promotion engine
+
+Published Promotion rules are compiled once per process into an in
+memory index keyed by product uid and channel id. The index is rebuilt
+when the 'promotions' RegistryVersion changes (every promotion save or
+delete bumps it), so evaluating a cart only touches the rules of its
+items plus the cart wide rules.
+
+Item discounts are stored per unit in Item.discount and subtracted from
+Item.extra_value, cart discounts go to cart.extra_costs['promotions'].
+"""
+import datetime
+import threading
+from collections import defaultdict
+
+from flask import current_app
+
+REGISTRY = 'promotions'
+
+
+class CompiledRule(object):
+    __slots__ = ('id', 'title', 'kind', 'value', 'buy', 'get', 'coupon',
+                 'starts_at', 'ends_at')
+
+    def __init__(self, id, title, kind, value=0, buy=None, get=None,
+                 coupon=None, starts_at=None, ends_at=None):
+        self.id = id
+        self.title = title
+        self.kind = kind
+        self.value = float(value or 0)
+        self.buy = int(buy or 0)
+        self.get = int(get or 0)
+        self.coupon = coupon
+        self.starts_at = starts_at
+        self.ends_at = ends_at
+
+    @classmethod
+    def from_promotion(cls, promotion):
+        return cls(str(promotion.id), promotion.title, promotion.kind,
+                   promotion.value, promotion.buy, promotion.get,
+                   promotion.coupon, promotion.starts_at, promotion.ends_at)
+
+    def is_active(self, now, coupons):
+        if self.coupon and self.coupon not in coupons:
+            return False
+        if self.starts_at and now < self.starts_at:
+            return False
+        if self.ends_at and now >= self.ends_at:
+            return False
+        return True
+
+    def get_discount(self, unity_value, quantity):
+        """discount for a line of `quantity` units of `unity_value`"""
+        if self.kind == 'percentage':
+            return unity_value * quantity * min(self.value, 100) / 100
+        if self.kind == 'fixed':
+            return min(self.value, unity_value) * quantity
+        if self.kind == 'buy_x_get_y' and self.buy and self.get:
+            free = int(quantity // (self.buy + self.get)) * self.get
+            return free * unity_value
+        return 0.0
+
+    def get_cart_discount(self, subtotal):
+        if self.kind == 'percentage':
+            return subtotal * min(self.value, 100) / 100
+        if self.kind == 'fixed':
+            return self.value
+        return 0.0
+
+
+class PromotionIndex(object):
+
+    def __init__(self, version=None):
+        self.version = version
+        self.by_uid = defaultdict(list)
+        self.by_channel = defaultdict(list)
+        self.cart_rules = []
+        self.coupons = defaultdict(list)  # code: rules
+        self.size = 0
+
+    def add(self, rule, uids=(), channel_ids=()):
+        for uid in uids:
+            self.by_uid[uid].append(rule)
+        for channel_id in channel_ids:
+            self.by_channel[channel_id].append(rule)
+        if not uids and not channel_ids:
+            self.cart_rules.append(rule)
+        if rule.coupon:
+            self.coupons[rule.coupon].append(rule)
+        self.size += 1
+
+    def get_item_rules(self, uid, channel_id=None):
+        rules = self.by_uid.get(uid, [])
+        if channel_id and channel_id in self.by_channel:
+            rules = rules + self.by_channel[channel_id]
+        return rules
+
+    def evaluate(self, lines, coupons=(), now=None):
+        """
+        lines: [(uid, channel_id, unity_value, quantity), ...]
+        returns the discount of each line (the best rule wins, rules do
+        not stack) and the discount of the cart rules over the lines
+        """
+        now = now or datetime.datetime.now()
+        coupons = set(coupons)
+        discounts = []
+        subtotal = 0.0
+        for uid, channel_id, unity_value, quantity in lines:
+            best = 0.0
+            for rule in self.get_item_rules(uid, channel_id):
+                if rule.is_active(now, coupons):
+                    best = max(best, rule.get_discount(unity_value, quantity))
+            best = min(best, unity_value * quantity)
+            discounts.append(best)
+            subtotal += unity_value * quantity - best
+
+        cart_discount = 0.0
+        for rule in self.cart_rules:
+            if rule.is_active(now, coupons):
+                cart_discount = max(cart_discount,
+                                    rule.get_cart_discount(subtotal))
+        return discounts, min(cart_discount, subtotal)
+
+
+def compile_index(version=None):
+    from .models import Promotion
+    now = datetime.datetime.now()
+    index = PromotionIndex(version)
+    promotions = Promotion.objects(published=True).exclude(
+        'products', 'channels'
+    )
+    for promotion in promotions:
+        if promotion.ends_at and promotion.ends_at <= now:
+            continue
+        index.add(CompiledRule.from_promotion(promotion),
+                  promotion.uids, promotion.channel_ids)
+    return index
+
+
+_lock = threading.Lock()
+
+
+def get_index():
+    """compiled index of the current registry version, kept per app"""
+    from .models import RegistryVersion
+    version = RegistryVersion.current(REGISTRY)
+    index = current_app.extensions.get('cart_promotions')
+    if index is None or index.version != version:
+        with _lock:
+            index = current_app.extensions.get('cart_promotions')
+            if index is None or index.version != version:
+                index = compile_index(version)
+                current_app.extensions['cart_promotions'] = index
+    return index
+
+
+def is_valid_coupon(code, now=None):
+    """there is a promotion for the code running now"""
+    now = now or datetime.datetime.now()
+    return any(rule.is_active(now, (code,))
+               for rule in get_index().coupons.get(code, ()))
+
+
+def get_ref_id(document, name):
+    """id of a reference field without dereferencing it"""
+    value = document._data.get(name)
+    if value is None:
+        return None
+    return str(getattr(value, 'pk', None) or getattr(value, 'id', value))
+
+
+def get_channel_id(item):
+    """channel of the item product, from its snapshot"""
+    snapshot = item.get_snapshot()
+    return snapshot and snapshot.channel_id
+
+
+def apply_promotions(cart):
+    """
+    evaluates the promotions for the cart items and coupons,
+    returns the total discount
+    """
+    index = get_index()
+    had_promotions = 'promotions' in cart.extra_costs or any(
+        item.discount for item in cart.items
+    )
+    if not index.size and not had_promotions:
+        return 0.0
+
+    lines = []
+    for item in cart.items:
+        item.clean()
+        lines.append((
+            item.uid,
+            get_channel_id(item) if index.by_channel else None,
+            float(item.unity_value or 0),
+            float(item.quantity or 1)
+        ))
+    discounts, cart_discount = index.evaluate(lines, cart.coupons)
+
+    for item, discount, line in zip(cart.items, discounts, lines):
+        unit = round(discount / line[3], 2)
+        current = float(item.discount or 0)
+        if unit == current:
+            continue
+        item.extra_value = float(item.extra_value or 0) + current - unit
+        item.discount = unit
+
+    if cart_discount:
+        cart.extra_costs['promotions'] = -round(cart_discount, 2)
+    else:
+        cart.extra_costs.pop('promotions', None)
+
+    cart._columns = None
+    return sum(discounts) + cart_discount
@@ -0,0 +1,167 @@
+# coding: utf-8
+"""
+Immutable snapshots of the product fields items need (uid, title,
+prices, weight, dimensions, url, channel), cached per process in an LRU bounded
+by CART_SNAPSHOT_CACHE_SIZE for CART_SNAPSHOT_TTL seconds and keyed by
+product id, so hot products are not fetched and dereferenced on every
+set_item and Item.clean. Saving or deleting a product drops its
+snapshot in the saving process and bumps the 'products' RegistryVersion,
+other processes clear their cache when they see the new version (at
+most CART_REGISTRY_VERSION_INTERVAL seconds later).
+"""
+import threading
+
+from bson import DBRef
+from flask import current_app, has_app_context
+from quokka.core.models.content import Content
+
+from .cache import MemoryCache
+from .instrumentation import get_metrics
+from .promotions import get_ref_id
+
+
+def call(product, method):
+    getter = getattr(product, method, None)
+    return getter() if getter is not None else None
+
+
+class ProductSnapshot(object):
+    """
+    read only copy of a product, implements the getters of
+    BaseProductReference used by Item.clean
+    """
+    __slots__ = ('pk', 'collection', 'uid', 'title', 'unity_value',
+                 'extra_value', 'weight', 'dimensions', 'url',
+                 'channel_id', 'controls_stock')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ProductSnapshot is immutable")
+
+    @classmethod
+    def from_product(cls, product):
+        return cls(
+            pk=product.pk,
+            collection=product._get_collection_name(),
+            uid=call(product, 'get_uid') or str(product.pk),
+            title=call(product, 'get_title'),
+            unity_value=call(product, 'get_unity_value'),
+            extra_value=call(product, 'get_extra_value'),
+            weight=call(product, 'get_weight'),
+            dimensions=call(product, 'get_dimensions'),
+            url=call(product, 'get_absolute_url'),
+            channel_id=get_ref_id(product, 'channel'),
+            controls_stock=getattr(product, 'stock', None) is not None
+        )
+
+    def get_reference(self):
+        """value for Item.product without loading the product"""
+        return DBRef(self.collection, self.pk)
+
+    def get_uid(self):
+        return self.uid
+
+    def get_title(self):
+        return self.title
+
+    def get_unity_value(self):
+        return self.unity_value
+
+    def get_extra_value(self):
+        return self.extra_value
+
+    def get_weight(self):
+        return self.weight
+
+    def get_dimensions(self):
+        return self.dimensions
+
+    def get_absolute_url(self):
+        return self.url
+
+
+def get_state():
+    state = current_app.extensions.get('cart_snapshots')
+    if state is None:
+        config = current_app.config
+        state = current_app.extensions.setdefault('cart_snapshots', {
+            'cache': MemoryCache(
+                size=config.get('CART_SNAPSHOT_CACHE_SIZE', 10000),
+                timeout=config.get('CART_SNAPSHOT_TTL', 60)
+            ),
+            'version': None,
+            'hits': 0,
+            'misses': 0,
+            'lock': threading.Lock()
+        })
+    return state
+
+
+def check_version(state):
+    """clears the cache when a product changed in any process"""
+    from .models import RegistryVersion
+    version = RegistryVersion.current('products')
+    if state['version'] != version:
+        with state['lock']:
+            if state['version'] != version:
+                state['cache'].clear()
+                state['version'] = version
+
+
+def get_product_id(product):
+    """id of a product given as document, DBRef or id"""
+    if product is None or product == '':
+        return None
+    return getattr(product, 'pk', None) or getattr(product, 'id', product)
+
+
+def get_snapshot(product):
+    """
+    snapshot of a product given as document, DBRef or id,
+    only misses of products given by id query the database
+    """
+    product_id = get_product_id(product)
+    if product_id is None:
+        return None
+
+    state = get_state()
+    check_version(state)
+    key = str(product_id)
+    snapshot = state['cache'].get(key)
+    metrics = get_metrics()
+    if snapshot is not None:
+        with state['lock']:
+            state['hits'] += 1
+        if metrics is not None:
+            metrics.snapshot_hits += 1
+        return snapshot
+
+    with state['lock']:
+        state['misses'] += 1
+    if metrics is not None:
+        metrics.snapshot_misses += 1
+    if not isinstance(product, Content):
+        try:
+            product = Content.objects(id=product_id).first()
+        except Exception:  # invalid ids
+            product = None
+        if product is None:
+            return None
+    snapshot = ProductSnapshot.from_product(product)
+    state['cache'].set(key, snapshot)
+    return snapshot
+
+
+def invalidate_snapshot(sender, document, **kwargs):
+    """mongoengine post_save/post_delete receiver"""
+    if has_app_context() and hasattr(document, 'get_unity_value'):
+        get_state()['cache'].delete(str(document.pk))
+
+
+def get_snapshot_stats():
+    state = get_state()
+    return {'hits': state['hits'], 'misses': state['misses'],
+            'size': len(state['cache'].entries)}
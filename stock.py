@@ -0,0 +1,46 @@
+# coding: utf-8
+"""
+Atomic stock counters, the stock is stored in the product document
+and only changed with conditional $inc updates so it never goes
+below zero no matter how many buyers compete for the same product.
+"""
+from pymongo import UpdateOne
+
+
+class OutOfStock(Exception):
+    pass
+
+
+class ReservationConflict(Exception):
+    """the reservation kept changing concurrently while being set"""
+
+
+def take_stock(collection, product_id, quantity):
+    """
+    decrements `quantity` units if available, returns True when taken,
+    False when there is not enough stock and None for products which
+    do not control stock (stock is null)
+    """
+    result = collection.update_one(
+        {'_id': product_id, 'stock': {'$gte': quantity}},
+        {'$inc': {'stock': -quantity}}
+    )
+    if result.modified_count:
+        return True
+    if collection.find_one({'_id': product_id, 'stock': None}, {'_id': 1}):
+        return None
+    return False
+
+
+def give_back_stock(collection, quantities):
+    """
+    returns stock to products in one bulk write
+    quantities: {product_id: quantity}
+    """
+    requests = [
+        UpdateOne({'_id': product_id, 'stock': {'$ne': None}},
+                  {'$inc': {'stock': quantity}})
+        for product_id, quantity in quantities.items() if quantity
+    ]
+    if requests:
+        collection.bulk_write(requests, ordered=False)
@@ -13,3 +13,72 @@ logger = logging.getLogger(__name__)
 @celery.task
 def cart_task():
     logger.info("Doing something async...")
+
+
+@celery.task
+def archive_old_carts():
+    from .archive import archive_carts
+    moved = archive_carts()
+    logger.info("%s carts archived", moved)
+    return moved
+
+
+@celery.task
+def flush_hot_carts():
+    """periodic flush of a hot store shared by the host processes"""
+    from .hotstore import flush_hotstore
+    flushed = flush_hotstore()
+    logger.info("%s hot carts flushed", flushed)
+    return flushed
+
+
+@celery.task
+def sweep_reservations():
+    from .models import Reservation
+    released = Reservation.sweep_expired()
+    logger.info("%s expired reservations released", released)
+    return released
+
+
+@celery.task(bind=True)
+def reprice_product(self, product_id):
+    """updates pending carts after a product price change"""
+    from quokka.core.models.content import Content
+    from .models import Cart
+
+    def progress(done, total):
+        self.update_state(state='PROGRESS',
+                          meta={'done': done, 'total': total})
+
+    product = Content.objects.get(id=product_id)
+    repriced = Cart.reprice_product(product, progress=progress)
+    logger.info("%s carts repriced for %s", repriced, product_id)
+    return repriced
+
+
+@celery.task(bind=True, max_retries=10, default_retry_delay=60)
+def reconcile_transaction(self, identifier, transaction_code):
+    """checks a transaction whose confirmation hit an unavailable gateway"""
+    from .breaker import GatewayUnavailable
+    from .models import Processor
+    processor = Processor.get_instance_by_identifier(identifier)
+    try:
+        response = processor.call_gateway(
+            'check_transaction', processor.pg.check_transaction,
+            transaction_code
+        )
+    except GatewayUnavailable as e:
+        raise self.retry(exc=e)
+    return processor.handle_notification(response)
+
+
+@celery.task
+def dispatch_order_events():
+    """periodic relay of cart outboxes and delivery to the event sinks"""
+    from .events import process_events
+    delivered = process_events()
+    if delivered is None:
+        logger.info("order events already being dispatched")
+    else:
+        logger.info("order events delivered: %s", delivered)
+    return delivered
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import json
-from flask import request, jsonify, redirect, url_for, session, current_app
+from flask import (request, jsonify, redirect, url_for, session,
+                   current_app, abort, Response)
 from flask.views import View, MethodView
 from quokka.core.templates import render_template
 from quokka.utils import get_current_user
 from flask.ext.security import current_user
 from flask.ext.security.utils import url_for_security
-from .models import Cart, Processor
+from .models import Cart, Processor, CheckoutAttempt
+from .archive import all_carts
+from .instrumentation import measure_request, timed, get_sink
+from .profiling import profile_request
 
 import logging
 logger = logging.getLogger()
@@ -16,6 +20,12 @@ logger = logging.getLogger()
 class BaseView(MethodView):
 
     requires_login = False
+    profiled = False
+
+    def dispatch_request(self, *args, **kwargs):
+        name = self.__class__.__name__
+        with measure_request(name), profile_request(name, self.profiled):
+            return super(BaseView, self).dispatch_request(*args, **kwargs)
 
     def needs_login(self, **kwargs):
         if not current_user.is_authenticated():
@@ -67,6 +77,8 @@ class CartView(BaseView):
 
 
 class SetItemView(BaseView):
+    profiled = True
+
     def post(self):
         cart = Cart.get_cart()
         params = {k: v for k, v in request.form.items() if not k == "next"}
@@ -79,6 +91,7 @@ class RemoveItemView(BaseView):
         cart = Cart.get_cart()
         params = {k: v for k, v in request.form.items() if not k == "next"}
         item = cart.remove_item(**params)
+        cart.save()
         return self.redirect(item=item)
 
 
@@ -90,8 +103,28 @@ class SetProcessorView(BaseView):
         return self.redirect(processor=cart.processor.identifier)
 
 
+class SetCouponView(BaseView):
+    def post(self):
+        cart = Cart.get_cart()
+        code = request.form.get('coupon')
+        if request.form.get('remove'):
+            cart.remove_coupon(code)
+            cart.save()
+            return self.redirect(coupons=cart.coupons)
+        valid = cart.set_coupon(code)
+        if valid:
+            cart.save()
+        return self.redirect(coupon=code, valid=valid, coupons=cart.coupons)
+
+
 class CheckoutView(BaseView):
+    profiled = True
+
     def post(self):
+        # retries of a finished checkout get the same gateway redirect
+        replay = CheckoutAttempt.get_replay(session.get('cart_id'))
+        if replay:
+            return replay
         cart = Cart.get_cart()
         return (cart.requires_login and self.needs_login()) \
             or cart.process_pipeline()
@@ -99,30 +132,70 @@ class CheckoutView(BaseView):
 
 class HistoryView(BaseView):
     def get(self):
-        context = {
-            "carts": Cart.objects(belongs_to=get_current_user())
-        }
-        return self.needs_login(
+        login = self.needs_login(
             next=url_for('quokka.modules.cart.history')
-        ) or self.render(
-            'cart/history.html', **context
         )
+        if login:
+            return login
+        page = request.args.get('page', 1, type=int)
+        carts, has_next = all_carts(page, belongs_to=get_current_user())
+        context = {
+            "carts": carts,
+            "page": page,
+            "has_next": has_next
+        }
+        return self.render('cart/history.html', **context)
 
 
 class ProcessorView(View):
     methods = ['GET', 'POST']
+    processor_method = None
+    profiled = False
 
     def get_processor(self, identifier):
         return Processor.get_instance_by_identifier(identifier)
 
+    def dispatch_request(self, identifier):
+        name = self.__class__.__name__
+        with measure_request(name), \
+                profile_request(name, self.profiled) as profile:
+            processor = self.get_processor(identifier)
+            with timed('processor.%s' % self.processor_method):
+                response = getattr(processor, self.processor_method)()
+                # the cart of the request, not the one in the session
+                cart = getattr(processor, 'cart', None)
+                profile.update(
+                    cart_id=str(cart.id) if cart else None,
+                    pipeline_index=None
+                )
+                return response
+
 
 class NotificationView(ProcessorView):
-    def dispatch_request(self, identifier):
-        processor = self.get_processor(identifier)
-        return processor.notification()
+    processor_method = 'notification'
+    profiled = True
 
 
 class ConfirmationView(ProcessorView):
-    def dispatch_request(self, identifier):
-        processor = self.get_processor(identifier)
-        return processor.confirmation()
+    processor_method = 'confirmation'
+
+
+class MetricsView(View):
+    """
+    Prometheus text exposition of the cart metrics, scrapers pass
+    CART_METRICS_TOKEN, without a token only admins can read it
+    """
+
+    def dispatch_request(self):
+        token = current_app.config.get('CART_METRICS_TOKEN')
+        if token:
+            if request.args.get('token') != token:
+                abort(403)
+        elif not (current_user.is_authenticated() and
+                  current_user.has_role('admin')):
+            abort(404)
+        sink = get_sink()
+        if not hasattr(sink, 'render'):
+            abort(404)
+        return Response(sink.render(),
+                        mimetype='text/plain; version=0.0.4')